@@ -4,15 +4,16 @@
 # Copyright 2009 Dustin Lang
 # https://github.com/dstndstn/astrometry.net
 
+import hashlib
 import json
-from urllib.parse import urlencode, quote
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError
+import os
+import threading
+import time
+from urllib.parse import urlencode, quote, urlsplit
 
 if __name__ == "__main__":
     print("This is the NovaClient library and cannot be ran")
 
-# TODO: This is duplicated in both files
 # TODO: When there is a bad API key, status bar sticks with "Solving Image...""
 class RequestError(Exception):
     '''
@@ -20,6 +21,13 @@ class RequestError(Exception):
     '''
     pass
 
+class SessionExpired(RequestError):
+    '''
+    The server no longer accepts our (cached) session key
+    '''
+    pass
+
+
 def json2python(data):
     try:
         return json.loads(data)
@@ -30,15 +38,79 @@ def json2python(data):
 def python2json(pyd):
     return json.dumps(pyd)
 
+class MultipartBody(object):
+    '''
+    A multipart/form-data upload body of known length that reads the file in
+    blocks as it is sent, so memory use does not grow with the file size.
+    Iterating it again (e.g. to retry on a fresh connection) re-reads the file.
+    '''
+    block_size = 64 * 1024
+
+    def __init__(self, json, filename, path, progress=None):
+        import random
+        boundary_key = ''.join([random.choice('0123456789') for _ in range(19)])
+        boundary = '===============%s==' % boundary_key
+        self.content_type = 'multipart/form-data; boundary="%s"' % boundary
+        self.path = path
+        self.progress = progress
+        self.pre = (
+            '--' + boundary + '\n' +
+            'Content-Type: text/plain\r\n' +
+            'MIME-Version: 1.0\r\n' +
+            'Content-disposition: form-data; name="request-json"\r\n' +
+            '\r\n' +
+            json + '\n' +
+            '--' + boundary + '\n' +
+            'Content-Type: application/octet-stream\r\n' +
+            'MIME-Version: 1.0\r\n' +
+            'Content-disposition: form-data; name="file"; filename="%s"' % filename +
+            '\r\n' + '\r\n').encode()
+        self.post = ('\n' + '--' + boundary + '--\n').encode()
+        self.file_size = os.path.getsize(path)
+
+    def __len__(self):
+        return len(self.pre) + self.file_size + len(self.post)
+
+    def __iter__(self):
+        total = len(self)
+        sent = 0
+        for chunk in self._chunks():
+            sent += len(chunk)
+            yield chunk
+            if self.progress is not None:
+                self.progress(sent, total)
+
+    def _chunks(self):
+        yield self.pre
+        with open(self.path, 'rb') as fle:
+            while True:
+                block = fle.read(self.block_size)
+                if not block:
+                    break
+                yield block
+        yield self.post
+
+
 class NovaClient(object):
     '''
     nova.astrometry.net client
+
+    HTTP connections are kept alive and reused (one pool per thread), and the
+    session key can be cached on disk so that several solves share one login.
     '''
     default_url = 'https://nova.astrometry.net/api/'
+    # how long (seconds) a cached session key is trusted before logging in again
+    session_lifetime = 60 * 60
 
-    def __init__(self, apiurl=default_url):
+    def __init__(self, apiurl=default_url, session_file=None):
         self.session = None
         self.apiurl = apiurl
+        self.apikey = None
+        self.session_file = session_file
+        self.session_from_cache = False
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'connections': 0, 'logins': 0, 'logins_saved': 0}
 
     def get_url(self, service):
         '''
@@ -46,11 +118,90 @@ class NovaClient(object):
         '''
         return self.apiurl + service
 
-    def send_request(self, service, args={}, file_args=None):
+    def get_stats(self):
         '''
-        service: string
-        args: dict
+        request counters, to measure what connection and session reuse saved
+        '''
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['handshakes_saved'] = stats['requests'] - stats['connections']
+        return stats
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _connection(self, scheme, netloc, fresh=False):
+        '''
+        returns a kept-alive connection to the server, opening one if needed
         '''
+        import http.client
+        pool = getattr(self._local, 'connections', None)
+        if pool is None:
+            pool = self._local.connections = {}
+        conn = pool.get((scheme, netloc))
+        if conn is not None and fresh:
+            conn.close()
+            conn = None
+        if conn is None:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc, timeout=120)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=120)
+            pool[(scheme, netloc)] = conn
+            self._count('connections')
+        return conn
+
+    def close(self):
+        '''
+        closes this thread's kept-alive connections
+        '''
+        for conn in getattr(self._local, 'connections', {}).values():
+            conn.close()
+        self._local.connections = {}
+
+    def _http(self, method, url, body=None, headers=None):
+        '''
+        sends one request over a pooled connection; returns (status, body)
+        '''
+        import http.client
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        headers = dict(headers or {})
+        self._count('requests')
+        for attempt in range(2):
+            # A kept-alive socket may have been closed by the server while idle,
+            # in that case retry once on a fresh connection
+            conn = self._connection(parts.scheme, parts.netloc, fresh=(attempt > 0))
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    http.client.BadStatusLine, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if attempt > 0:
+                    raise
+                continue
+            if resp.will_close:
+                conn.close()
+                self._local.connections.pop((parts.scheme, parts.netloc), None)
+            return resp.status, data
+
+    def get_file(self, url):
+        '''
+        downloads a file (e.g. a wcs_file) over the same pooled connections
+        '''
+        status, data = self._http('GET', url)
+        if status >= 400:
+            raise RequestError('HTTP error %d retrieving %s' % (status, url))
+        return data
+
+    def _prepare_request(self, service, args, file_args, progress):
+        '''
+        builds the url, body and headers of an API request
+        '''
+        args = dict(args or {})
         if self.session is not None:
             args.update({ 'session': self.session })
         # print 'Python:', (args)
@@ -58,70 +209,148 @@ class NovaClient(object):
         # print 'Sending json:', json
         url = self.get_url(service)
         print('Sending to URL:', url)
-        # If we're sending a file, format a multipart/form-data
+        # If we're sending a file, stream a multipart/form-data body from disk
         if file_args is not None:
-            import random
-            boundary_key = ''.join([random.choice('0123456789') for _ in range(19)])
-            boundary = '===============%s==' % boundary_key
-            headers = {'Content-Type':
-                       'multipart/form-data; boundary="%s"' % boundary}
-            data_pre = (
-                '--' + boundary + '\n' +
-                'Content-Type: text/plain\r\n' +
-                'MIME-Version: 1.0\r\n' +
-                'Content-disposition: form-data; name="request-json"\r\n' +
-                '\r\n' +
-                json + '\n' +
-                '--' + boundary + '\n' +
-                'Content-Type: application/octet-stream\r\n' +
-                'MIME-Version: 1.0\r\n' +
-                'Content-disposition: form-data; name="file"; filename="%s"' % file_args[0] +
-                '\r\n' + '\r\n')
-            data_post = (
-                '\n' + '--' + boundary + '--\n')
-            data = data_pre.encode() + file_args[1] + data_post.encode()
+            data = MultipartBody(json, file_args[0], file_args[1], progress)
+            headers = {'Content-Type': data.content_type,
+                       'Content-Length': str(len(data))}
         else:
             # Else send x-www-form-encoded
             data = {'request-json': json}
             # print 'Sending form data:', data
             data = urlencode(data).encode('utf-8')
             # print 'Sending data:', data
-            headers = {}
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        return url, data, headers
 
-        request = Request(url=url, headers=headers, data=data)
-        try:
-            fle = urlopen(request)
-            txt = fle.read()
-            # DEBUG print 'Got json:', txt
-            result = json2python(txt)
-            if not result:
-                raise RequestError('Server did not send valid json: ', txt)
-            # DEBUG print 'Got result:', result
-            stat = result.get('status')
-            # DEBUG print 'Got status:', stat
-            if stat == 'error':
-                errstr = result.get('errormessage', '(none)')
-                raise RequestError('server error message: ' + errstr)
-            return result
-        except HTTPError as err:
-            print('HTTPError', err)
-            txt = err.read()
+    def _parse_response(self, service, status, txt):
+        '''
+        returns the result of an API request, raising SessionExpired when the
+        cached session key is no longer valid
+        '''
+        if status >= 400:
+            print('HTTPError', status)
             errFileName = 'err.html'
             open(errFileName, 'wb').write(txt)
             print('Wrote error text to ', errFileName)
+            return None
+        # DEBUG print 'Got json:', txt
+        result = json2python(txt)
+        if not result:
+            raise RequestError('Server did not send valid json: ', txt)
+        # DEBUG print 'Got result:', result
+        stat = result.get('status')
+        # DEBUG print 'Got status:', stat
+        if stat == 'error':
+            errstr = result.get('errormessage', '(none)')
+            if self.session_from_cache and 'session' in errstr and service != 'login':
+                raise SessionExpired(errstr)
+            raise RequestError('server error message: ' + errstr)
+        return result
 
-    def login(self, apikey):
+    def send_request(self, service, args=None, file_args=None, progress=None):
         '''
-        Logs us into the plate-solver and gets a session key
+        service: string
+        args: dict
+        file_args: (filename, path) of a file to upload
+        progress: called as progress(bytes_sent, total_bytes) during an upload
+        '''
+        url, data, headers = self._prepare_request(service, args, file_args, progress)
+        status, txt = self._http('POST', url, body=data, headers=headers)
+        try:
+            return self._parse_response(service, status, txt)
+        except SessionExpired:
+            # The cached session key has expired on the server, log in again
+            self._forget_session()
+            self.login(self.apikey)
+            return self.send_request(service, args, file_args, progress)
+
+    def _session_key(self, apikey):
+        return hashlib.sha256((self.apiurl + apikey).encode()).hexdigest()
+
+    def _read_session_file(self):
+        try:
+            with open(self.session_file) as fle:
+                return json.load(fle)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_session_file(self, sessions):
+        tmp = self.session_file + '.%d.tmp' % os.getpid()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.session_file)), exist_ok=True)
+            with open(tmp, 'w') as fle:
+                json.dump(sessions, fle)
+            os.replace(tmp, self.session_file)
+        except OSError as err:
+            print('Could not cache nova session:', err)
+
+    def _load_session(self, apikey):
+        '''
+        returns an unexpired cached session key for this API key, if any
+        '''
+        if self.session_file is None:
+            return None
+        entry = self._read_session_file().get(self._session_key(apikey))
+        if entry is None or entry.get('expires', 0) < time.time():
+            return None
+        return entry.get('session')
+
+    def _save_session(self, apikey, sess):
+        if self.session_file is None:
+            return
+        sessions = self._read_session_file()
+        sessions[self._session_key(apikey)] = {'session': sess,
+                                               'expires': time.time() + self.session_lifetime}
+        self._write_session_file(sessions)
+
+    def _forget_session(self):
+        self.session = None
+        self.session_from_cache = False
+        if self.session_file is None or self.apikey is None:
+            return
+        sessions = self._read_session_file()
+        if sessions.pop(self._session_key(self.apikey), None) is not None:
+            self._write_session_file(sessions)
+
+    def _resume_session(self, apikey):
+        '''
+        picks up an unexpired cached session key; returns True if there was one
+        '''
+        self.apikey = apikey
+        sess = self._load_session(apikey)
+        if not sess:
+            self.session = None
+            return False
+        print('Reusing session:', sess)
+        self.session = sess
+        self.session_from_cache = True
+        self._count('logins_saved')
+        return True
+
+    def _start_session(self, apikey, result):
+        '''
+        takes the session key from a login result
         '''
-        import string
-        args = { 'apikey': apikey.strip() }
-        result = self.send_request('login', args)
         sess = result.get('session') if result is not None else None
         if not sess:
             raise RequestError('no session in result')
         print('Got session:', sess)
+        self._count('logins')
         self.session = sess
+        self.session_from_cache = False
+        self._save_session(apikey, sess)
+
+    def login(self, apikey):
+        '''
+        Logs us into the plate-solver and gets a session key, reusing a cached
+        one when it has not expired
+        '''
+        apikey = apikey.strip()
+        if self._resume_session(apikey):
+            return
+        args = { 'apikey': apikey }
+        self._start_session(apikey, self.send_request('login', args))
 
     def _get_upload_args(self, **kwargs):
         '''
@@ -142,7 +371,10 @@ class NovaClient(object):
                 ('radius', None, float),
                 ('downsample_factor', None, int),
                 ('tweak_order', None, int),
-                ('crpix_center', None, bool), ]
+                ('crpix_center', None, bool),
+                ('parity', None, int),
+                ('image_width', None, int),
+                ('image_height', None, int), ]
         for key, default, typ in lkdt:
             # image_width, image_height
             if key in kwargs:
@@ -154,14 +386,14 @@ class NovaClient(object):
         # print 'Upload args:', args
         return args
 
-    def upload(self, fne, **kwargs):
+    def upload(self, fne, progress=None, **kwargs):
         '''
-        uploads an image file
+        uploads an image file, streaming it from disk
+        progress: called as progress(bytes_sent, total_bytes)
         '''
         args = self._get_upload_args(**kwargs)
         try:
-            fle = open(fne, 'rb')
-            result = self.send_request('upload', args, (fne, fle.read()))
+            result = self.send_request('upload', args, (os.path.basename(fne), fne), progress)
             return result
         except IOError:
             print('File %s does not exist' % fne)
@@ -203,3 +435,85 @@ class NovaClient(object):
         result = self.send_request('jobs_by_tag?query=%s&%s'
                                    % (quote(tag.strip()), exact_option), {}, )
         return result
+
+
+class JobWaiter(object):
+    '''
+    Waits on many nova submissions at once, polling each with an adaptive
+    interval: short at first, backing off while the submission is queued,
+    and tightening again once its job is running.
+    '''
+    min_interval = 0.5
+    queued_max_interval = 8.0
+    running_max_interval = 2.0
+    backoff = 1.5
+
+    def __init__(self, client):
+        self.client = client
+        self.pending = {}
+        self.polls = 0
+        # sub_id -> (time submitted, time its job started) of finished submissions
+        self.times = {}
+
+    def add(self, sub_id):
+        '''
+        start tracking a submission
+        '''
+        self.pending[sub_id] = {'job_id': None,
+                                'interval': self.min_interval,
+                                'added': time.time(),
+                                'started': None,
+                                'next_poll': time.time() + self.min_interval}
+
+    def _poll(self, sub_id, entry):
+        '''
+        polls one submission or job; returns its final status or None
+        '''
+        self.polls += 1
+        if entry['job_id'] is None:
+            stat = self.client.sub_status(sub_id, justdict=True) or {}
+            jobs = [j for j in stat.get('jobs', []) if j is not None]
+            if not jobs:
+                # still queued, back off
+                entry['interval'] = min(entry['interval'] * self.backoff, self.queued_max_interval)
+                return None
+            print('Selecting job id', jobs[0])
+            entry['job_id'] = jobs[0]
+            entry['started'] = time.time()
+            entry['interval'] = self.min_interval
+            return None
+        stat = self.client.job_status(entry['job_id'], justdict=True) or {}
+        status = stat.get('status', '')
+        if status in ('success', 'failure'):
+            return status
+        entry['interval'] = min(entry['interval'] * self.backoff, self.running_max_interval)
+        return None
+
+    def wait(self, timeout=None, cancel=None):
+        '''
+        generator yielding (sub_id, job_id, status) as each submission finishes,
+        status being 'success' or 'failure'
+        cancel: a threading.Event that stops the wait when set, leaving the
+        unfinished submissions pending
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while self.pending:
+            if cancel is not None and cancel.is_set():
+                return
+            sub_id = min(self.pending, key=lambda sid: self.pending[sid]['next_poll'])
+            entry = self.pending[sub_id]
+            now = time.time()
+            if deadline is not None and entry['next_poll'] > deadline:
+                raise RequestError('Timed out waiting for submissions %s' % list(self.pending))
+            if entry['next_poll'] > now:
+                if cancel is not None:
+                    cancel.wait(entry['next_poll'] - now)
+                    continue
+                time.sleep(entry['next_poll'] - now)
+            status = self._poll(sub_id, entry)
+            if status is None:
+                entry['next_poll'] = time.time() + entry['interval']
+                continue
+            del self.pending[sub_id]
+            self.times[sub_id] = (entry['added'], entry['started'])
+            yield sub_id, entry['job_id'], status
@@ -1,91 +1,287 @@
 import argparse
-import PPA_lib
-from astropy.io import fits
-
-# Parse arguments
-argParser = argparse.ArgumentParser(description="A python utility to help align any equotorial telescope by imaging the celestial pole region")
-
-argParser.add_argument("--solver", type=str, nargs="?", default=None, help="Whether to use online \"nova\" or \"local\" solver", required=True)
-argParser.add_argument("--horizontal", type=str, nargs="?", metavar="horizontal_file_path", default=None, help="The filepath to the horizontal image", required=True)
-argParser.add_argument("--vertical", type=str, nargs="?", metavar="vertical_file_path", default=None, help="The filepath to the vertical image", required=True)
-argParser.add_argument("--improved", type=str, nargs="?", metavar="improved_file_path", default=None, help="The filepath to the improved image after adjusting scope mount")
-
-argParser.add_argument("--cache-dir", type=str, nargs="?", help="Filepath to look in for cached .wcs files")
-argParser.add_argument("--config", type=str, nargs="?", help="Filepath to config to use")
-argParser.add_argument("--more-data", type=bool, nargs="?", default=False, help="Returns more detailed information")
-
-args = argParser.parse_args()
-
-solver_options = ["local", "nova"]
-if args.solver not in solver_options:
-    print("Option '--solver' must be one of " + str(solver_options))
-    exit(2)
-
-print(args)
-
-config_file_path = args.config
-cache_dir = args.cache_dir
-return_more_data = args.more_data
-solver = args.solver
-
-config = PPA_lib.PPAConfig(config_file_path)
-config.cachedir = cache_dir or config.cachedir
-
-
-def solve_img(imagePath):
-    PPA_lib.plate_solve(config, imagePath, solver)
-
-
-# Solve images
-hImgPath = args.horizontal
-hWcsPath = PPA_lib.get_wcs_file_path(config, hImgPath)
-solve_img(hImgPath)
-hdulist_h = fits.open(hWcsPath)
-
-vImgPath = args.vertical
-vWcsPath = PPA_lib.get_wcs_file_path(config, vImgPath)
-solve_img(vImgPath)
-hdulist_v = fits.open(vWcsPath)
-
-iImgPath = args.improved
-iWcsPath = None
-hdulist_i = None
-if iImgPath is not None:
-    iWcsPath = PPA_lib.get_wcs_file_path(config, iImgPath)
-    solve_img(iImgPath)
-    hdulist_i = fits.open(iWcsPath)
-
-
-# Determine axis and error
-axis = PPA_lib.find_ra_axis_pix_coords(hdulist_v[0], hdulist_h[0])
-# Have the wcs files, just get the error
-if hdulist_i is None:
-    error = PPA_lib.find_error(axis, hdulist_h)
-else:
-    error = PPA_lib.find_error(axis, hdulist_i)
+import os
+import sys
+# Everything heavier is imported by the code path that needs it, so that
+# --help, or a run where every image is already solved, starts quickly
+
+# Where PPA_daemon listens by default
+DAEMON_PORT = 8765
+DAEMON_URL = 'http://127.0.0.1:%d/' % DAEMON_PORT
+
+
+def parse_args():
+    argParser = argparse.ArgumentParser(description="A python utility to help align any equotorial telescope by imaging the celestial pole region", epilog="To align many image sets at once, see: PPA-cli.py batch --help. To keep PPA running between calls, see: PPA-cli.py daemon --help")
+
+    argParser.add_argument("--solver", type=str, nargs="?", default=None, help="Whether to use online \"nova\" or \"local\" solver", required=True)
+    argParser.add_argument("--horizontal", type=str, nargs="?", metavar="horizontal_file_path", default=None, help="The filepath to the horizontal image", required=True)
+    argParser.add_argument("--vertical", type=str, nargs="?", metavar="vertical_file_path", default=None, help="The filepath to the vertical image", required=True)
+    argParser.add_argument("--improved", type=str, nargs="?", metavar="improved_file_path", default=None, help="The filepath to the improved image after adjusting scope mount")
+    argParser.add_argument("--rotated", type=str, action="append", metavar="rotated_file_path", default=[], help="A further image taken while rotating in RA only, used with the vertical and horizontal ones to find the RA axis more precisely (can be repeated)")
+
+    argParser.add_argument("--cache-dir", type=str, nargs="?", help="Filepath to look in for cached .wcs files")
+    argParser.add_argument("--config", type=str, nargs="?", help="Filepath to config to use")
+    argParser.add_argument("--watch", type=str, nargs="?", metavar="folder_path", default=None, help="Keep solving the newest image written to this folder as an improved image")
+    argParser.add_argument("--more-data", type=bool, nargs="?", default=False, help="Returns more detailed information")
+    argParser.add_argument("--trace", type=str, nargs="?", metavar="trace_file_path", const="-", default=None, help="Write timing spans of each phase to this file (stderr if no file is given), to open in chrome://tracing or Perfetto")
+    argParser.add_argument("--daemon", type=str, nargs="?", metavar="url", const=DAEMON_URL, default=None, help="Ask a running PPA daemon (PPA-cli.py daemon) for the error, at this URL (default %s)" % DAEMON_URL)
+
+    return argParser.parse_args()
+
+
+def parse_batch_args(argv):
+    argParser = argparse.ArgumentParser(prog="PPA-cli.py batch", description="Align many image sets listed in a CSV or JSON manifest, writing each result as soon as it is known")
+
+    argParser.add_argument("manifest", type=str, help="CSV (name,horizontal,vertical,improved) or JSON list of the image sets")
+    argParser.add_argument("--solver", type=str, default=None, help="Whether to use online \"nova\" or \"local\" solver", required=True)
+    argParser.add_argument("--results", type=str, default=None, help="JSON lines file to append the results to, and to resume from (default: next to the manifest)")
+    argParser.add_argument("--processes", type=int, default=None, help="Processes computing axes and errors (default: one per core)")
+    argParser.add_argument("--concurrency", type=int, default=8, help="Images being solved at once (default 8)")
+    argParser.add_argument("--cache-dir", type=str, nargs="?", help="Filepath to look in for cached .wcs files")
+    argParser.add_argument("--config", type=str, nargs="?", help="Filepath to config to use")
+    argParser.add_argument("--trace", type=str, nargs="?", metavar="trace_file_path", const="-", default=None, help="Write timing spans of each phase to this file (stderr if no file is given)")
+
+    return argParser.parse_args(argv)
+
+
+def batch(argv):
+    args = parse_batch_args(argv)
+    if args.trace is not None:
+        import PPA_trace
+        PPA_trace.enable(args.trace)
+    import PPA_lib
+    import PPA_batch
+
+    if args.solver not in ("local", "nova"):
+        print("Option '--solver' must be one of ['local', 'nova']")
+        exit(2)
+    config = PPA_lib.PPAConfig(args.config)
+    config.cachedir = args.cache_dir or config.cachedir
+    sets = PPA_batch.read_manifest(args.manifest)
+    results = args.results or os.path.splitext(args.manifest)[0] + '.results.jsonl'
+    failures = PPA_batch.run_batch(config, args.solver, sets, results, args.processes, args.concurrency)
+    print('Results in %s, %d set(s) failed' % (results, failures))
+    exit(1 if failures else 0)
+
+
+def make_upload_progress(name):
+    '''
+    Returns a callback reporting the upload progress of one image in 10% steps
+    '''
+    last = [-10]
+
+    def upload_progress(sent, total):
+        percent = 100 * sent // total
+        if percent // 10 != last[0] // 10 or sent == total:
+            print('%s: uploaded %d of %d bytes (%d%%)' % (name, sent, total, percent))
+        last[0] = percent
+    return upload_progress
+
+
+def solve_all(config, solver, images, prior=None):
+    '''
+    Solves every image at once and yields (hint, WcsSummary) as each WCS is ready:
+    the nova solves share one polling loop, and local solve-field runs happen in
+    subprocesses on the managed worker pool (see PPA_lib.plate_solve_many).
+    images: dict of hint -> image path
+    prior: the WcsSummary of an image already solved, to search around
+    '''
+    import PPA_lib
+    progress = None
+    if solver == 'nova':
+        def progress(image_path):
+            return make_upload_progress(os.path.basename(image_path))
+    for hint, wcs_path, error in PPA_lib.plate_solve_many(config, images, solver, progress, prior):
+        if error is not None:
+            raise error
+        yield hint, PPA_lib.wcs_summary(config, wcs_path)
+
+
+def watch(config, solver, folder, axis, prior):
+    '''
+    Solves each new frame written to folder as an improved image, printing its
+    error as soon as it is known. Frames that arrive while one is being solved
+    are skipped in favour of the newest. Each solve searches around the
+    previous one, starting from prior, the WcsSummary of the last image solved.
+    '''
+    import PPA_lib
+    import PPA_watch
+    watcher = PPA_watch.make_watcher(folder)
+    print('Watching %s for new images, Ctrl-C to stop' % folder, flush=True)
+    try:
+        for frame, skipped in PPA_watch.newest_frames(watcher):
+            if skipped:
+                print('Skipping %d older image(s)' % len(skipped))
+            try:
+                wcs_fn = PPA_lib.plate_solve(config, frame, solver, prior.scale, prior=prior)
+                summary = PPA_lib.wcs_summary(config, wcs_fn)
+                error = PPA_lib.find_error(axis, summary)
+                prior = summary
+            except Exception as err:
+                print('%s: %s' % (os.path.basename(frame), err), flush=True)
+                continue
+            print('%s: %s' % (os.path.basename(frame), formatError(error)), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
 
 def formatError(err):
+    import PPA_lib
     print(err)
-    if err[0] > 0:
-        inst = 'Right '
+    return PPA_lib.format_move(err)
+
+
+def daemon_token_path(port):
+    '''
+    The file where the daemon on port leaves the token its clients must send
+    '''
+    import platformdirs
+    return os.path.join(platformdirs.user_cache_dir("PPA", appauthor=False), 'daemon-%d.token' % port)
+
+
+def daemon_request(url, operation, payload):
+    '''
+    Sends one request to a PPA daemon (see PPA_daemon); returns its JSON answer
+    Raises OSError if no daemon answers at url, or its token can't be read
+    '''
+    import http.client
+    import json
+    from urllib.parse import urlsplit
+    parts = urlsplit(url)
+    port = parts.port or 80
+    with open(daemon_token_path(port)) as fle:
+        token = fle.read().strip()
+    conn = http.client.HTTPConnection(parts.hostname, port)
+    try:
+        conn.request('POST', '/' + operation, json.dumps(payload),
+                     {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + token})
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def parse_daemon_args(argv):
+    argParser = argparse.ArgumentParser(prog="PPA-cli.py daemon", description="Keep PPA running, answering solve, axis and error requests on localhost (see PPA_daemon.py)")
+
+    argParser.add_argument("--solver", type=str, default="nova", help="The solver used when a request doesn't name one, \"nova\" (default) or \"local\"")
+    argParser.add_argument("--port", type=int, default=DAEMON_PORT, help="Port to listen on, on 127.0.0.1 (default %d)" % DAEMON_PORT)
+    argParser.add_argument("--cache-dir", type=str, nargs="?", help="Filepath to look in for cached .wcs files")
+    argParser.add_argument("--config", type=str, nargs="?", help="Filepath to config to use")
+    argParser.add_argument("--trace", type=str, nargs="?", metavar="trace_file_path", const="-", default=None, help="Write timing spans of each phase to this file (stderr if no file is given)")
+
+    return argParser.parse_args(argv)
+
+
+def daemon(argv):
+    args = parse_daemon_args(argv)
+    if args.trace is not None:
+        import PPA_trace
+        PPA_trace.enable(args.trace)
+    import PPA_lib
+    import PPA_daemon
+
+    config = PPA_lib.PPAConfig(args.config)
+    config.cachedir = args.cache_dir or config.cachedir
+    PPA_daemon.serve(config, daemon_token_path(args.port), args.solver, args.port)
+
+
+def align_on_daemon(args):
+    '''
+    Has a running daemon solve the images and find the error
+    Returns False if no daemon answers
+    '''
+    payload = {'solver': args.solver,
+               'horizontal': os.path.abspath(args.horizontal),
+               'vertical': os.path.abspath(args.vertical),
+               'improved': os.path.abspath(args.improved) if args.improved else None,
+               'rotated': [os.path.abspath(image) for image in args.rotated]}
+    try:
+        reply = daemon_request(args.daemon, 'error', payload)
+    except OSError as err:
+        print('No PPA daemon at %s (%s), solving here' % (args.daemon, err))
+        return False
+    if reply.get('status') != 'success':
+        print('PPA daemon: %s' % reply.get('message'))
+        exit(2)
+    print(tuple(reply['error']))
+    print(reply['move'])
+    return True
+
+
+def main():
+    if sys.argv[1:2] == ['batch']:
+        return batch(sys.argv[2:])
+    if sys.argv[1:2] == ['daemon']:
+        return daemon(sys.argv[2:])
+    args = parse_args()
+    if args.daemon is not None and args.watch is None and align_on_daemon(args):
+        exit(1)
+    if args.trace is not None:
+        import PPA_trace
+        PPA_trace.enable(args.trace)
+    import PPA_lib
+
+    solver_options = ["local", "nova"]
+    if args.solver not in solver_options:
+        print("Option '--solver' must be one of " + str(solver_options))
+        exit(2)
+
+    print(args)
+
+    config_file_path = args.config
+    cache_dir = args.cache_dir
+    solver = args.solver
+
+    config = PPA_lib.PPAConfig(config_file_path)
+    config.cachedir = cache_dir or config.cachedir
+
+    # Solve images, finding the axis as soon as both h and v are solved
+    images = {'h': args.horizontal, 'v': args.vertical}
+    if args.improved is not None:
+        images['i'] = args.improved
+    # the images rotated about the RA axis, all used to find it
+    axis_hints = ['v', 'h']
+    for number, image in enumerate(args.rotated, 1):
+        images['r%d' % number] = image
+        axis_hints.append('r%d' % number)
+    wcs_paths = {hint: PPA_lib.get_wcs_file_path(config, path)
+                 for hint, path in images.items() if os.path.exists(path)}
+    if len(wcs_paths) == len(images) and all(os.path.exists(path) for path in wcs_paths.values()):
+        # Everything is solved already, no need for any of the solver machinery
+        solved = ((hint, PPA_lib.wcs_summary(config, path)) for hint, path in wcs_paths.items())
     else:
-        inst = 'Left '
-    decdeg = abs(err[0])
-    inst = inst + ('%02d:%02d:%02d' % PPA_lib.decdeg2dms(decdeg))
-
-    if err[1] > 0:
-        inst = inst + '   Down '
+        # Images already solved tell the others where to look
+        prior = next((PPA_lib.wcs_summary(config, path) for path in wcs_paths.values()
+                      if os.path.exists(path)), None)
+        solved = solve_all(config, solver, images, prior)
+    summaries = {}
+    axis = None
+    for hint, summary in solved:
+        summaries[hint] = summary
+        if axis is None and all(hint in summaries for hint in axis_hints):
+            axis = PPA_lib.find_ra_axis([summaries[hint] for hint in axis_hints])[0]
+
+    # Have the wcs files, just get the error
+    if 'i' not in summaries:
+        error = PPA_lib.find_error(axis, summaries['h'])
     else:
-        inst = inst + '   Up '
-    decdeg = abs(err[1])
-    inst = inst + ('%02d:%02d:%02d' % PPA_lib.decdeg2dms(decdeg))
-    return inst
+        error = PPA_lib.find_error(axis, summaries['i'])
+
+    print(formatError(error))
+
+    if args.watch is not None:
+        watch(config, solver, args.watch, axis, summaries.get('i', summaries['h']))
 
+    exit(1)
 
-print(formatError(error))
 
-exit(1)
+if __name__ == '__main__':
+    if getattr(sys, 'frozen', False):
+        # in the frozen PPA-cli, batch's worker processes start here too
+        import multiprocessing
+        multiprocessing.freeze_support()
+    main()
 
 
 
@@ -7,12 +7,18 @@ Created on Sun Oct 12 22:40:05 2014
 
 from __future__ import print_function
 import os
+import queue
 import sys
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 import PPA_lib
+import PPA_trace
+import PPA_viewer
 from tkinter import Frame, Tk, Menu, Label, Entry, PhotoImage
 from tkinter import StringVar, IntVar, DoubleVar
-from tkinter import Scrollbar, Toplevel, Canvas, Radiobutton
+from tkinter import Toplevel, Radiobutton
 from tkinter import Button, LabelFrame, Checkbutton, Scale
 from tkinter import HORIZONTAL
 
@@ -106,7 +112,7 @@ class PhotoPolarAlign(Frame):
         '''
         self.stat_msg = txt
         self.wstat.config(text=self.stat_msg)
-        self.wstat.update()
+        self.wstat.update_idletasks()
 
     def settings_destroy(self):
         '''
@@ -123,13 +129,15 @@ class PhotoPolarAlign(Frame):
         # create child window
         win = Toplevel()
         self.settings_win = win
-        win.geometry('480x600')
+        win.geometry('480x740')
         win.title('Settings')
 
         var_cachedir = StringVar(value=self.config.cachedir)
+        var_cache_size = IntVar(value=self.config.cache_size)
 
         var_apikey = StringVar(value=self.config.apikey)
         var_restrict_scale = IntVar(value=self.config.restrict_scale)
+        var_upload_sources = IntVar(value=self.config.upload_sources)
 
         var_local_shell = StringVar(value=self.config.local_shell)
         var_local_downscale = IntVar(value=self.config.local_downscale)
@@ -138,6 +146,9 @@ class PhotoPolarAlign(Frame):
         var_local_scale_low = DoubleVar(value=self.config.local_scale_low)
         var_local_scale_hi = DoubleVar(value=self.config.local_scale_hi)
         var_local_xtra = StringVar(value=self.config.local_xtra)
+        var_local_cpulimit = IntVar(value=self.config.local_cpulimit)
+        var_local_timeout = IntVar(value=self.config.local_timeout)
+        var_local_engine = IntVar(value=self.config.local_engine)
 
         frm = LabelFrame(win, borderwidth=2, relief='ridge', text='Settings')
         frm.pack(side='top', ipadx=20, padx=20, fill='x')
@@ -145,6 +156,10 @@ class PhotoPolarAlign(Frame):
         nxt.grid(row=0, column=0, pady=4, sticky='w')
         nxt = Entry(frm, textvariable=var_cachedir)
         nxt.grid(row=0, column=1, pady=4)
+        nxt = Label(frm, text='Cache size (MB, 0 for no limit)')
+        nxt.grid(row=1, column=0, pady=4, sticky='w')
+        nxt = Entry(frm, textvariable=var_cache_size, width=8)
+        nxt.grid(row=1, column=1, pady=4, sticky='w')
 
         frm = LabelFrame(win, borderwidth=2, relief='ridge', text='nova.astrometry.net')
         frm.pack(side='top', ipadx=20, padx=20, fill='x')
@@ -156,6 +171,10 @@ class PhotoPolarAlign(Frame):
         nxt.grid(row=1, column=0, pady=4, sticky='w')
         nxt = Checkbutton(frm, var=var_restrict_scale)
         nxt.grid(row=1, column=1, pady=4)
+        nxt = Label(frm, text='Upload star list only')
+        nxt.grid(row=2, column=0, pady=4, sticky='w')
+        nxt = Checkbutton(frm, var=var_upload_sources)
+        nxt.grid(row=2, column=1, pady=4)
 
         frm = LabelFrame(win, borderwidth=2, relief='ridge', text='Local solver Configuration')
         frm.pack(side='top', ipadx=20, padx=20, fill='x')
@@ -214,14 +233,30 @@ class PhotoPolarAlign(Frame):
         nxt = Entry(frm, textvariable=var_local_xtra, width=40)
         nxt.grid(row=6, column=1, pady=4, sticky='we', columnspan=2)
 
+        nxt = Label(frm, text='cpu limit (s)')
+        nxt.grid(row=7, column=0, pady=4, sticky='w')
+        nxt = Entry(frm, textvariable=var_local_cpulimit, width=8)
+        nxt.grid(row=7, column=1, pady=4, sticky='w')
+        nxt = Label(frm, text='timeout (s)')
+        nxt.grid(row=8, column=0, pady=4, sticky='w')
+        nxt = Entry(frm, textvariable=var_local_timeout, width=8)
+        nxt.grid(row=8, column=1, pady=4, sticky='w')
+
+        nxt = Label(frm, text='keep indexes loaded')
+        nxt.grid(row=9, column=0, pady=4, sticky='w')
+        nxt = Checkbutton(frm, var=var_local_engine)
+        nxt.grid(row=9, column=1, pady=4, sticky='w')
+
         nxt = Button(frm, text='Read from AstroTortilla configuration',
                      command=self.slurpAT)
-        nxt.grid(row=7, column=0, pady=4, sticky='we', columnspan=3)
+        nxt.grid(row=10, column=0, pady=4, sticky='we', columnspan=3)
 
         def set_and_save_settings():
             self.config.cachedir = var_cachedir.get()
+            self.config.cache_size = var_cache_size.get()
             self.config.apikey = var_apikey.get()
             self.config.restrict_scale = var_restrict_scale.get()
+            self.config.upload_sources = var_upload_sources.get()
             self.config.local_shell = var_local_shell.get()
             self.config.local_downscale = var_local_downscale.get()
             self.config.local_configfile = var_local_configfile.get()
@@ -229,6 +264,9 @@ class PhotoPolarAlign(Frame):
             self.config.local_scale_low = var_local_scale_low.get()
             self.config.local_scale_hi = var_local_scale_hi.get()
             self.config.local_xtra = var_local_xtra.get()
+            self.config.local_cpulimit = var_local_cpulimit.get()
+            self.config.local_timeout = var_local_timeout.get()
+            self.config.local_engine = var_local_engine.get()
 
             self.settings_destroy()
 
@@ -259,7 +297,7 @@ class PhotoPolarAlign(Frame):
         User wants to select an image file
         '''
         import tkinter.filedialog
-        from os.path import splitext, dirname, basename
+        from os.path import dirname, basename
         options = {}
         options['filetypes'] = [('JPEG files', '.jpg .jpeg .JPG .JPEG'),
                                 ('all files', '.*')]
@@ -271,11 +309,10 @@ class PhotoPolarAlign(Frame):
         options['title'] = titles[hint]
         img = tkinter.filedialog.askopenfilename(**options)
         if img:
-            wcs = PPA_lib.get_cache_file_path(os.path.basename(splitext(img)[0] + '.wcs'))
-            if PPA_lib.happy_with(wcs, img):
-                self.update_solved_labels(hint, 'active')
-            else:
-                self.update_solved_labels(hint, 'disabled')
+            # unsolved until cache_job finds its solution
+            wcs = ''
+            self.update_solved_labels(hint, 'disabled')
+            self.executor.submit(self.cache_job, hint, img, self.scale)
             self.config.imgdir = dirname(img)
             if hint == 'v':
                 self.vimg_fn = img
@@ -304,35 +341,162 @@ class PhotoPolarAlign(Frame):
         else:
             self.wvar5.configure(text='--.--')
 
+    def post(self, func, *args):
+        '''
+        Has the main thread call func(*args); the way workers touch the window
+        '''
+        self.events.put((func, args))
+
+    def poll_events(self):
+        '''
+        Runs what the workers posted, every 100 ms
+        '''
+        while True:
+            try:
+                func, args = self.events.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception:
+                print(traceback.format_exc())
+        self.after(100, self.poll_events)
+
+    def start_job(self, title, func, *args):
+        '''
+        Runs func(cancel, *args) on a worker thread, listed in the Jobs frame
+        with its own Cancel button until it ends
+        cancel: the threading.Event set by that button
+        '''
+        self.job_count += 1
+        job_id = self.job_count
+        cancel = threading.Event()
+        row = Frame(self.wfrjobs)
+        row.pack(side='top', fill='x')
+        Label(row, anchor='w', text=title).pack(side='left')
+        button = Button(row, text='Cancel', command=lambda: self.cancel_job(job_id))
+        button.pack(side='right')
+        self.jobs[job_id] = (cancel, row, button)
+        self.executor.submit(self.run_job, job_id, func, cancel, *args)
+
+    def run_job(self, job_id, func, cancel, *args):
+        '''
+        A job, on its worker thread
+        '''
+        try:
+            func(cancel, *args)
+        except PPA_lib.SolveCancelled:
+            self.post(self.stat_bar, 'Cancelled')
+        except IOError:
+            self.post(self.stat_bar, "Couldn't open the image")
+        except Exception:
+            print(traceback.format_exc())
+            self.post(self.stat_bar, 'An error has occured. See console for more details.')
+        finally:
+            self.post(self.end_job, job_id)
+
+    def cancel_job(self, job_id):
+        '''
+        User pressed the Cancel button of a job
+        '''
+        if job_id in self.jobs:
+            cancel, row, button = self.jobs[job_id]
+            cancel.set()
+            button.configure(text='Cancelling...', state='disabled')
+
+    def end_job(self, job_id):
+        '''
+        Removes a finished job from the Jobs frame
+        '''
+        cancel, row, button = self.jobs.pop(job_id)
+        row.destroy()
+
+    def cancel_jobs(self):
+        '''
+        Stops every job, as the application closes
+        '''
+        for cancel, row, button in self.jobs.values():
+            cancel.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
     def solve(self, hint, solver):
         '''
-        Solve an image
+        Solve an image, on a worker thread
         '''
-        self.stat_bar('Solving image...')
+        from os.path import basename
         if hint != 'i' and self.vimg_fn == self.himg_fn:
             self.stat_bar(('Image filenames coincide - Check the Image filenames'))
             return
+        images = {'h': self.himg_fn, 'v': self.vimg_fn, 'i': self.iimg_fn}
+        image_path = images[hint]
+        self.stat_bar('Solving image...')
+        self.start_job('Solving %s (%s)' % (basename(image_path), solver), self.solve_job,
+                       hint, solver, image_path, self.scale, self.prior_solution(hint))
+
+    def solve_job(self, cancel, hint, solver, image_path, scale, prior):
+        '''
+        Solves an image; runs on a worker thread
+        '''
+        upload_percent = -1
+
+        def progress(sent, total):
+            nonlocal upload_percent
+            percent = 100 * sent // total
+            if percent != upload_percent:
+                upload_percent = percent
+                self.post(self.stat_bar, 'Uploading image... %d%% of %.1f MB' % (percent, total / 1e6))
+        wcs_fn = PPA_lib.plate_solve(self.config, image_path, solver, scale=scale, progress=progress,
+                                     prior=prior, cancel=cancel)
+        self.post(self.solved, hint, image_path, wcs_fn)
+
+    def cache_job(self, hint, image_path, scale):
+        '''
+        Looks for the solution of a newly selected image in the cache; runs on
+        a worker thread, as hashing the image takes a while
+        '''
         try:
-            match hint:
-                case 'h':
-                    image_path = self.himg_fn
-                case 'v':
-                    image_path = self.vimg_fn
-                case 'i':
-                    image_path = self.iimg_fn
-                case _:
-                    image_path = ""
-                    raise Exception('Invalid hint passed:', hint)
-
-            PPA_lib.plate_solve(self.config, image_path, solver, scale=self.scale)
-            self.update_solved_labels(hint, 'active')
-            PPA_lib.update_scale(self, hint)
-            self.stat_bar('Idle')
-        except IOError:
-            self.stat_bar(("Couldn't open the image"))
+            wcs_fn = PPA_lib.get_wcs_file_path(self.config, image_path, scale)
+        except IOError as err:
+            print(err)
+            self.post(self.stat_bar, "Couldn't open the image")
+            return
         except Exception:
             print(traceback.format_exc())
-            self.stat_bar("An error has occured. See console for more details.")
+            self.post(self.stat_bar, 'An error has occured. See console for more details.')
+            return
+        if os.path.exists(wcs_fn):
+            self.post(self.solved, hint, image_path, wcs_fn)
+
+    def solved(self, hint, image_path, wcs_fn):
+        '''
+        Takes in the solution of an image, unless another image has been
+        selected in the meantime
+        '''
+        images = {'h': self.himg_fn, 'v': self.vimg_fn, 'i': self.iimg_fn}
+        if images[hint] != image_path:
+            return
+        if hint == 'h':
+            self.hwcs_fn = wcs_fn
+        elif hint == 'v':
+            self.vwcs_fn = wcs_fn
+        elif hint == 'i':
+            self.iwcs_fn = wcs_fn
+        self.update_solved_labels(hint, 'active')
+        PPA_lib.update_scale(self, hint)
+        self.stat_bar('Idle')
+
+    def prior_solution(self, hint):
+        '''
+        The summary of another solved image of this session, for the solver to
+        search around, or None
+        '''
+        for other, wcs_fn in (('i', self.iwcs_fn), ('h', self.hwcs_fn), ('v', self.vwcs_fn)):
+            if other != hint and wcs_fn and os.path.exists(wcs_fn):
+                try:
+                    return PPA_lib.wcs_summary(self.config, wcs_fn)
+                except Exception:
+                    pass
+        return None
 
     def update_display(self, cpcrd, the_scale):
         '''
@@ -366,232 +530,194 @@ class PhotoPolarAlign(Frame):
         inst = inst + ('%02d:%02d:%02d' % PPA_lib.decdeg2dms(ddeg))
         self.wvar9.configure(text=inst)
 
-    def annotate_imp(self):
+
+    def annotated_crop(self, img, wcs, cpcrd, axis, the_scale, hemi):
         '''
-        Annotate the improvement image
+        Crops an image around the Celestial Pole, the RA axis and the
+        reference stars, and marks them on the crop
         '''
-        from PIL import Image
-        from astropy.time import Time
-        from astropy.coordinates import SkyCoord
-        from astropy.coordinates import FK5
-        from astropy.io import fits
-        from astropy import wcs
         import numpy
+        if hemi == 'N':
+            stars = [(wcs.wcs_world2pix(self.polaris, 1), 'White', 'a'),
+                     (wcs.wcs_world2pix(self.lam, 1), 'Orange', 'l')]
+        else:
+            stars = [(wcs.wcs_world2pix(self.sigma, 1), 'White', 's'),
+                     (wcs.wcs_world2pix(self.chi, 1), 'Orange', 'c'),
+                     (wcs.wcs_world2pix(self.red, 1), 'Red', '!')]
+        # the two brightest reference stars, with the pole and the axis, set the bounds
+        points = numpy.array([cpcrd[0], axis] + [crd[0] for crd, colour, name in stars[:2]])
+        left, bottom = points.min(axis=0).astype(int)
+        right, top = points.max(axis=0).astype(int)
+        margin = int(2500 / the_scale)
+        xl = max(1, left - margin)
+        xr = min(img.width, right + margin)
+        yt = min(img.height, top + margin)
+        yb = max(1, bottom - margin)
+        cropped = img.crop((xl, yb, xr, yt))
+        # draw on the crop only, in its own pixel coordinates
+        offset = numpy.array([xl, yb])
+        cpcircle(cpcrd - offset, cropped, the_scale)
+        cross([numpy.asarray(axis) - offset], cropped, 'Red')
+        for crd, colour, name in stars:
+            circle(crd - offset, cropped, colour, name)
+        return cropped
+
+    def show_annotation(self, cpcrd, the_scale, pyramid, title):
+        '''
+        Shows an annotated image, and the error it measures
+        '''
+        self.update_display(cpcrd, the_scale)
+        self.create_imgwin(pyramid, title)
+        self.stat_bar('Idle')
+
+    def show_axis(self, hemi, axis, cpcrd, the_scale, pyramid, title):
+        '''
+        Takes in the RA axis found by annotate_job, and shows its image
+        '''
+        self.hemi = hemi
+        self.axis = axis
+        self.show_annotation(cpcrd, the_scale, pyramid, title)
+
+    def annotate_imp(self):
+        '''
+        Annotate the improvement image, on a worker thread
+        '''
         if self.iimg_fn == self.himg_fn:
             self.stat_bar(('Image filenames coincide - Check the Image ' +
                            'filenames'))
             return
-        try:
-            imi = Image.open(self.iimg_fn)
-            # Load the FITS hdulist using astropy.io.fits
-            hdulisti = fits.open(self.iwcs_fn)
-            hdulisth = fits.open(self.hwcs_fn)
-        except IOError:
-            return
         axis = self.axis
         try:
             axis[0]
         except:
             self.stat_bar("don't know where Polar Axis is - Find Polar Axis")
             return
-        self.stat_bar('Annotating...')
-        headi = hdulisti[0].header
-        headh = hdulisth[0].header
-        wcsi = wcs.WCS(headi)
-        now = Time.now()
-        if self.hemi == 'N':
-            cp = SkyCoord(ra=0, dec=90, frame='fk5', unit='deg', equinox=now)
-        else:
-            cp = SkyCoord(ra=0, dec=-90, frame='fk5', unit='deg', equinox=now)
-        cpj2000 = cp.transform_to(FK5(equinox='J2000'))
-        cpskycrd = numpy.array([[cpj2000.ra.deg, cpj2000.dec.deg]],
+        self.start_job('Showing improvement', self.annotate_imp_job, self.iimg_fn,
+                       self.iwcs_fn, self.hwcs_fn, self.himg_fn, axis, self.hemi)
+
+    def annotate_imp_job(self, cancel, iimg_fn, iwcs_fn, hwcs_fn, himg_fn, axis, hemi):
+        '''
+        Annotates the improvement image; runs on a worker thread
+        '''
+        from PIL import Image
+        import numpy
+        try:
+            with PPA_trace.span('image open', image=iimg_fn):
+                imi = Image.open(iimg_fn)
+                imi.load()
+            # Summaries of the plate solutions, from the index when possible
+            summaryi = PPA_lib.wcs_summary(self.config, iwcs_fn)
+            summaryh = PPA_lib.wcs_summary(self.config, hwcs_fn)
+        except IOError as err:
+            print(err)
+            self.post(self.stat_bar, "Couldn't read the image or its plate solution. See console for more details.")
+            return
+        self.post(self.stat_bar, 'Annotating...')
+        wcsi = summaryi.wcs()
+        # CP now, in J2000 coordinates
+        cpskycrd = numpy.array([PPA_lib.celestial_pole_j2000(hemi == 'N')],
                                numpy.float64)
         cpcrdi = wcsi.wcs_world2pix(cpskycrd, 1)
-        scalei = PPA_lib.scale_from_header(headi)
-        widthi, heighti = PPA_lib.width_height_from_header(headi)
-        if PPA_lib.width_height_from_header(headi) != PPA_lib.width_height_from_header(headh):
-            self.stat_bar('Incompatible image dimensions...')
+        scalei = summaryi.scale
+        widthi, heighti = summaryi.width, summaryi.height
+        if (widthi, heighti) != (summaryh.width, summaryh.height):
+            self.post(self.stat_bar, 'Incompatible image dimensions...')
             return
-        if PPA_lib.parity_from_header(headi) == 0:
-            self.stat_bar('Wrong parity...')
+        if summaryi.parity == 0:
+            self.post(self.stat_bar, 'Wrong parity...')
             return
-        self.update_display(cpcrdi, scalei)
-        cpcircle(cpcrdi, imi, scalei)
-        cross([axis], imi, 'Red')
-        if self.hemi == 'N':
-            poli = wcsi.wcs_world2pix(self.polaris, 1)
-            lami = wcsi.wcs_world2pix(self.lam, 1)
-            circle(poli, imi, 'White', 'a')
-            circle(lami, imi, 'Orange', 'l')
-            left = int(min(cpcrdi[0][0], poli[0][0], lami[0][0], axis[0]))
-            right = int(max(cpcrdi[0][0], poli[0][0], lami[0][0], axis[0]))
-            bottom = int(min(cpcrdi[0][1], poli[0][1], lami[0][1], axis[1]))
-            top = int(max(cpcrdi[0][1], poli[0][1], lami[0][1], axis[1]))
-        else:
-            ori = wcsi.wcs_world2pix(self.chi, 1)
-            whi = wcsi.wcs_world2pix(self.sigma, 1)
-            rei = wcsi.wcs_world2pix(self.red, 1)
-            circle(whi, imi, 'White', 's')
-            circle(ori, imi, 'Orange', 'c')
-            circle(rei, imi, 'Red', '!')
-            left = int(min(cpcrdi[0][0], ori[0][0], whi[0][0], axis[0]))
-            right = int(max(cpcrdi[0][0], ori[0][0], whi[0][0], axis[0]))
-            bottom = int(min(cpcrdi[0][1], ori[0][1], whi[0][1], axis[1]))
-            top = int(max(cpcrdi[0][1], ori[0][1], whi[0][1], axis[1]))
-        margin = int(2500 / scalei)
-        xl = max(1, left - margin)
-        xr = min(widthi, right + margin)
-        yt = min(heighti, top + margin)
-        yb = max(1, bottom - margin)
-        croppedi = imi.crop((xl, yb, xr, yt))
-        croppedi.load()
-        crop_fn = PPA_lib.get_cache_file_path(os.path.basename(os.path.splitext(self.himg_fn)[0] + '_cropi.ppm'))
-        croppedi.save(crop_fn, 'PPM')
-        self.create_imgwin(crop_fn, self.iimg_fn)
-        self.stat_bar('Idle')
+        t_annotate = time.time()
+        croppedi = self.annotated_crop(imi, wcsi, cpcrdi, axis, scalei, hemi)
+        PPA_trace.complete('annotation', t_annotate, time.time(), image=iimg_fn)
+        pyramid = PPA_viewer.Pyramid(croppedi)
+        if not cancel.is_set():
+            self.post(self.show_annotation, cpcrdi, scalei, pyramid, iimg_fn)
 
     def annotate(self):
         '''
-        Find RA axis and Annotate the pair of horiz/vertical images
+        Find RA axis and Annotate the pair of horiz/vertical images, on a
+        worker thread
         '''
-        from PIL import Image
-        from astropy.time import Time
-        import scipy.optimize
-        from astropy.coordinates import SkyCoord
-        from astropy.coordinates import FK5
-        from astropy.io import fits
-        from astropy import wcs
-        import numpy
-
         if self.vimg_fn == self.himg_fn:
             self.stat_bar(('Image filenames coincide - Check the Image ' +
                            'filenames'))
             return
+        self.start_job('Finding polar axis', self.annotate_job, self.himg_fn, self.vwcs_fn, self.hwcs_fn)
+
+    def annotate_job(self, cancel, himg_fn, vwcs_fn, hwcs_fn):
+        '''
+        Finds the RA axis and annotates the horizontal image; runs on a worker
+        thread
+        '''
+        from PIL import Image
+        import numpy
+
         try:
-            imh = Image.open(self.himg_fn)
-            # Load the FITS hdulist using astropy.io.fits
-            hdulistv = fits.open(self.vwcs_fn)
-            hdulisth = fits.open(self.hwcs_fn)
-        except IOError:
+            with PPA_trace.span('image open', image=himg_fn):
+                imh = Image.open(himg_fn)
+                imh.load()
+            # Summaries of the plate solutions, from the index when possible
+            summaryv = PPA_lib.wcs_summary(self.config, vwcs_fn)
+            summaryh = PPA_lib.wcs_summary(self.config, hwcs_fn)
+        except IOError as err:
+            print(err)
+            self.post(self.stat_bar, "Couldn't read the image or its plate solution. See console for more details.")
             return
-        self.stat_bar('Finding RA axis...')
-        # Parse the WCS keywords in the primary HDU
-        headv = hdulistv[0].header
-        headh = hdulisth[0].header
-        wcsv = wcs.WCS(headv)
-        wcsh = wcs.WCS(headh)
-        decv = PPA_lib.dec_frm_header(headv)
-        dech = PPA_lib.dec_frm_header(headh)
+        self.post(self.stat_bar, 'Finding RA axis...')
+        wcsh = summaryh.wcs()
+        decv = summaryv.dec
+        dech = summaryh.dec
         if decv > 65 and dech > 65:
-            self.hemi = 'N'
+            hemi = 'N'
         elif decv < -65 and dech < -65:
-            self.hemi = 'S'
+            hemi = 'S'
         else:
-            self.stat_bar('Nowhere near (>25 deg) the Poles!')
+            self.post(self.stat_bar, 'Nowhere near (>25 deg) the Poles!')
             return
-        now = Time.now()
-        if self.hemi == 'N':
-            cp = SkyCoord(ra=0, dec=90, frame='fk5', unit='deg', equinox=now)
-        else:
-            cp = SkyCoord(ra=0, dec=-90, frame='fk5', unit='deg', equinox=now)
-
-        # CP now, in J2000 coordinates, precess
-        cpj2000 = cp.transform_to(FK5(equinox='J2000'))
-        # sky coordinates
-        cpskycrd = numpy.array([[cpj2000.ra.deg, cpj2000.dec.deg]],
+        # CP now, in J2000 coordinates, precessed offline
+        cpskycrd = numpy.array([PPA_lib.celestial_pole_j2000(hemi == 'N')],
                                numpy.float64)
         # pixel coordinates
         cpcrdh = wcsh.wcs_world2pix(cpskycrd, 1)
-        if self.hemi == 'N':
+        if hemi == 'N':
             print('Northern Celestial Pole', dech)
         else:
             print('Southern Celestial Pole', dech)
-        scaleh = PPA_lib.scale_from_header(headh)
-        widthh, heighth = PPA_lib.width_height_from_header(headh)
-        if PPA_lib.width_height_from_header(headh) != PPA_lib.width_height_from_header(headv):
-            self.stat_bar('Incompatible image dimensions...')
+        scaleh = summaryh.scale
+        widthh, heighth = summaryh.width, summaryh.height
+        if (widthh, heighth) != (summaryv.width, summaryv.height):
+            self.post(self.stat_bar, 'Incompatible image dimensions...')
             return
-        if PPA_lib.parity_from_header(headh) == 0 or PPA_lib.parity_from_header(headv) == 0:
-            self.stat_bar('Wrong parity...')
+        if summaryh.parity == 0 or summaryv.parity == 0:
+            self.post(self.stat_bar, 'Wrong parity...')
             return
 
-        def displacement(coords):
-            '''
-            the movement of a sky object in the two images
-            '''
-            pixcrd1 = numpy.array([coords], numpy.float64)
-            skycrd = wcsv.wcs_pix2world(pixcrd1, 1)
-            pixcrd2 = wcsh.wcs_world2pix(skycrd, 1)
-            return pixcrd2 - pixcrd1
-        axis = scipy.optimize.broyden1(displacement, [widthh/2, heighth/2])
-        self.axis = axis
-        self.update_display(cpcrdh, scaleh)
-        #
-        self.stat_bar('Annotating...')
-        cpcircle(cpcrdh, imh, scaleh)
-        cross([axis], imh, 'Red')
-        # add reference stars
-        if self.hemi == 'N':
-            polh = wcsh.wcs_world2pix(self.polaris, 1)
-            lamh = wcsh.wcs_world2pix(self.lam, 1)
-            circle(polh, imh, 'White', 'a')
-            circle(lamh, imh, 'Orange', 'l')
-            left = int(min(cpcrdh[0][0], polh[0][0], lamh[0][0], axis[0]))
-            right = int(max(cpcrdh[0][0], polh[0][0], lamh[0][0], axis[0]))
-            bottom = int(min(cpcrdh[0][1], polh[0][1], lamh[0][1], axis[1]))
-            top = int(max(cpcrdh[0][1], polh[0][1], lamh[0][1], axis[1]))
-        else:
-            orh = wcsh.wcs_world2pix(self.chi, 1)
-            whh = wcsh.wcs_world2pix(self.sigma, 1)
-            reh = wcsh.wcs_world2pix(self.red, 1)
-            circle(whh, imh, 'White', 's')
-            circle(orh, imh, 'Orange', 'c')
-            circle(reh, imh, 'Red', '!')
-            left = int(min(cpcrdh[0][0], orh[0][0], whh[0][0], axis[0]))
-            right = int(max(cpcrdh[0][0], orh[0][0], whh[0][0], axis[0]))
-            bottom = int(min(cpcrdh[0][1], orh[0][1], whh[0][1], axis[1]))
-            top = int(max(cpcrdh[0][1], orh[0][1], whh[0][1], axis[1]))
-        margin = int(2500 / scaleh)
-        xl = max(1, left - margin)
-        xr = min(widthh, right + margin)
-        yt = min(heighth, top + margin)
-        yb = max(1, bottom - margin)
-        croppedh = imh.crop((xl, yb, xr, yt))
-        croppedh.load()
-        crop_fn = PPA_lib.get_cache_file_path(os.path.basename(os.path.splitext(self.himg_fn)[0] + '_croph.ppm'))
-        croppedh.save(crop_fn, 'PPM')
-        self.create_imgwin(crop_fn, self.himg_fn)
-        self.stat_bar('Idle')
+        axis = PPA_lib.find_ra_axis([summaryv, summaryh])[0]
+        self.post(self.stat_bar, 'Annotating...')
+        t_annotate = time.time()
+        croppedh = self.annotated_crop(imh, wcsh, cpcrdh, axis, scaleh, hemi)
+        PPA_trace.complete('annotation', t_annotate, time.time(), image=himg_fn)
+        pyramid = PPA_viewer.Pyramid(croppedh)
+        if not cancel.is_set():
+            self.post(self.show_axis, hemi, axis, cpcrdh, scaleh, pyramid, himg_fn)
 
-    def create_imgwin(self, img_fn, title):
+    def create_imgwin(self, pyramid, title):
         '''
-        creates a window to display an image
+        creates a window to display an image, given as a PPA_viewer.Pyramid
         '''
         from os.path import basename
+        t_display = time.time()
         # create child window
-        img = PhotoImage(file=img_fn)
+        width, height = pyramid.size(0)
+        wwid = min(800, width)
+        whei = min(800, height)
         win = Toplevel()
-        wwid = min(800, img.width())
-        whei = min(800, img.height())
         win.geometry(('%dx%d' % (wwid + 28, whei + 28)))
         win.title(basename(title))
-        frame = Frame(win, bd=0)
-        frame.pack()
-        xscrollbar = Scrollbar(frame, orient='horizontal')
-        xscrollbar.pack(side='bottom', fill='x')
-        yscrollbar = Scrollbar(frame, orient='vertical')
-        yscrollbar.pack(side='right', fill='y')
-        canvas = Canvas(frame, bd=0, width=wwid, height=whei,
-                        scrollregion=(0, 0, img.width(), img.height()),
-                        xscrollcommand=xscrollbar.set,
-                        yscrollcommand=yscrollbar.set)
-        canvas.pack(side='top', fill='both', expand=1)
-        canvas.create_image(0, 0, image=img, anchor='nw')
-        xscrollbar.config(command=canvas.xview)
-        yscrollbar.config(command=canvas.yview)
-        frame.pack()
-        # next statement is important! creates reference to img
-        canvas.img = img
+        viewer = PPA_viewer.TiledViewer(win, pyramid, wwid, whei)
+        viewer.pack(side='top', fill='both', expand=1)
+        win.update_idletasks()
+        PPA_trace.complete('display', t_display, time.time(), image=title)
 
     def update_solved_labels(self, hint, sta):
         '''
@@ -612,7 +738,7 @@ class PhotoPolarAlign(Frame):
             widget.configure(state='disabled', bg='red',
                              activebackground='red',
                              highlightbackground='red')
-        widget.update()
+        widget.update_idletasks()
 
     def slurpAT(self):
         import tkinter.filedialog
@@ -791,6 +917,10 @@ class PhotoPolarAlign(Frame):
         nxt = Label(self.wfrst, anchor='w', text=self.stat_msg)
         nxt.pack(anchor='w')
         self.wstat = nxt
+        # #################################################################
+        nxt = LabelFrame(master, borderwidth=2, relief='ridge', text='Jobs')
+        nxt.pack(side='bottom', fill='x')
+        self.wfrjobs = nxt
 
     def __init__(self, master=None):
         import numpy
@@ -885,12 +1015,20 @@ class PhotoPolarAlign(Frame):
 
         self.wfrst = None
         self.wstat = None
+        self.wfrjobs = None
 
         self.myparent = None
 
         self.stat_msg = 'Idle'
+        # solves and annotations run on workers, which hand their results
+        # back to the main thread through this queue
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='ppa-worker')
+        self.events = queue.Queue()
+        self.jobs = {}  # job id -> (cancel event, row in the Jobs frame, its Cancel button)
+        self.job_count = 0
         Frame.__init__(self, master)
         self.create_widgets(master)
+        self.after(100, self.poll_events)
         # check local solver
 
         if self.config.local_shell is None or self.config.local_shell == '':
@@ -912,3 +1050,4 @@ ROOT = Tk()
 ROOT.geometry('440x470+300+300')
 APP = PhotoPolarAlign(master=ROOT)
 ROOT.mainloop()
+APP.cancel_jobs()
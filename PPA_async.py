@@ -0,0 +1,324 @@
+'''
+asyncio plate-solving engine
+
+    wcs_path = await PPA_async.solve(config, image_path, solver='nova', timeout=600)
+
+One event loop can drive many solves at once. nova requests go over a small
+asyncio HTTP/1.1 client that keeps its connections alive, and local solves
+run solve-field as asyncio subprocesses. Cancelling a solve, or hitting its
+timeout, drops its connection or kills its solve-field.
+'''
+import asyncio
+import os
+import ssl
+import threading
+import time
+import weakref
+from urllib.parse import quote, urlsplit
+
+import PPA_lib
+import PPA_trace
+from PPA_cache import get_wcs_cache, write_atomic
+from PPA_local import kill_process_tree
+from NovaClient import NovaClient, JobWaiter, RequestError, SessionExpired
+
+
+class AsyncNovaClient(NovaClient):
+    '''
+    nova.astrometry.net client for asyncio
+    '''
+
+    def __init__(self, apiurl=NovaClient.default_url, session_file=None):
+        super().__init__(apiurl, session_file)
+        self._idle = {}
+
+    async def _open(self, scheme, netloc):
+        host, _, port = netloc.partition(':')
+        if scheme == 'https':
+            conn = await asyncio.open_connection(host, int(port or 443), ssl=ssl.create_default_context())
+        else:
+            conn = await asyncio.open_connection(host, int(port or 80))
+        self._count('connections')
+        return conn
+
+    def close(self):
+        '''
+        closes the kept-alive connections
+        '''
+        for conns in self._idle.values():
+            for reader, writer in conns:
+                writer.close()
+        self._idle = {}
+
+    async def _send(self, writer, method, netloc, path, body, headers):
+        head = ['%s %s HTTP/1.1' % (method, path), 'Host: ' + netloc, 'Connection: keep-alive']
+        if isinstance(body, bytes):
+            headers['Content-Length'] = str(len(body))
+        head += ['%s: %s' % item for item in headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if isinstance(body, bytes):
+            writer.write(body)
+        elif body is not None:
+            for chunk in body:
+                writer.write(chunk)
+                await writer.drain()
+        await writer.drain()
+
+    async def _receive(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('server closed the connection')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b''.join(chunks)
+        elif 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        else:
+            data = await reader.read()
+            headers['connection'] = 'close'
+        return status, headers, data
+
+    async def _http(self, method, url, body=None, headers=None):
+        '''
+        sends one request over a kept-alive connection; returns (status, body)
+        '''
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        self._count('requests')
+        for attempt in range(2):
+            idle = self._idle.setdefault(key, [])
+            reused = attempt == 0 and len(idle) > 0
+            reader, writer = idle.pop() if reused else await self._open(*key)
+            try:
+                await self._send(writer, method, parts.netloc, path, body, dict(headers or {}))
+                status, resp_headers, data = await self._receive(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                # an idle kept-alive socket may have been closed by the server
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                # cancelled half way through a request, the connection is unusable
+                writer.close()
+                raise
+            if resp_headers.get('connection', '').lower() == 'close':
+                writer.close()
+            else:
+                idle.append((reader, writer))
+            return status, data
+
+    async def get_file(self, url):
+        status, data = await self._http('GET', url)
+        if status >= 400:
+            raise RequestError('HTTP error %d retrieving %s' % (status, url))
+        return data
+
+    async def send_request(self, service, args=None, file_args=None, progress=None):
+        url, data, headers = self._prepare_request(service, args, file_args, progress)
+        status, txt = await self._http('POST', url, body=data, headers=headers)
+        try:
+            return self._parse_response(service, status, txt)
+        except SessionExpired:
+            self._forget_session()
+            await self.login(self.apikey)
+            return await self.send_request(service, args, file_args, progress)
+
+    async def login(self, apikey):
+        apikey = apikey.strip()
+        if self._resume_session(apikey):
+            return
+        self._start_session(apikey, await self.send_request('login', {'apikey': apikey}))
+
+    async def upload(self, fne, progress=None, **kwargs):
+        args = self._get_upload_args(**kwargs)
+        return await self.send_request('upload', args, (os.path.basename(fne), fne), progress)
+
+    async def job_status(self, job_id, justdict=False):
+        result = await self.send_request('jobs/%s' % job_id)
+        return result if justdict else result.get('status')
+
+    async def sub_status(self, sub_id, justdict=False):
+        result = await self.send_request('submissions/%s' % sub_id)
+        return result if justdict else result.get('status')
+
+    async def myjobs(self):
+        result = await self.send_request('myjobs/')
+        return result['jobs']
+
+    async def jobs_by_tag(self, tag, exact):
+        exact_option = 'exact=yes' if exact else ''
+        return await self.send_request('jobs_by_tag?query=%s&%s' % (quote(tag.strip()), exact_option), {})
+
+
+# logged-in clients, per event loop, per (server, API key)
+_clients = weakref.WeakKeyDictionary()
+
+
+async def get_nova_client(config, server=None):
+    '''
+    A logged-in AsyncNovaClient shared by every solve on this event loop
+    '''
+    server = server or config.nova_server
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    key = (server, config.apikey)
+    if key not in clients:
+        async def login():
+            client = AsyncNovaClient(server, os.path.join(config.cachedir, 'nova_session.json'))
+            await client.login(config.apikey)
+            return client
+        clients[key] = asyncio.ensure_future(login())
+    try:
+        return await asyncio.shield(clients[key])
+    except RequestError:
+        clients.pop(key, None)
+        print("Couldn't log on to nova.astrometry.net - Check the API key")
+        raise
+
+
+async def wait_for_job(client, sub_id):
+    '''
+    Polls a submission with JobWaiter's adaptive intervals until its job ends
+    Returns (job_id, 'success' or 'failure')
+    '''
+    interval = JobWaiter.min_interval
+    job_id = None
+    added = time.time()
+    while True:
+        await asyncio.sleep(interval)
+        if job_id is None:
+            stat = await client.sub_status(sub_id, justdict=True) or {}
+            jobs = [j for j in stat.get('jobs', []) if j is not None]
+            if not jobs:
+                interval = min(interval * JobWaiter.backoff, JobWaiter.queued_max_interval)
+                continue
+            job_id = jobs[0]
+            started = time.time()
+            PPA_trace.complete('queue wait', added, started, subid=sub_id)
+            interval = JobWaiter.min_interval
+            continue
+        stat = await client.job_status(job_id, justdict=True) or {}
+        if stat.get('status', '') in ('success', 'failure'):
+            PPA_trace.complete('solve', started, time.time(), solver='nova', job=job_id, status=stat['status'])
+            return job_id, stat['status']
+        interval = min(interval * JobWaiter.backoff, JobWaiter.running_max_interval)
+
+
+async def nova_solve(config, filename, wcsfn, scale=None, progress=None, server=None, near=None):
+    '''
+    Plate solves one image on nova, writing its solution to wcsfn
+    '''
+    server = server or config.nova_server
+    client = await get_nova_client(config, server)
+    upload_fn, kwargs = await asyncio.to_thread(PPA_lib.nova_prepare_upload, config, filename, wcsfn, scale, near)
+    with PPA_trace.span('upload', file=os.path.basename(upload_fn), bytes=os.path.getsize(upload_fn)):
+        upres = await client.upload(upload_fn, progress=progress, **kwargs)
+    stat = upres['status'] if upres is not None else None
+    if stat != 'success':
+        raise RequestError('Upload failed: status %s' % stat)
+    job_id, status = await wait_for_job(client, upres['subid'])
+    if status != 'success':
+        raise PPA_lib.SolveError("nova couldn't solve '%s'" % filename)
+    with PPA_trace.span('wcs download', job=job_id):
+        txt = await client.get_file(server.replace('/api/', '/wcs_file/%i' % job_id))
+    write_atomic(wcsfn, txt)
+
+
+async def local_solve(config, filename, wcsfn, scale=None, near=None):
+    '''
+    Plate solves one image with solve-field, or on the resident
+    astrometry-engine if configured, writing its solution to wcsfn
+    '''
+    if config.local_engine == 1:
+        cancel = threading.Event()
+        try:
+            result = await asyncio.to_thread(PPA_lib.engine_solve, config, filename, wcsfn, scale, cancel, near)
+        except BaseException:
+            cancel.set()
+            raise
+        if result is not None:
+            if not result.solved:
+                raise PPA_lib.SolveError("astrometry-engine couldn't solve '%s': %s" % (filename, result.describe()))
+            return
+    cmd = PPA_lib.local_solve_command(config, filename, wcsfn, scale, near)
+    proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE,
+                                                 stderr=asyncio.subprocess.PIPE,
+                                                 start_new_session=(os.name == 'posix'))
+    try:
+        stdout, stderr = await proc.communicate()
+    except BaseException:
+        kill_process_tree(proc)
+        await proc.wait()
+        raise
+    if proc.returncode != 0 or not os.path.exists(wcsfn):
+        raise PPA_lib.SolveError("solve-field couldn't solve '%s' (exit status %s): %s"
+                                 % (filename, proc.returncode, stderr.decode(errors='replace').strip()))
+
+
+async def solve(config, image_path, solver='nova', scale=None, timeout=None, progress=None, prior=None):
+    '''
+    Plate solves an image, returning the path of its .wcs file
+    Raises asyncio.TimeoutError if it takes longer than timeout seconds
+    prior: the WcsSummary of an earlier image of the session, to search
+    around before falling back to a blind solve
+    '''
+    if not os.path.exists(image_path):
+        raise IOError(f"Image file '{image_path}' not found.")
+    wcsfn = await asyncio.to_thread(PPA_lib.get_wcs_file_path, config, image_path, scale)
+    cache = get_wcs_cache(config.cachedir)
+    if os.path.exists(wcsfn):
+        cache.use(wcsfn)
+        return wcsfn  # Already solved
+    os.makedirs(os.path.dirname(wcsfn), exist_ok=True)
+    if solver not in ('nova', 'local'):
+        raise ValueError('Unknown solver %r' % solver)
+    near = await asyncio.to_thread(PPA_lib.search_area, prior) if prior is not None else None
+
+    lock = cache.lock(wcsfn)
+
+    async def job():
+        nonlocal near
+        # one solve per key at a time, across threads and processes
+        while not lock.acquire(blocking=False):
+            await asyncio.sleep(lock.poll_interval)
+        try:
+            if os.path.exists(wcsfn):
+                return  # Solved while we waited
+            while True:
+                try:
+                    if solver == 'nova':
+                        scale_to_use = scale if config.restrict_scale == 1 else None
+                        await nova_solve(config, image_path, lock.part, scale_to_use, progress, near=near)
+                    else:
+                        await local_solve(config, image_path, lock.part, scale, near)
+                    break
+                except PPA_lib.SolveError:
+                    if near is None:
+                        raise
+                    print('No solution near the previous image for %s, trying a blind solve' % image_path)
+                    near = None
+            lock.publish()
+        finally:
+            lock.release()
+    await asyncio.wait_for(job(), timeout)
+    cache.use(wcsfn)
+    await asyncio.to_thread(PPA_lib.wcs_summary, config, wcsfn)  # index the new solution
+    await asyncio.to_thread(PPA_lib.trim_cache, config)
+    return wcsfn
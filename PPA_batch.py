@@ -0,0 +1,205 @@
+'''
+Batch alignment of many image sets from a manifest
+
+    PPA-cli.py batch night.csv --solver nova
+
+The manifest is a CSV file with a header row, or a JSON list of objects,
+giving for each set a name, a horizontal and a vertical image, and optionally
+further images rotated in RA only and improved images (both separated by ";"
+in CSV, lists in JSON). Relative paths are taken from the manifest's folder.
+
+Every image of every set is solved at once, up to the solve concurrency: the
+nova solves share one upload queue and polling loop, and local solves run on
+the solve-field worker pool (see PPA_lib.plate_solve_many). As soon as all the images of a set are solved, its
+RA axis and errors are computed on a process pool, and its result is
+appended to the results file (JSON lines). Sets already in that file with an
+"ok" status are skipped, so an interrupted batch picks up where it stopped.
+'''
+import concurrent.futures
+import csv
+import json
+import os
+import threading
+
+import PPA_lib
+
+_worker_config = None
+
+
+def read_manifest(path):
+    '''
+    Returns the image sets of a manifest: a list of dicts with name,
+    horizontal, vertical, rotated and improved (lists)
+    '''
+    folder = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='') as fle:
+        if path.lower().endswith('.json'):
+            rows = json.load(fle)
+        else:
+            rows = list(csv.DictReader(fle))
+    sets = []
+    names = set()
+    for number, row in enumerate(rows, 1):
+        row = {key.strip().lower(): value for key, value in row.items() if key}
+        if not row.get('horizontal') or not row.get('vertical'):
+            raise ValueError('%s: set %d needs a horizontal and a vertical image' % (path, number))
+        lists = {}
+        for column in ('rotated', 'improved'):
+            images = row.get(column) or []
+            if isinstance(images, str):
+                images = [image.strip() for image in images.split(';') if image.strip()]
+            lists[column] = [os.path.join(folder, image) for image in images]
+        name = str(row.get('name') or row['horizontal'])
+        if name in names:
+            raise ValueError('%s: set name %r is used twice' % (path, name))
+        names.add(name)
+        sets.append({'name': name,
+                     'horizontal': os.path.join(folder, row['horizontal']),
+                     'vertical': os.path.join(folder, row['vertical']),
+                     'rotated': lists['rotated'],
+                     'improved': lists['improved']})
+    return sets
+
+
+def finished_sets(results_path):
+    '''
+    The names of the sets the results file already has a good result for
+    '''
+    done = set()
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path) as fle:
+        for line in fle:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # cut short by an interruption
+            if result.get('status') == 'ok':
+                done.add(result['name'])
+    return done
+
+
+def _init_worker(config_file_path, cachedir):
+    global _worker_config
+    _worker_config = PPA_lib.PPAConfig(config_file_path)
+    _worker_config.cachedir = cachedir
+
+
+def measure_set(image_set, wcs_paths):
+    '''
+    Finds the RA axis of a solved set and the error of its improved images
+    (of the horizontal one if there are none); runs on the process pool
+    wcs_paths: image path -> .wcs path
+    '''
+    config = _worker_config
+    rotated = [image_set['vertical'], image_set['horizontal']] + image_set['rotated']
+    axis, uncertainty = PPA_lib.find_ra_axis([PPA_lib.wcs_summary(config, wcs_paths[image]) for image in rotated])
+    errors = []
+    for image in image_set['improved'] or [image_set['horizontal']]:
+        error = PPA_lib.find_error(axis, PPA_lib.wcs_summary(config, wcs_paths[image]))
+        errors.append({'image': image, 'right': float(error[0]), 'down': float(error[1])})
+    return {'axis': [float(axis[0]), float(axis[1])],
+            'axis_uncertainty': None if uncertainty is None else [float(value) for value in uncertainty],
+            'errors': errors}
+
+
+def images_of(image_set):
+    return [image_set['horizontal'], image_set['vertical']] + image_set['rotated'] + image_set['improved']
+
+
+def run_batch(config, solver, sets, results_path, processes=None, concurrency=8):
+    '''
+    Aligns every set not already in the results file, appending each result
+    as soon as it is known
+    processes: size of the process pool for the axis and error computations
+    (default: one per core)
+    concurrency: how many images are being solved at once
+    Returns the number of sets that failed
+    A frozen program calling this must call multiprocessing.freeze_support()
+    first thing, as PPA-cli.py does
+    '''
+    done = finished_sets(results_path)
+    todo = [image_set for image_set in sets if image_set['name'] not in done]
+    print('%d sets, %d already done' % (len(sets), len(sets) - len(todo)), flush=True)
+    if not todo:
+        return 0
+
+    failed = set()
+
+    def write(image_set, status, **fields):
+        result = dict(name=image_set['name'], status=status, **fields)
+        results.write(json.dumps(result) + '\n')
+        results.flush()
+        os.fsync(results.fileno())
+        if status == 'ok':
+            print('%s: %s' % (image_set['name'], ', '.join('right %(right).4f down %(down).4f deg' % error
+                                                           for error in result['errors'])), flush=True)
+        else:
+            failed.add(image_set['name'])
+            print('%s: %s' % (image_set['name'], result['message']), flush=True)
+
+    # image -> the sets using it, so that an image shared by sets is solved once
+    users = {}
+    for image_set in todo:
+        for image in images_of(image_set):
+            users.setdefault(image, []).append(image_set)
+    unsolved = {image_set['name']: set(images_of(image_set)) for image_set in todo}
+    wcs_paths = {}
+
+    results = open(results_path, 'a')
+    stop = threading.Event()  # ends the solves if the batch is interrupted
+    solvers = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ppa-solve')
+    measurers = concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                                       initargs=(config.cfgfn, config.cachedir))
+    try:
+        # one future per image, set as plate_solve_many solves it
+        solves = {concurrent.futures.Future(): image for image in users}
+        solves_of = {image: future for future, image in solves.items()}
+
+        def solve_all():
+            try:
+                for image, wcs_path, error in PPA_lib.plate_solve_many(config, {image: image for image in users}, solver,
+                                                                       cancel=stop, limit=concurrency):
+                    if error is None:
+                        solves_of[image].set_result(wcs_path)
+                    else:
+                        solves_of[image].set_exception(error)
+            except Exception as err:
+                for future in solves_of.values():
+                    if not future.done():
+                        future.set_exception(err)
+        solvers.submit(solve_all)
+        measures = {}
+        running = set(solves)
+        while running:
+            finished, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                if future in measures:
+                    image_set = measures.pop(future)
+                    try:
+                        write(image_set, 'ok', **future.result())
+                    except Exception as err:
+                        write(image_set, 'error', message=str(err))
+                    continue
+                image = solves.pop(future)
+                try:
+                    wcs_paths[image] = future.result()
+                except Exception as err:
+                    for image_set in users[image]:
+                        if image_set['name'] not in failed:
+                            write(image_set, 'error', message="couldn't solve %s: %s" % (image, err))
+                    continue
+                for image_set in users[image]:
+                    unsolved[image_set['name']].discard(image)
+                    if unsolved[image_set['name']] or image_set['name'] in failed:
+                        continue
+                    paths = {path: wcs_paths[path] for path in images_of(image_set)}
+                    measure = measurers.submit(measure_set, image_set, paths)
+                    measures[measure] = image_set
+                    running.add(measure)
+    finally:
+        stop.set()
+        solvers.shutdown(cancel_futures=True)
+        measurers.shutdown(cancel_futures=True)
+        results.close()
+    return len(failed)
@@ -0,0 +1,551 @@
+'''
+Content-addressed cache of plate solutions
+
+A solve is stored under a key made from a hash of the image content and the
+solve parameters, in a sharded layout:
+
+    <cachedir>/wcs/<first 2 hex digits of key>/<key>.wcs
+
+so the same picture is a cache hit however it is named or wherever it lives,
+and two different pictures that share a filename never collide.
+
+A SQLite index remembers the content hash of each image seen, by path and
+checked against its size and mtime, so an image is only hashed once. The same
+file holds a one-row summary of each solution (scale, parity, image size,
+CRVAL, CRPIX, CD matrix and SIP terms), so the solution can be used without
+parsing its FITS header again.
+
+A solution is only ever put in place whole, by renaming a finished file (see
+write_atomic and SolveLock.part), so a .wcs file that exists is complete. And
+only one solve of a key runs at a time: SolveLock makes the other threads, and
+other processes sharing the cache, wait for it and then use its solution.
+
+WcsCache.trim keeps the cache under a size cap, least recently used first:
+solve-field's side products and other derived files go before any solution,
+and the solutions this process has used are kept whatever their age. It only
+ever deletes files named after a key under wcs/, the cache directory being
+the user's choice, and takes a solution's lock file along with it. A
+solution's access time is its last use (set on every cache hit, as atime
+updates are often off), its modification time being left alone for the
+SummaryIndex.
+'''
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+# what the cache owns under wcs/<first 2 hex digits of key>/: solutions and
+# their lock files, solve-field's outputs (<key>.part.* while solving) and
+# write_atomic's temporary files
+_shard_re = re.compile(r'[0-9a-f]{2}$')
+_owned_re = re.compile(r'([0-9a-f]{64})(\.part)?(\.wcs|\.axy|\.xyls|-indx\.xyls|\.corr|\.match|\.rdls|\.solved'
+                       r'|\.new|-objs\.png|-indx\.png|-ngc\.png)(\.lock|\.\d+\.\d+\.tmp)?$')
+
+SUMMARY_FIELDS = ('scale', 'parity', 'width', 'height', 'ctype1', 'ctype2', 'lonpole',
+                  'crval1', 'crval2', 'crpix1', 'crpix2', 'cd1_1', 'cd1_2', 'cd2_1', 'cd2_2', 'sip')
+
+
+class WcsCache(object):
+    '''
+    Maps images to cached .wcs files
+    '''
+    index_name = 'wcs_summary.sqlite'  # shared with SummaryIndex
+    legacy_index_name = 'wcs_index.json'
+    block_size = 1024 * 1024
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.index_fn = os.path.join(cachedir, self.index_name)
+        self._lock = threading.Lock()
+        self._db = None
+        self._solving = {}  # .wcs path -> [the lock of the threads solving it, threads waiting on or holding it]
+        self.pinned = set()  # the .wcs files used by this process, never trimmed
+        self._trimmed = 0
+
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+            os.makedirs(self.cachedir, exist_ok=True)
+            self._db = sqlite3.connect(self.index_fn, timeout=10, check_same_thread=False)
+            with self._db as db:
+                db.execute('CREATE TABLE IF NOT EXISTS image_hash (path TEXT PRIMARY KEY, size INTEGER, '
+                           'mtime_ns INTEGER, digest TEXT)')
+            self._import_legacy_index()
+        return self._db
+
+    def _import_legacy_index(self):
+        # the JSON index of earlier versions, keyed by "path|size|mtime_ns"
+        legacy_fn = os.path.join(self.cachedir, self.legacy_index_name)
+        try:
+            with open(legacy_fn) as fle:
+                legacy = json.load(fle)
+        except (OSError, ValueError):
+            return
+        rows = []
+        for stamp, digest in legacy.items():
+            path, size, mtime_ns = stamp.rsplit('|', 2)
+            rows.append((path, int(size), int(mtime_ns), digest))
+        with self._db as db:
+            db.executemany('INSERT OR IGNORE INTO image_hash VALUES (?, ?, ?, ?)', rows)
+        os.remove(legacy_fn)
+
+    def image_hash(self, image_path):
+        '''
+        the content hash of an image, from the index when it has not changed
+        '''
+        import sqlite3
+        stat = os.stat(image_path)
+        path = os.path.abspath(image_path)
+        try:
+            with self._lock:
+                row = self._connect().execute('SELECT size, mtime_ns, digest FROM image_hash WHERE path = ?',
+                                              (path,)).fetchone()
+        except sqlite3.Error as err:
+            print('Could not read the WCS cache index:', err)
+            row = None
+        if row is not None and tuple(row[:2]) == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        sha = hashlib.sha256()
+        with open(image_path, 'rb') as fle:
+            while True:
+                block = fle.read(self.block_size)
+                if not block:
+                    break
+                sha.update(block)
+        digest = sha.hexdigest()
+        try:
+            with self._lock, self._connect() as db:
+                db.execute('INSERT OR REPLACE INTO image_hash VALUES (?, ?, ?, ?)',
+                           (path, stat.st_size, stat.st_mtime_ns, digest))
+        except sqlite3.Error as err:
+            print('Could not write the WCS cache index:', err)
+        return digest
+
+    def prune(self):
+        '''
+        forgets the hashes of images that no longer exist
+        '''
+        import sqlite3
+        try:
+            with self._lock:
+                paths = [row[0] for row in self._connect().execute('SELECT path FROM image_hash')]
+            gone = [(path,) for path in paths if not os.path.exists(path)]
+            if gone:
+                with self._lock, self._connect() as db:
+                    db.executemany('DELETE FROM image_hash WHERE path = ?', gone)
+        except sqlite3.Error as err:
+            print('Could not write the WCS cache index:', err)
+
+    def key(self, image_path, params=None):
+        '''
+        the cache key of an image solved with the given parameters
+        '''
+        digest = self.image_hash(image_path)
+        if params:
+            digest = hashlib.sha256((digest + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+        return digest
+
+    def path(self, key):
+        '''
+        where the .wcs file for a key lives
+        '''
+        return os.path.join(self.cachedir, 'wcs', key[:2], key + '.wcs')
+
+    def use(self, wcs_path):
+        '''
+        Records a use of a .wcs file: pins it for this session and makes it
+        the most recently used
+        '''
+        with self._lock:
+            self.pinned.add(os.path.abspath(wcs_path))
+        try:
+            stat = os.stat(wcs_path)
+            os.utime(wcs_path, ns=(time.time_ns(), stat.st_mtime_ns))
+        except OSError:
+            pass
+
+    def trim(self, max_bytes, grace=600, interval=0):
+        '''
+        Deletes the least recently used files of the cache until they take at
+        most max_bytes: derived files (solve-field side products, extracted
+        star lists, leftovers) first, then solutions, with their lock files.
+        Only the files named after a key under wcs/ are the cache's: anything
+        else in the cache directory is left alone. Pinned solutions, solves
+        under way and anything used in the last grace seconds are kept.
+        The hashes of images that no longer exist are forgotten too.
+        Does nothing if the last trim was less than interval seconds ago.
+        Returns the paths of the solutions deleted
+        '''
+        now = time.time()
+        with self._lock:
+            if now - self._trimmed < interval:
+                return []
+            self._trimmed = now
+            pinned = set(self.pinned)
+        self.prune()
+        if not max_bytes:
+            return []
+        wcsdir = os.path.join(os.path.abspath(self.cachedir), 'wcs')
+        try:
+            shards = [shard for shard in os.listdir(wcsdir) if _shard_re.match(shard)]
+        except OSError:
+            shards = []
+        total = 0
+        candidates = []  # (is a solution, last used, size, path)
+        locks = []  # (last used, .wcs path)
+        for shard in shards:
+            folder = os.path.join(wcsdir, shard)
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                continue
+            for name in names:
+                match = _owned_re.match(name)
+                if match is None or match.group(1)[:2] != shard:
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                used = max(stat.st_atime, stat.st_mtime)
+                key, part, suffix, extra = match.groups()
+                if extra == '.lock':
+                    if not part and suffix == '.wcs':
+                        locks.append((used, path[:-len(extra)]))
+                    continue
+                total += stat.st_size
+                if path in pinned or now - used < grace:
+                    continue
+                solution = suffix == '.wcs' and not part and not extra
+                candidates.append((solution, used, stat.st_size, path))
+        removed = []
+        deleted = freed = 0
+        for solution, used, size, path in sorted(candidates):
+            if total - freed <= max_bytes:
+                break
+            if solution:
+                if not self._evict(path):
+                    continue
+                removed.append(path)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+            deleted += 1
+            freed += size
+        # the lock files of keys that were never solved, or whose solution went
+        for used, path in locks:
+            if now - used >= grace and not os.path.exists(path):
+                self._evict(path)
+        if deleted:
+            print('Trimmed the cache to %.1f MB: %d solution(s) and %d other file(s) deleted'
+                  % ((total - freed) / 1e6, len(removed), deleted - len(removed)))
+        return removed
+
+    def _evict(self, wcs_path):
+        # deletes a solution and its lock file, unless it is being solved
+        lock = self.lock(wcs_path)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            try:
+                os.remove(wcs_path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                return False
+        finally:
+            lock.release(forget=True)
+        return True
+
+    def lock(self, wcs_path):
+        '''
+        A SolveLock for a .wcs file of this cache
+        '''
+        return SolveLock(self, wcs_path)
+
+    def _join_solve(self, wcs_path):
+        # the thread lock of a .wcs file, counted while a thread waits on or holds it
+        with self._lock:
+            entry = self._solving.setdefault(wcs_path, [threading.Lock(), 0])
+            entry[1] += 1
+        return entry
+
+    def _leave_solve(self, wcs_path, entry):
+        with self._lock:
+            entry[1] -= 1
+            if entry[1] == 0 and self._solving.get(wcs_path) is entry:
+                del self._solving[wcs_path]
+
+
+def write_atomic(path, data):
+    '''
+    Writes data (bytes) to path through a temporary file in the same folder,
+    so that path is either absent or complete
+    '''
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'wb') as fle:
+            fle.write(data)
+            fle.flush()
+            os.fsync(fle.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _lock_file(fle):
+    '''
+    Takes an exclusive OS lock on an open file without waiting; the OS drops
+    it if the process dies. Returns False if another process holds it.
+    '''
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            fle.seek(0)
+            msvcrt.locking(fle.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock_file(fle):
+    if os.name == 'nt':
+        import msvcrt
+        fle.seek(0)
+        msvcrt.locking(fle.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(fle.fileno(), fcntl.LOCK_UN)
+
+
+def _is_file(fle, path):
+    # whether an open file is still the one at path
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    fstat = os.fstat(fle.fileno())
+    return (stat.st_dev, stat.st_ino) == (fstat.st_dev, fstat.st_ino)
+
+
+class SolveLock(object):
+    '''
+    The right to solve into one .wcs file: a thread lock shared by the threads
+    of this process, and an OS lock on <wcs file>.lock for the other
+    processes using the cache
+    '''
+    poll_interval = 0.2
+
+    def __init__(self, cache, wcs_path):
+        self.cache = cache
+        self.wcs_path = wcs_path
+        self.lock_fn = wcs_path + '.lock'
+        self._entry = None
+        self._file = None
+
+    @property
+    def part(self):
+        '''
+        where the solver writes, to be renamed to the .wcs file once solved
+        '''
+        return os.path.splitext(self.wcs_path)[0] + '.part.wcs'
+
+    def _try_acquire(self):
+        entry = self.cache._join_solve(self.wcs_path)
+        if not entry[0].acquire(blocking=False):
+            self.cache._leave_solve(self.wcs_path, entry)
+            return False
+        while True:
+            try:
+                os.makedirs(os.path.dirname(self.lock_fn), exist_ok=True)
+                fle = open(self.lock_fn, 'a+b')
+            except OSError:
+                self._leave(entry)
+                raise
+            if not _lock_file(fle):
+                fle.close()
+                self._leave(entry)
+                return False
+            if _is_file(fle, self.lock_fn):
+                break
+            # deleted by a trim while we waited for it: lock the new one
+            _unlock_file(fle)
+            fle.close()
+        self._entry = entry
+        self._file = fle
+        self._discard_part()  # left by a process that died solving
+        return True
+
+    def _leave(self, entry):
+        entry[0].release()
+        self.cache._leave_solve(self.wcs_path, entry)
+
+    def _discard_part(self):
+        # the .part.wcs and whatever else solve-field wrote next to it
+        folder, name = os.path.split(os.path.splitext(self.part)[0])
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return
+        for fn in names:
+            if fn.startswith(name) and fn[len(name):len(name) + 1] in ('.', '-'):
+                try:
+                    os.remove(os.path.join(folder, fn))
+                except OSError:
+                    pass
+
+    def acquire(self, cancel=None, blocking=True):
+        '''
+        Waits for the lock, unless cancel (a threading.Event) is set first
+        Returns whether it was acquired
+        '''
+        waiting = False
+        while not self._try_acquire():
+            if not blocking or (cancel is not None and cancel.is_set()):
+                return False
+            if not waiting:
+                waiting = True
+                print('Waiting for the solve of %s already under way' % os.path.basename(self.wcs_path))
+            if cancel is not None:
+                cancel.wait(self.poll_interval)
+            else:
+                time.sleep(self.poll_interval)
+        return True
+
+    def release(self, forget=False):
+        '''
+        forget: also delete the lock file, the solution being evicted
+        '''
+        self._discard_part()  # solve-field's side products, or a failed or cancelled solve
+        if forget:
+            try:
+                os.remove(self.lock_fn)  # while locked, see _try_acquire
+            except OSError:
+                pass
+        _unlock_file(self._file)
+        self._file.close()
+        self._file = None
+        entry, self._entry = self._entry, None
+        self._leave(entry)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def publish(self):
+        '''
+        Puts the finished solution in place
+        '''
+        os.replace(self.part, self.wcs_path)
+
+
+class SummaryIndex(object):
+    '''
+    Summaries of .wcs files, keyed by path and checked against the file's
+    size and modification time
+    '''
+    index_name = 'wcs_summary.sqlite'
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.index_fn = os.path.join(cachedir, self.index_name)
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+            os.makedirs(self.cachedir, exist_ok=True)
+            self._db = sqlite3.connect(self.index_fn, timeout=10, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS summary (path TEXT PRIMARY KEY, size INTEGER, '
+                             'mtime_ns INTEGER, %s)' % ', '.join(SUMMARY_FIELDS))
+        return self._db
+
+    def get(self, wcs_path):
+        '''
+        the summary of a .wcs file as a dict, or None if it is not indexed or has changed
+        '''
+        import sqlite3
+        stat = os.stat(wcs_path)
+        try:
+            with self._lock:
+                row = self._connect().execute('SELECT size, mtime_ns, %s FROM summary WHERE path = ?'
+                                              % ', '.join(SUMMARY_FIELDS),
+                                              (os.path.abspath(wcs_path),)).fetchone()
+        except sqlite3.Error as err:
+            print('Could not read the WCS summary index:', err)
+            return None
+        if row is None or tuple(row[:2]) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        record = dict(zip(SUMMARY_FIELDS, row[2:]))
+        record['sip'] = json.loads(record['sip']) if record['sip'] else None
+        return record
+
+    def forget(self, wcs_paths):
+        '''
+        drops the summaries of deleted .wcs files
+        '''
+        import sqlite3
+        try:
+            with self._lock, self._connect() as db:
+                db.executemany('DELETE FROM summary WHERE path = ?', [(os.path.abspath(path),) for path in wcs_paths])
+        except sqlite3.Error as err:
+            print('Could not write the WCS summary index:', err)
+
+    def put(self, wcs_path, record):
+        '''
+        stores the summary of a .wcs file
+        '''
+        import sqlite3
+        stat = os.stat(wcs_path)
+        values = [record.get(field) for field in SUMMARY_FIELDS]
+        values[-1] = json.dumps(values[-1]) if values[-1] else None
+        try:
+            with self._lock, self._connect() as db:
+                db.execute('INSERT OR REPLACE INTO summary VALUES (?, ?, ?%s)' % (', ?' * len(SUMMARY_FIELDS)),
+                           [os.path.abspath(wcs_path), stat.st_size, stat.st_mtime_ns] + values)
+        except sqlite3.Error as err:
+            print('Could not write the WCS summary index:', err)
+
+
+_caches = {}
+_summaries = {}
+_caches_lock = threading.Lock()
+
+
+def get_wcs_cache(cachedir):
+    '''
+    The shared WcsCache for a cache directory
+    '''
+    with _caches_lock:
+        cache = _caches.get(cachedir)
+        if cache is None:
+            cache = _caches[cachedir] = WcsCache(cachedir)
+    return cache
+
+
+def get_summary_index(cachedir):
+    '''
+    The shared SummaryIndex for a cache directory
+    '''
+    with _caches_lock:
+        index = _summaries.get(cachedir)
+        if index is None:
+            index = _summaries[cachedir] = SummaryIndex(cachedir)
+    return index
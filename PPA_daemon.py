@@ -0,0 +1,265 @@
+'''
+Resident PPA daemon, answering JSON requests on localhost
+
+    PPA-cli.py daemon --solver nova                 # start it
+    PPA-cli.py --solver nova --horizontal h.jpg --vertical v.jpg --improved i.jpg --daemon
+
+The daemon keeps the parsed config, the nova session and its connections,
+numpy and the plate solutions it has read in memory, so a request for an
+error update costs the solve of the new image, if any, and milliseconds
+otherwise. Every request is a POST of a JSON object, and every answer a JSON
+object with a "status" of "success" or "error" (and a "message"):
+
+    /solve     {"image": path, "solver": "nova"}              -> {"wcs": path}
+    /axis      {"horizontal": path, "vertical": path, "rotated": [path, ...]}
+               -> {"axis": [x, y], "axis_uncertainty": [sx, sy] or null}
+    /error     {"horizontal": ..., "vertical": ..., "rotated": [...], "improved": path or null}
+               -> {"axis": ..., "error": [right, down], "move": "Right 00:12:03   Up 00:01:10"}
+    /status    {}                                             -> {"service": "PPA", "requests": n, ...}
+    /shutdown  {}
+
+Paths must be absolute, as the daemon's working folder is its own. "solver"
+defaults to the one the daemon was started with.
+
+It only listens on 127.0.0.1, and only answers the PPA command line tool or
+other programs of the same user: every request must carry the token the
+daemon writes, when it starts, to a file only that user can read
+("Authorization: Bearer <token>"), a Host of 127.0.0.1, localhost or [::1]
+with its port, no Origin, and POSTs a Content-Type of application/json. So a
+web page open in a browser can neither shut it down nor have it upload local
+files to nova.
+'''
+import hmac
+import http.server
+import json
+import os
+import secrets
+import threading
+import time
+
+import PPA_lib
+
+class PPADaemon(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    solve_limit = 8  # how many images of a request may be solving at once
+
+    def __init__(self, config, solver, port):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.config = config
+        self.solver = solver
+        self.token = secrets.token_urlsafe(32)
+        self.started = time.time()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._summaries = {}  # .wcs path -> (mtime_ns, WcsSummary)
+        self._axes = {}  # .wcs paths of the rotated images -> (RA axis pixel, uncertainty)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def write_token(self, token_fn):
+        '''
+        Writes the token to a file only this user can read
+        '''
+        os.makedirs(os.path.dirname(token_fn), exist_ok=True)
+        fd = os.open(token_fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fle:
+            fle.write(self.token)
+        os.chmod(token_fn, 0o600)
+
+    def refusal(self, headers, post):
+        '''
+        Why a request is refused, as (HTTP status, message), or None
+        '''
+        if headers.get('Origin') is not None:
+            return 403, 'requests from web pages are refused'
+        # names a page of another site can't be served from (DNS rebinding)
+        if headers.get('Host') not in ['%s:%d' % (host, self.server_address[1])
+                                       for host in ('127.0.0.1', 'localhost', '[::1]')]:
+            return 403, 'wrong Host'
+        if post and headers.get_content_type() != 'application/json':
+            return 415, 'the Content-Type must be application/json'
+        expected = ('Bearer ' + self.token).encode()
+        if not hmac.compare_digest(headers.get('Authorization', '').encode('latin-1', 'replace'), expected):
+            return 401, 'missing or wrong token'
+        return None
+
+    def warm_up(self):
+        '''
+        Does the imports and the nova login now rather than on the first request
+        '''
+        # what the requests need, loaded here rather than by the first one
+        import numpy  # noqa: F401 (a deliberate warm-up)
+        import PPA_wcs  # noqa: F401 (a deliberate warm-up)
+        PPA_lib.celestial_pole_j2000(True)
+        if self.solver == 'nova' and self.config.apikey:
+            try:
+                PPA_lib.get_nova_client(self.config)
+            except Exception as err:
+                print("Couldn't log on to nova yet: %s" % err)
+
+    def summary(self, wcs_path):
+        '''
+        The WcsSummary of a solution, kept in memory while its file is unchanged
+        '''
+        mtime = os.stat(wcs_path).st_mtime_ns
+        with self._lock:
+            known = self._summaries.get(wcs_path)
+        if known is not None and known[0] == mtime:
+            return known[1]
+        summary = PPA_lib.wcs_summary(self.config, wcs_path)
+        with self._lock:
+            self._summaries[wcs_path] = (mtime, summary)
+        return summary
+
+    def solve_set(self, images, solver=None):
+        '''
+        Solves the images of a set at once, the nova solves sharing one
+        polling loop: dict of hint -> image path
+        Returns dict of hint -> .wcs path
+        '''
+        for image in images.values():
+            if not os.path.isabs(image):
+                raise ValueError("'%s' is not an absolute path" % image)
+        # images already solved tell the others where to look
+        cached = [PPA_lib.get_wcs_file_path(self.config, image) for image in images.values() if os.path.exists(image)]
+        prior = next((self.summary(path) for path in cached if os.path.exists(path)), None)
+        wcs_paths = {}
+        for hint, wcs_path, error in PPA_lib.plate_solve_many(self.config, images, solver or self.solver, prior=prior,
+                                                              limit=self.solve_limit):
+            if error is not None:
+                raise error
+            wcs_paths[hint] = wcs_path
+        return wcs_paths
+
+    def axis(self, wcs_paths):
+        '''
+        The RA axis and its uncertainty from the solutions of the images
+        rotated about it, v and h first
+        '''
+        key = tuple(wcs_paths)
+        with self._lock:
+            found = self._axes.get(key)
+        if found is None:
+            found = PPA_lib.find_ra_axis([self.summary(path) for path in wcs_paths])
+            with self._lock:
+                self._axes[key] = found
+        axis, uncertainty = found
+        return {'axis': [float(axis[0]), float(axis[1])],
+                'axis_uncertainty': None if uncertainty is None else [float(value) for value in uncertainty]}
+
+    def rotated_set(self, request):
+        '''
+        The images of a request rotated about the RA axis, by hint
+        '''
+        images = {'v': request['vertical'], 'h': request['horizontal']}
+        for number, image in enumerate(request.get('rotated') or [], 1):
+            images['r%d' % number] = image
+        return images
+
+    # the operations, each taking the request's JSON object
+
+    def op_solve(self, request):
+        return {'wcs': self.solve_set({'image': request['image']}, request.get('solver'))['image']}
+
+    def op_axis(self, request):
+        wcs = self.solve_set(self.rotated_set(request), request.get('solver'))
+        return self.axis(list(wcs.values()))
+
+    def op_error(self, request):
+        images = self.rotated_set(request)
+        hints = list(images)
+        if request.get('improved'):
+            images['i'] = request['improved']
+        wcs = self.solve_set(images, request.get('solver'))
+        reply = self.axis([wcs[hint] for hint in hints])
+        error = PPA_lib.find_error(reply['axis'], self.summary(wcs.get('i', wcs['h'])))
+        reply.update(error=[float(error[0]), float(error[1])], move=PPA_lib.format_move(error))
+        return reply
+
+    def op_status(self, request):
+        return {'service': 'PPA', 'solver': self.solver, 'cachedir': self.config.cachedir,
+                'uptime': time.time() - self.started, 'requests': self.requests,
+                'solutions': len(self._summaries)}
+
+    def op_shutdown(self, request):
+        threading.Thread(target=self.shutdown, daemon=True).start()
+        return {}
+
+    def handle_request_json(self, operation, request):
+        with self._lock:
+            self.requests += 1
+        handler = getattr(self, 'op_' + operation, None)
+        if handler is None:
+            return 404, {'status': 'error', 'message': 'unknown operation %s' % operation}
+        t_start = time.time()
+        try:
+            reply = handler(request)
+        except KeyError as err:
+            return 400, {'status': 'error', 'message': 'missing %s' % err}
+        except Exception as err:
+            return 500, {'status': 'error', 'message': str(err) or type(err).__name__}
+        reply.update(status='success', seconds=time.time() - t_start)
+        return 200, reply
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, reply):
+        body = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _refuse(self, post):
+        refusal = self.server.refusal(self.headers, post)
+        if refusal is None:
+            return False
+        self.close_connection = True
+        self._reply(refusal[0], {'status': 'error', 'message': refusal[1]})
+        return True
+
+    def do_POST(self):
+        if self._refuse(True):
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            return self._reply(400, {'status': 'error', 'message': 'the request is not JSON'})
+        self._reply(*self.server.handle_request_json(self.path.strip('/'), request))
+
+    def do_GET(self):
+        if self._refuse(False):
+            return
+        if self.path.strip('/') == 'status':
+            return self._reply(*self.server.handle_request_json('status', {}))
+        self._reply(405, {'status': 'error', 'message': 'use POST'})
+
+
+def serve(config, token_fn, solver, port):
+    '''
+    Runs a daemon until it is shut down or interrupted
+    token_fn: where to write the token its clients must send
+    '''
+    daemon = PPADaemon(config, solver, port)
+    daemon.write_token(token_fn)
+    daemon.warm_up()
+    print('PPA daemon listening on %s, Ctrl-C to stop' % daemon.url, flush=True)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        try:
+            os.remove(token_fn)
+        except OSError:
+            pass
@@ -1,13 +1,23 @@
+import functools
 import os
-import sys
+import threading
+import time
 import platformdirs
-from urllib.request import urlopen
-from NovaClient import NovaClient
+from NovaClient import NovaClient, RequestError
+from PPA_cache import get_wcs_cache, get_summary_index, write_atomic
+import PPA_trace
 
 
-class RequestError(Exception):
+class SolveError(Exception):
     '''
-    An exception that happens when talking to the plate solver
+    An image could not be plate solved
+    '''
+    pass
+
+
+class SolveCancelled(SolveError):
+    '''
+    A plate solve was cancelled before it finished
     '''
     pass
 
@@ -18,6 +28,22 @@ def decdeg2dms(dd):
     return deg, mnt, sec
 
 
+def format_move(err):
+    '''
+    How to move the mount for an error from find_error, e.g. 'Right 00:12:03   Up 00:01:10'
+    '''
+    if err[0] > 0:
+        inst = 'Right '
+    else:
+        inst = 'Left '
+    inst = inst + ('%02d:%02d:%02d' % decdeg2dms(abs(err[0])))
+    if err[1] > 0:
+        inst = inst + '   Down '
+    else:
+        inst = inst + '   Up '
+    return inst + ('%02d:%02d:%02d' % decdeg2dms(abs(err[1])))
+
+
 class PPAConfig:
     def __init__(self, config_file_path_override=None):
         import configparser
@@ -32,11 +58,18 @@ class PPAConfig:
         self.local_scale_low: float = 0
         self.local_scale_hi: float = 0
         self.local_xtra: str = ''
+        self.local_cpulimit: int = 0
+        self.local_timeout: int = 0
+        self.local_workers: int = 0
+        self.local_engine: int = 0
 
         self.apikey: str = ''
         self.restrict_scale: int = 0
+        self.upload_sources: int = 0
+        self.nova_server: str = NovaClient.default_url
 
         self.cachedir: str = ''
+        self.cache_size: int = 1024
 
         try:
             self.apikey = self.config_original.get('nova', 'apikey')
@@ -57,6 +90,11 @@ class PPAConfig:
                 self.cachedir = get_cache_file_path()
         except Exception:
             self.cachedir = get_cache_file_path()
+        # ... and the size it may grow to, in MB (0 for no limit)
+        try:
+            self.cache_size = self.config_original.getint('file', 'cache size')
+        except Exception:
+            pass
 
         # ...geometry
         try:
@@ -71,6 +109,17 @@ class PPAConfig:
             print("Error reading 'restrict scale': " + str(e))
             self.restrict_scale = 0
 
+        # do we want to extract the stars ourselves and upload just their positions
+        try:
+            self.upload_sources = self.config_original.getint('nova', 'upload sources')
+        except Exception:
+            self.upload_sources = 0
+        # an astrometry.net API other than nova's (e.g. a self-hosted one)
+        try:
+            self.nova_server = self.config_original.get('nova', 'server') or NovaClient.default_url
+        except Exception:
+            pass
+
         try:
             self.local_shell = self.config_original.get('local', 'shell')
             self.local_downscale = self.config_original.getint('local', 'downscale')
@@ -85,13 +134,18 @@ class PPAConfig:
             #     print("Can't use local astrometry.net solver, check PATH")
         except Exception as e:
             print("Error loading local configs: " + str(e))
+        # solve-field CPU budget and wall-clock timeout in seconds, how many may run at once (0 for defaults),
+        # and whether to solve on a resident astrometry-engine
+        for option in ('cpulimit', 'timeout', 'workers', 'engine'):
+            try:
+                setattr(self, 'local_' + option, self.config_original.getint('local', option))
+            except Exception:
+                pass
 
 
 def scale_frm_wcs(fn):
-    from astropy.io import fits
-    hdu = fits.open(fn)
-    head = hdu[0].header
-    return scale_from_header(head)
+    from PPA_wcs import read_header
+    return scale_from_header(read_header(fn))
 
 
 def parity_from_header(head):
@@ -194,8 +248,28 @@ def get_cache_file_path(cache_file_name: str = "") -> str:
     return os.path.join(dir, cache_file_name)
 
 
-def get_wcs_file_path(config: PPAConfig, image_file_name: str):
-    return os.path.join(config.cachedir, os.path.basename(os.path.splitext(image_file_name)[0] + '.wcs'))
+def solve_params(config: PPAConfig, scale: float = None):
+    '''
+    The solve parameters that can change a solution, and so are part of its cache key
+    '''
+    if scale is not None and config.restrict_scale == 1:
+        return {'scale': round(scale, 2)}
+    return {}
+
+
+def get_wcs_file_path(config: PPAConfig, image_file_name: str, scale: float = None):
+    '''
+    The cached .wcs file for an image, keyed on its content and the solve parameters
+    A solution made before the scale was known does if there is none with it
+    '''
+    cache = get_wcs_cache(config.cachedir)
+    params = solve_params(config, scale)
+    wcs_path = cache.path(cache.key(image_file_name, params))
+    if params and not os.path.exists(wcs_path):
+        unscaled = cache.path(cache.key(image_file_name))
+        if os.path.exists(unscaled):
+            return unscaled
+    return wcs_path
 
 
 def write_config_file(ppa):
@@ -206,11 +280,15 @@ def write_config_file(ppa):
     if not ppa.config.config_original.has_section('nova'):
         ppa.config.config_original.add_section('nova')
     ppa.config.config_original.set('nova', 'apikey', str(ppa.config.apikey))
+    ppa.config.config_original.set('nova', 'upload sources', str(ppa.config.upload_sources))
+    if ppa.config.nova_server != NovaClient.default_url:
+        ppa.config.config_original.set('nova', 'server', str(ppa.config.nova_server))
     # the image directory
     if not ppa.config.config_original.has_section('file'):
         ppa.config.config_original.add_section('file')
     ppa.config.config_original.set('file', 'imgdir', str(ppa.config.imgdir))
     ppa.config.config_original.set('file', 'cachedir', str(ppa.config.cachedir))
+    ppa.config.config_original.set('file', 'cache size', str(ppa.config.cache_size))
     # the geometry
     # TODO: Stores the current location and size of window, likely to stay the same when reopening.
     # if not ppa.config.config_original.has_section('appearance'):
@@ -230,6 +308,10 @@ def write_config_file(ppa):
     ppa.config.config_original.set('local', 'scale_low', str(ppa.config.local_scale_low))
     ppa.config.config_original.set('local', 'scale_hi', str(ppa.config.local_scale_hi))
     ppa.config.config_original.set('local', 'xtra', str(ppa.config.local_xtra))
+    ppa.config.config_original.set('local', 'cpulimit', str(ppa.config.local_cpulimit))
+    ppa.config.config_original.set('local', 'timeout', str(ppa.config.local_timeout))
+    ppa.config.config_original.set('local', 'workers', str(ppa.config.local_workers))
+    ppa.config.config_original.set('local', 'engine', str(ppa.config.local_engine))
 
     with open(ppa.config.cfgfn, 'w') as cfgfile:
         ppa.config.config_original.write(cfgfile)
@@ -239,109 +321,377 @@ def write_config_file(ppa):
 def update_scale(ppa, hint):
     try:
         if hint == 'v':
-            ppa.scale = scale_frm_wcs(ppa.vwcs_fn)
+            ppa.scale = wcs_summary(ppa.config, ppa.vwcs_fn).scale
         elif hint == 'h':
-            ppa.scale = scale_frm_wcs(ppa.hwcs_fn)
+            ppa.scale = wcs_summary(ppa.config, ppa.hwcs_fn).scale
         elif hint == 'i':
-            ppa.scale = scale_frm_wcs(ppa.iwcs_fn)
+            ppa.scale = wcs_summary(ppa.config, ppa.iwcs_fn).scale
         ppa.havescale = True
     except Exception:
         ppa.config.havescale = False
         return
 
 
-def plate_solve(config: PPAConfig, image_path, solver, scale=None):
+def open_wcs(wcs_path):
     '''
-    Solve an image
+    Opens a .wcs file as an hdulist, without importing astropy
     '''
-    aimg = image_path
-    awcs = get_wcs_file_path(config, image_path)
-    if os.path.exists(awcs):
-        return  # Already solved
-    elif not os.path.exists(aimg):
-        raise IOError(f"Image file '{aimg}' not found.")
+    from PPA_wcs import open_wcs_file
+    return open_wcs_file(wcs_path)
 
-    open(aimg)  # Throw exception IOError if unable to open images
 
-    match solver:
-        case "nova":
-            scale_to_use = None
-            if scale is not None and config.restrict_scale == 1:
-                scale_to_use = scale
-            nova_img2wcs(config, aimg, awcs, scale_to_use)
+def summarize_header(head):
+    '''
+    The summary record of a plate-solution header, as stored in the SummaryIndex
+    '''
+    width, height = width_height_from_header(head)
+    record = {'scale': scale_from_header(head), 'parity': parity_from_header(head),
+              'width': width, 'height': height}
+    for key in ('CTYPE1', 'CTYPE2', 'LONPOLE', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2',
+                'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2'):
+        record[key.lower()] = head.get(key)
+    record['sip'] = {key: value for key, value in head.items()
+                     if key.split('_')[0] in ('A', 'B', 'AP', 'BP') and key != 'COMMENT'} or None
+    return record
+
+
+def wcs_summary(config: PPAConfig, wcs_path):
+    '''
+    The WcsSummary of a .wcs file, from the summary index when it is there,
+    otherwise from its header (adding it to the index)
+    '''
+    from PPA_wcs import WcsSummary, read_header
+    with PPA_trace.span('wcs summary', path=wcs_path) as sp:
+        index = get_summary_index(config.cachedir)
+        record = index.get(wcs_path)
+        sp.set(indexed=record is not None)
+        if record is None:
+            with PPA_trace.span('fits parse'):
+                record = summarize_header(read_header(wcs_path))
+            index.put(wcs_path, record)
+    return WcsSummary(wcs_path, record)
 
-        case "local":
-            local_img2wcs(config, aimg, awcs, scale)
 
+# How far beyond the previous field to look, in degrees: enough for the
+# mount adjustments made between frames
+SEARCH_MARGIN = 2.0
 
-def find_ra_axis_pix_coords(v_fits, h_fits):
+
+def search_area(summary):
     '''
-    Find RA axis based on 2 images rotated about axis
+    Where to look for the next image of a session: around the centre of an
+    earlier solution, within its field plus SEARCH_MARGIN, with its parity
+    Returns a dict of ra, dec, radius (degrees) and parity (0 normal,
+    1 flipped, None if unknown)
     '''
-    import scipy.optimize
-    from astropy import wcs
     import numpy
+    centre = numpy.array([[(summary.width + 1) / 2, (summary.height + 1) / 2]], numpy.float64)
+    ra, dec = summary.wcs().wcs_pix2world(centre, 1)[0]
+    half_diagonal = numpy.hypot(summary.width, summary.height) / 2 * summary.scale / 3600
+    record = summary.record
+    parity = None
+    if None not in (record['cd1_1'], record['cd1_2'], record['cd2_1'], record['cd2_2']):
+        # astrometry.net calls a positive CD determinant flipped
+        parity = int(record['cd1_1'] * record['cd2_2'] - record['cd1_2'] * record['cd2_1'] >= 0)
+    return {'ra': float(ra), 'dec': float(dec), 'radius': float(half_diagonal) + SEARCH_MARGIN,
+            'parity': parity}
+
+
+def plate_solve(config: PPAConfig, image_path, solver, scale=None, progress=None, prior=None, cancel=None):
+    '''
+    Solve an image, returning the path of its .wcs file
+    progress: called as progress(bytes_sent, total_bytes) while uploading to nova
+    prior: the WcsSummary of an earlier image of the session; the solver then
+    searches only around it, falling back to a blind solve if that fails
+    cancel: a threading.Event that stops the solve when set; SolveCancelled
+    is then raised
+    '''
+    with PPA_trace.span('plate solve', image=image_path, solver=solver) as sp:
+        aimg = image_path
+        if not os.path.exists(aimg):
+            raise IOError(f"Image file '{aimg}' not found.")
+        with PPA_trace.span('cache key'):
+            awcs = get_wcs_file_path(config, image_path, scale)
+        cache = get_wcs_cache(config.cachedir)
+        if os.path.exists(awcs):
+            sp.set(cached=True)
+            cache.use(awcs)
+            return awcs  # Already solved
+
+        open(aimg)  # Throw exception IOError if unable to open images
+        os.makedirs(os.path.dirname(awcs), exist_ok=True)
+        near = search_area(prior) if prior is not None else None
+
+        # one solve per key at a time, across threads and processes
+        lock = cache.lock(awcs)
+        with PPA_trace.span('solve lock wait'):
+            if not lock.acquire(cancel):
+                raise SolveCancelled("Solving '%s' was cancelled" % aimg)
+        try:
+            if os.path.exists(awcs):
+                sp.set(cached=True)
+                cache.use(awcs)
+                return awcs  # Solved while we waited
+            match solver:
+                case "nova":
+                    scale_to_use = None
+                    if scale is not None and config.restrict_scale == 1:
+                        scale_to_use = scale
+                    nova_img2wcs(config, aimg, lock.part, scale_to_use, progress, near=near, cancel=cancel)
+
+                case "local":
+                    local_img2wcs(config, aimg, lock.part, scale, cancel=cancel, near=near)
+            lock.publish()
+        finally:
+            lock.release()
+        cache.use(awcs)
+        wcs_summary(config, awcs)  # index the new solution
+    trim_cache(config)
+    return awcs
+
+
+def plate_solve_many(config: PPAConfig, images, solver, progress=None, prior=None, cancel=None, limit=None):
+    '''
+    Solves several images at once, as plate_solve does each: on nova, the
+    images not solved yet share one upload queue and polling loop
+    (nova_img2wcs_many); on the local solver, or for an image whose solve is
+    already under way elsewhere, plate_solve runs on a thread per image.
+    images: dict of name -> image path
+    progress: called as progress(image_path) for the upload progress callback
+    of each image sent to nova (see plate_solve), or None
+    limit: how many images may be solving at once (default: all of them)
+    Generator yielding (name, .wcs path, None) as each image is solved, and
+    (name, None, exception) for each image that could not be
+    '''
+    import concurrent.futures
+    cache = get_wcs_cache(config.cachedir)
+    others = dict(images)
+    batch = {}  # image path -> (names, .wcs path, SolveLock) of the images solved on nova together
+    if solver == 'nova':
+        for name, image_path in images.items():
+            if not os.path.exists(image_path):
+                continue  # left to plate_solve to report
+            if image_path in batch:
+                batch[image_path][0].append(name)
+                del others[name]
+                continue
+            with PPA_trace.span('cache key'):
+                awcs = get_wcs_file_path(config, image_path)
+            if os.path.exists(awcs):
+                continue  # a cache hit
+            lock = cache.lock(awcs)
+            if not lock.acquire(blocking=False):
+                continue  # plate_solve waits for it
+            if os.path.exists(awcs):
+                lock.release()  # solved since we looked
+                continue
+            batch[image_path] = ([name], awcs, lock)
+            del others[name]
+    if len(batch) == 1 and not others:
+        # a single solve, as plate_solve does it
+        (image_path, (names, awcs, lock)), = batch.items()
+        lock.release()
+        batch, others = {}, {name: image_path for name in names}
+
+    workers = max(1, min(len(others), limit or len(others)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ppa-solve') as executor:
+        futures = {executor.submit(plate_solve, config, image_path, solver, None,
+                                   progress and progress(image_path), prior, cancel): name
+                   for name, image_path in others.items()}
+        try:
+            if batch:
+                near = search_area(prior) if prior is not None else None
+                solves = [(image_path, lock.part, None, near, progress and progress(image_path))
+                          for image_path, (_, _, lock) in batch.items()]
+                try:
+                    for image_path, error in nova_img2wcs_many(config, solves, cancel=cancel, limit=limit):
+                        names, awcs, lock = batch.pop(image_path)
+                        try:
+                            if error is None:
+                                lock.publish()
+                        finally:
+                            lock.release()
+                        if error is None:
+                            cache.use(awcs)
+                            wcs_summary(config, awcs)  # index the new solution
+                        for name in names:
+                            yield name, None if error else awcs, error
+                except Exception as err:
+                    for image_path, (names, _, lock) in list(batch.items()):
+                        del batch[image_path]
+                        lock.release()
+                        for name in names:
+                            yield name, None, err
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as err:
+                    yield futures[future], None, err
+        finally:
+            for _, _, lock in batch.values():
+                lock.release()  # left solving when the caller stopped early
+    trim_cache(config)
+
+
+def trim_cache(config: PPAConfig, interval=60):
+    '''
+    Keeps the cache directory under config.cache_size MB, deleting the least
+    recently used files; at most once every interval seconds
+    '''
+    removed = get_wcs_cache(config.cachedir).trim(config.cache_size * 1024 * 1024, interval=interval)
+    if removed:
+        get_summary_index(config.cachedir).forget(removed)
 
-    # Parse the WCS keywords in the primary HDU
-    header_v = v_fits.header
-    header_h = h_fits.header
-    wcsv = wcs.WCS(header_v)  # TODO: This is the second FITSFixedWarning. Something about image isn't included with the fits file?
-    wcsh = wcs.WCS(header_h)
 
-    width_h, height_h = width_height_from_header(header_h)
-    if (width_h, height_h) != width_height_from_header(header_v):
+def solve_ra_axis_many(wcses, width, height, refine=True, tol=1e-6, max_iter=10, grid=5):
+    '''
+    Find the pixel showing the same point of the sky in any number of images
+    taken while rotating in RA only: the RA axis.
+    A grid x grid set of pixels of the first image is taken to the sky and
+    into every other image in one batch, an affine model is fitted to each of
+    those mappings in a single least squares call, and the fixed point they
+    share, (I - A_k) p = b_k for every k, is solved for by least squares.
+    Gauss-Newton steps then remove what the affine models missed (distortion).
+    Returns (axis pixel coords, its standard error in x and y (None with only
+    two images, which fix it exactly), Gauss-Newton iterations,
+    rms residual in pixels)
+    '''
+    import numpy
+    from PPA_wcs import world2pix_many
+
+    if len(wcses) < 2:
+        raise ValueError('Finding the RA axis needs at least 2 images')
+    first, others = wcses[0], wcses[1:]
+    gridx, gridy = numpy.meshgrid(numpy.linspace(1, width, grid), numpy.linspace(1, height, grid))
+    pix = numpy.column_stack([gridx.ravel(), gridy.ravel()])
+    mapped = world2pix_many(others, first.wcs_pix2world(pix, 1), 1)
+    design = numpy.column_stack([pix, numpy.ones(len(pix))])
+    # one pair of right-hand side columns per image
+    coef = numpy.linalg.lstsq(design, mapped.transpose(1, 0, 2).reshape(len(pix), -1), rcond=None)[0]
+    coef = coef.reshape(3, len(others), 2)
+    affine = coef[:2].transpose(1, 2, 0)
+    offset = coef[2].ravel()
+    jacobian = (affine - numpy.identity(2)).reshape(-1, 2)
+    axis = numpy.linalg.lstsq(-jacobian, offset, rcond=None)[0]
+
+    def displacement(coords):
+        '''
+        Where the sky at coords of the first image is in each other image,
+        less coords
+        '''
+        return (world2pix_many(others, first.wcs_pix2world(numpy.array([coords]), 1), 1)[:, 0] - coords).ravel()
+
+    residual = displacement(axis)
+    iterations = 0
+    # with two images the residual vanishes; with more, the steps do
+    while refine and iterations < max_iter and numpy.abs(residual).max() > tol:
+        step = numpy.linalg.lstsq(jacobian, residual, rcond=None)[0]
+        axis = axis - step
+        residual = displacement(axis)
+        iterations += 1
+        if numpy.hypot(*step) <= tol:
+            break
+    dof = len(residual) - 2
+    uncertainty = None
+    if dof > 0:
+        covariance = residual @ residual / dof * numpy.linalg.inv(jacobian.T @ jacobian)
+        uncertainty = numpy.sqrt(numpy.diag(covariance))
+    return axis, uncertainty, iterations, float(numpy.sqrt(residual @ residual / len(others)))
+
+
+def find_ra_axis(summaries):
+    '''
+    Find RA axis based on 2 or more images rotated about it, e.g. v and h
+    summaries: the WcsSummary of each solution
+    Returns (axis pixel coords, their standard error, or None from 2 images)
+    '''
+    width, height = summaries[0].width, summaries[0].height
+    if any((summary.width, summary.height) != (width, height) for summary in summaries):
         raise Exception("Incompatible image dimensions")
-        return
-    if parity_from_header(header_h) == 0 or parity_from_header(header_v) == 0:
-        print("Parity h: " + str(parity_from_header(header_h)))
-        print("Parity v: " + str(parity_from_header(header_v)))
+    if any(summary.parity == 0 for summary in summaries):
+        print("Parities: " + str([summary.parity for summary in summaries]))
         raise Exception("Wrong parity in images")  # Parity might be the mirroredness of the image?
-        return
 
-    def displacement(coords):  # Is the point in the sky at this pixel coordinate in the same pixel coordinate in the other image? Return difference
-        '''
-        The difference in pixel coordinates from the horiz-vert images
-        '''
-        pixcrd1 = numpy.array([coords], numpy.float64)
-        skycrd = wcsv.wcs_pix2world(pixcrd1, 1)
-        pixcrd2 = wcsh.wcs_world2pix(skycrd, 1)
-        return pixcrd2 - pixcrd1
-    # Finding the point in both images that represent the same point in the sky.
-    ra_axis_pix_coords = scipy.optimize.broyden1(displacement, [width_h / 2, height_h / 2])  # Start with initial guess of middle of the image, and keep testing until we get closer and closer to the actual point that is the same in both.
-    # ra_axis_sky_coords = wcsv.wcs_pix2world(numpy.array([ra_axis_pix_coords], numpy.float64), 1)
+    # Finding the point in all images that represent the same point in the sky.
+    with PPA_trace.span('axis solve', images=len(summaries)) as sp:
+        axis, uncertainty, iterations, residual = solve_ra_axis_many([summary.wcs() for summary in summaries],
+                                                                     width, height)
+        sp.set(iterations=iterations, residual=residual)
+    print('RA axis found from %d images after %d refinement iterations, residual %.2g pixels'
+          % (len(summaries), iterations, residual))
+    if uncertainty is not None:
+        print('RA axis uncertainty %.2f, %.2f pixels' % tuple(uncertainty))
+    return axis, uncertainty
+
+
+def find_ra_axis_pix_coords(summary_v, summary_h):
+    '''
+    Find RA axis based on 2 images rotated about axis
+    summary_v, summary_h: the WcsSummary of each solution
+    '''
+    return find_ra_axis([summary_v, summary_h])[0]
+
 
-    return ra_axis_pix_coords
+# J2000.0 (2000-01-01 12:00 TT) as a POSIX timestamp, and TT - UTC, in seconds
+J2000_TIMESTAMP = 946727935.816
+TT_MINUS_UTC = 69.184
+
+
+def celestial_poles_j2000(north, timestamps):
+    '''
+    The J2000 coordinates of the celestial pole of date at each of the given
+    POSIX timestamps, using the IAU 2006 precession angles (no network or
+    IERS tables needed). The pole of date is the third row of the precession
+    matrix R3(-z) R2(theta) R3(-zeta).
+    Returns arrays of RA and Dec in degrees
+    '''
+    import numpy
+    t = (numpy.asarray(timestamps, numpy.float64) + TT_MINUS_UTC - J2000_TIMESTAMP) / (86400.0 * 36525.0)
+    zeta = (2.650545 + t * (2306.083227 + t * (0.2988499 + t * (0.01801828 + t * (-0.000005971 + t * -0.0000003173))))) / 3600.0
+    theta = (t * (2004.191903 + t * (-0.4294934 + t * (-0.04182264 + t * (-0.000007089 + t * -0.0000001274))))) / 3600.0
+    zeta, theta = numpy.radians(zeta), numpy.radians(theta)
+    sign = 1.0 if north else -1.0
+    x = sign * numpy.cos(zeta) * numpy.sin(theta)
+    y = -sign * numpy.sin(zeta) * numpy.sin(theta)
+    z = sign * numpy.cos(theta)
+    return numpy.mod(numpy.degrees(numpy.arctan2(y, x)), 360.0), numpy.degrees(numpy.arcsin(z))
+
+
+@functools.lru_cache(maxsize=16)
+def _celestial_pole_for_day(north, day):
+    ra, dec = celestial_poles_j2000(north, (day + 0.5) * 86400.0)
+    return float(ra), float(dec)
+
+
+def celestial_pole_j2000(north, timestamp=None):
+    '''
+    The J2000 coordinates (RA, Dec in degrees) of today's celestial pole,
+    memoized per day: the pole moves about 0.05 arcseconds a day
+    '''
+    if timestamp is None:
+        timestamp = time.time()
+    with PPA_trace.span('pole precession'):
+        return _celestial_pole_for_day(bool(north), int(timestamp // 86400))
 
 
 # hdulist_best: The best horizontal image, whether it's the first h or the recent i
-def find_error(axis, hdulist_best):
+def find_error(axis, summary_best):
     '''
     Annotate the improvement image
+    summary_best: the WcsSummary of the latest solution
     '''
-    from astropy.time import Time
-    from astropy.coordinates import SkyCoord
-    from astropy.coordinates import FK5
-    from astropy import wcs
     import numpy
 
-    # Parse the WCS keywords in the primary HDU
-    header_best = hdulist_best[0].header
+    dec_best = summary_best.dec
 
-    dec_best = dec_frm_header(header_best)
-
-    now = Time.now()
     if dec_best > 65:
-        cp = SkyCoord(ra=0, dec=90, frame='fk5', unit='deg', equinox=now)
+        cp_sky_coords = numpy.array([celestial_pole_j2000(True)], numpy.float64)
     elif dec_best < -65:
-        cp = SkyCoord(ra=0, dec=-90, frame='fk5', unit='deg', equinox=now)
+        cp_sky_coords = numpy.array([celestial_pole_j2000(False)], numpy.float64)
     else:
         raise Exception("Nowhere near Celestial Pole. Must be <25 degrees")
 
-    cpj2000 = cp.transform_to(FK5(equinox='J2000'))
-    cp_sky_coords = numpy.array([[cpj2000.ra.deg, cpj2000.dec.deg]], numpy.float64)
-
-    header_best = hdulist_best[0].header
-    wcs_best = wcs.WCS(header_best)
+    wcs_best = summary_best.wcs()
 
     cp_pixcoord_rel_best = wcs_best.wcs_world2pix(cp_sky_coords, 1)[0]
     cp_x = cp_pixcoord_rel_best[0]
@@ -350,284 +700,319 @@ def find_error(axis, hdulist_best):
     axis_x = axis[0]  # Pixel coords
     axis_y = axis[1]
 
-    scale_best = scale_from_header(header_best)
+    scale_best = summary_best.scale
     error = [(cp_x - axis_x) * scale_best / 3600, (cp_y - axis_y) * scale_best / 3600]
     return error
 
 
-def local_img2wcs(config: PPAConfig, filename, wcsfn, scale: float = None):
-    import os
+def local_solve_command(config: PPAConfig, filename, wcsfn, scale: float = None, near=None, augment=None):
+    '''
+    The shell command that runs Astrometry.net's "solve-field" on an image,
+    writing its solution to wcsfn
+    near: a search_area() to restrict the solve to
+    augment: (width, height) when filename is an xylist, to only write the
+    augmented xylist (.axy) for astrometry-engine instead of solving
+    '''
+    cmd = 'solve-field -b ' + config.local_configfile
+    if scale is not None and config.restrict_scale == 1:
+        up_lim = scale * 1.05
+        lo_lim = scale * 0.95
+        cmd = cmd + (' -u app -L %.2f -H %.2f ' % (lo_lim, up_lim))
+    else:
+        cmd = cmd + ' -u ' + config.local_scale_units
+        cmd = cmd + (' -L %.2f' % config.local_scale_low)
+        cmd = cmd + (' -H %.2f' % config.local_scale_hi)
+    if config.local_downscale != 1 and augment is None:
+        cmd = cmd + (' -z %d' % config.local_downscale)
+    if config.local_cpulimit:
+        cmd = cmd + (' --cpulimit %d' % config.local_cpulimit)
+    if near is not None:
+        cmd = cmd + (' --ra %.6f --dec %.6f --radius %.3f' % (near['ra'], near['dec'], near['radius']))
+        if near['parity'] is not None:
+            cmd = cmd + (' --parity %s' % ('neg' if near['parity'] else 'pos'))
+    if augment is not None:
+        cmd = cmd + (' --just-augment --width %d --height %d' % augment)
+    cmd = cmd + ' ' + config.local_xtra
+    cmd = cmd + ' -O '
+    cmd = cmd + ' -D ' + os.path.dirname(wcsfn)  # Output files to specified cache directory
+    cmd = cmd + ' -o ' + os.path.splitext(os.path.basename(wcsfn))[0]  # named after the cache key
+    cmd = cmd + ' \\"%s\\"'
+    template = ((config.local_shell % cmd))
+    # print template
+    return (template % filename)
+
+
+_local_pool = None
+_local_pool_lock = threading.Lock()
+
+
+def get_local_pool(config: PPAConfig):
+    '''
+    The shared pool of solve-field workers
+    '''
+    global _local_pool
+    from PPA_local import LocalSolverPool
+    with _local_pool_lock:
+        if _local_pool is None:
+            _local_pool = LocalSolverPool(config.local_workers or None, config.local_timeout or None)
+        _local_pool.timeout = config.local_timeout or None
+    return _local_pool
+
+
+_local_engine = None
+
+
+def get_local_engine(config: PPAConfig):
+    '''
+    The shared resident astrometry-engine, started on first use
+    '''
+    global _local_engine
+    import atexit
+    from PPA_local import LocalEngine
+    with _local_pool_lock:
+        if _local_engine is None:
+            cmd = 'astrometry-engine --files-on-stdin'
+            if config.local_configfile:
+                cmd = cmd + ' -c ' + config.local_configfile
+            _local_engine = LocalEngine(config.local_shell % cmd, config.local_timeout or None)
+            atexit.register(_local_engine.close)
+        _local_engine.timeout = config.local_timeout or None
+    return _local_engine
+
+
+def engine_solve(config: PPAConfig, filename, wcsfn, scale: float = None, cancel=None, near=None):
+    '''
+    Plate solves one image on the resident astrometry-engine: extracts its
+    stars, has solve-field write the augmented xylist without loading any
+    index, and hands that to the engine
+    Returns a LocalSolveResult, or None if the image has too few stars
+    '''
+    from PPA_stars import image_to_xylist
+    xylist_fn = os.path.splitext(wcsfn)[0] + '.xyls'
+    with PPA_trace.span('star extraction'):
+        size = image_to_xylist(filename, xylist_fn)
+    if size is None:
+        return None
+    cmd = local_solve_command(config, xylist_fn, wcsfn, scale, near, augment=size)
+    print(cmd)
+    with PPA_trace.span('augment'):
+        result = get_local_pool(config).submit(cmd, filename, wcsfn, cancel).result()
+    axy = os.path.splitext(wcsfn)[0] + '.axy'
+    if result.returncode != 0 or not os.path.exists(axy):
+        return result
+    with PPA_trace.span('solve', solver='astrometry-engine', hinted=near is not None) as sp:
+        result = get_local_engine(config).solve(axy, filename, wcsfn, cancel)
+        sp.set(solved=result.solved)
+    return result
+
+
+def local_img2wcs(config: PPAConfig, filename, wcsfn, scale: float = None, cancel=None, near=None):
+    '''
+    Plate solves one image with solve-field on the local worker pool, or on
+    the resident astrometry-engine if configured
+    cancel: a threading.Event that kills the solve when set
+    near: a search_area() to try first, before a blind solve
+    '''
+    print('___________________________________________________________')
+    result = None
+    if config.local_engine == 1:
+        result = engine_solve(config, filename, wcsfn, scale, cancel, near)
+        if result is None:
+            print('Too few stars found for astrometry-engine, running solve-field')
+    if result is None:
+        # Run Astrometry.net package "solve-field" program to plate solve locally
+        cmd = local_solve_command(config, filename, wcsfn, scale, near)
+        print(cmd)
+        with PPA_trace.span('solve', solver='solve-field', hinted=near is not None) as sp:
+            result = get_local_pool(config).submit(cmd, filename, wcsfn, cancel).result()
+            sp.set(solved=result.solved)
+    print(result.stdout)
+    print('___________________________________________________________')
+    print('local solve time ' + str(result.elapsed))
+    print('___________________________________________________________')
+    if near is not None and not result.solved and not result.cancelled:
+        print('No solution near the previous image (%s), trying a blind solve' % result.describe())
+        return local_img2wcs(config, filename, wcsfn, scale, cancel)
+    if result.cancelled:
+        raise SolveCancelled("Solving '%s' was cancelled" % filename)
+    if not result.solved:
+        raise SolveError("solve-field couldn't solve '%s': %s" % (filename, result.describe()))
+
+
+_nova_clients = {}
+_nova_clients_lock = threading.Lock()
+
+
+def get_nova_client(config: PPAConfig, server=None):
+    '''
+    Returns a logged-in NovaClient shared by every solve with the same server and
+    API key, so one session and its kept-alive connections serve a whole run
+    server: the API URL, by default the configured one
+    '''
+    server = server or config.nova_server
+    key = (server, config.apikey)
+    with _nova_clients_lock:
+        client = _nova_clients.get(key)
+        if client is None:
+            client = NovaClient(apiurl=server,
+                                session_file=os.path.join(config.cachedir, 'nova_session.json'))
+            try:
+                client.login(config.apikey)
+            except RequestError as e:
+                print("Couldn't log on to nova.astrometry.net - Check the API key")
+                raise e
+            _nova_clients[key] = client
+    return client
+
+
+def nova_upload_kwargs(config: PPAConfig, scale: float = None, near=None):
+    '''
+    The nova upload options for an image
+    near: a search_area() to restrict the solve to
+    '''
+    kwargs = dict()
+    if config.restrict_scale == 1 and scale is not None:
+        kwargs.update(scale_units='arcsecperpix',
+                      scale_est=('%.2f' % scale),
+                      scale_err=5,
+                      scale_type='ev')
+    if near is not None:
+        kwargs.update(center_ra=near['ra'], center_dec=near['dec'], radius=near['radius'])
+        if near['parity'] is not None:
+            kwargs.update(parity=near['parity'])
+    return kwargs
+
+
+def nova_source_list(filename, wcsfn):
+    '''
+    Extracts the stars of an image into an xylist next to its .wcs file, so nova
+    can be sent that instead of the image
+    Returns (file to upload, (width, height)), or (filename, None) to fall back
+    to uploading the image itself
+    '''
+    from PPA_stars import image_to_xylist
+    xylist_fn = os.path.splitext(wcsfn)[0] + '.xyls'
+    try:
+        with PPA_trace.span('star extraction'):
+            size = image_to_xylist(filename, xylist_fn)
+    except Exception as e:
+        print('Star extraction failed, uploading the image instead:', e)
+        return filename, None
+    if size is None:
+        print('Too few stars found, uploading the image instead')
+        return filename, None
+    return xylist_fn, size
+
+
+def nova_prepare_upload(config: PPAConfig, filename, wcsfn, scale: float = None, near=None):
+    '''
+    What to upload to nova for an image, and with which options
+    Returns (file to upload, upload kwargs)
+    '''
+    kwargs = nova_upload_kwargs(config, scale, near)
+    upload_fn = filename
+    if config.upload_sources == 1:
+        upload_fn, size = nova_source_list(filename, wcsfn)
+        if size is not None:
+            kwargs.update(image_width=size[0], image_height=size[1])
+    return upload_fn, kwargs
+
+
+def nova_submit(client: NovaClient, filename, kwargs, progress=None):
+    '''
+    Uploads one image and returns its submission id
+    '''
+    print('with estimated scale', kwargs.get('scale_est'))
+    if 'center_ra' in kwargs:
+        print('near RA %(center_ra).3f Dec %(center_dec).3f, radius %(radius).2f deg' % kwargs)
+    with PPA_trace.span('upload', file=os.path.basename(filename), bytes=os.path.getsize(filename)):
+        upres = client.upload(filename, progress=progress, **kwargs)
+    stat = upres['status'] if upres is not None else None
+    if stat != 'success':
+        print(upres)
+        raise RequestError('Upload failed: status %s' % stat)
+    return upres['subid']
+
+
+def nova_img2wcs_many(config: PPAConfig, images, server=None, cancel=None, limit=None):
+    '''
+    Plate solves several images: uploads them, then waits on every
+    submission in a single polling loop, downloading each .wcs as soon as its
+    job finishes.
+    images: iterable of (filename, wcsfn, scale, near, progress), near being a
+    search_area() or None, and progress called as progress(bytes_sent,
+    total_bytes) while uploading, or None. Images that fail near their search
+    area are resubmitted blind.
+    limit: how many submissions may be waited on at once, the next image being
+    uploaded as each finishes (default: all of them)
+    cancel: a threading.Event that stops the solves when set; SolveCancelled
+    is then raised
+    Generator yielding (filename, None) as each .wcs is written, and
+    (filename, SolveError) for each image nova couldn't solve; RequestError is
+    only raised for failures to talk to nova
+    '''
     import time
+    from NovaClient import JobWaiter
     t_start = time.time()
-    # TODO: I seriously don't think this will ever be false unless you're in a really weird situation. Just remove this condition. And the next one.
-    if (('OS' in os.environ and os.environ['OS'] == 'Windows_NT') or
-        ('OSTYPE' in os.environ and os.environ['OSTYPE'] == 'linux') or
-        (os.uname()[0] == 'Linux') or
-            ('OSTYPE' in os.environ and os.environ['OSTYPE'] == 'darwin')):
-        # Cygwin local or Linux local
-        if True:
-            # first rough estimate of scale
-            print('___________________________________________________________')
-            # Run Astrometry.net package "solve-field" program to plate solve locally
-            cmd = 'solve-field -b ' + config.local_configfile
-            if scale is not None and config.restrict_scale == 1:
-                up_lim = scale * 1.05
-                lo_lim = scale * 0.95
-                cmd = cmd + (' -u app -L %.2f -H %.2f ' % (lo_lim, up_lim))
-            else:
-                cmd = cmd + ' -u ' + config.local_scale_units
-                cmd = cmd + (' -L %.2f' % config.local_scale_low)
-                cmd = cmd + (' -H %.2f' % config.local_scale_hi)
-            if config.local_downscale != 1:
-                cmd = cmd + (' -z %d' % config.local_downscale)
-            cmd = cmd + ' ' + config.local_xtra
-            cmd = cmd + ' -O '
-            cmd = cmd + ' -D ' + os.path.dirname(wcsfn)  # Output files to specified cache directory
-            cmd = cmd + ' \\"%s\\"'
-            template = ((config.local_shell % cmd))
-            # print template
-            cmd = (template % filename)
-            print(cmd)
-            os.system(cmd)
-            print('___________________________________________________________')
-    print('local solve time ' + str(time.time() - t_start))
+    server = server or config.nova_server
+    client = get_nova_client(config, server)
+    waiter = JobWaiter(client)
+    submitted = {}
+    images = iter(images)
+
+    def submit(filename, wcsfn, scale, near, progress):
+        upload_fn, kwargs = nova_prepare_upload(config, filename, wcsfn, scale, near)
+        sub_id = nova_submit(client, upload_fn, kwargs, progress)
+        submitted[sub_id] = (filename, wcsfn, scale, near, progress)
+        waiter.add(sub_id)
+
+    def fill():
+        # uploads the next images, until limit submissions are waited on
+        for image in images:
+            if cancel is not None and cancel.is_set():
+                return
+            submit(*image)
+            if limit and len(waiter.pending) >= limit:
+                return
+
+    fill()
+    for sub_id, job_id, status in waiter.wait(cancel=cancel):
+        filename, wcsfn, scale, near, progress = submitted[sub_id]
+        added, started = waiter.times[sub_id]
+        PPA_trace.complete('queue wait', added, started or time.time(), image=filename, subid=sub_id)
+        if started is not None:
+            PPA_trace.complete('solve', started, time.time(), solver='nova', image=filename,
+                               job=job_id, status=status, hinted=near is not None)
+        if status != 'success' and near is not None:
+            print('No solution near the previous image for %s, trying a blind solve' % filename)
+            submit(filename, wcsfn, scale, None, progress)
+            continue
+        fill()
+        if status != 'success':
+            print('Plate solve failed for', filename)
+            yield filename, SolveError("nova couldn't solve '%s'" % filename)
+            continue
+        # We don't need the API for this, just construct URL
+        url = server.replace('/api/', '/wcs_file/%i' % job_id)
+        print('Retrieving file from', url)
+        with PPA_trace.span('wcs download', job=job_id):
+            txt = client.get_file(url)
+        write_atomic(wcsfn, txt)
+        print('Wrote to', wcsfn)
+        print('nova solve time ' + str(time.time() - t_start))
+        yield filename, None
+    if cancel is not None and cancel.is_set():
+        raise SolveCancelled('Solving %s was cancelled' % ', '.join(repr(entry[0]) for entry in submitted.values()))
+    print('nova reuse: %(requests)d requests, %(handshakes_saved)d handshakes saved, '
+          '%(logins_saved)d logins saved' % client.get_stats() + ', %d status polls' % waiter.polls)
     print('___________________________________________________________')
 
 
-def nova_img2wcs(config: PPAConfig, filename, wcsfn, scale: float = None):
+def nova_img2wcs(config: PPAConfig, filename, wcsfn, scale: float = None, progress=None, near=None, cancel=None):
     '''
     Plate solves one image
+    Raises SolveError if nova couldn't solve it
     '''
-    import time
-    t_start = time.time()
-    # import optparse
-    # parser = optparse.OptionParser()
-    # parser.add_option('--server', dest='server',
-    #                   default=NovaClient.default_url,
-    #                   help='Set server base URL (eg, %default)')
-    # parser.add_option('--apikey', '-k', dest='apikey',
-    #                   help='API key for Astrometry.net web service; if not' +
-    #                   'given will check AN_API_KEY environment variable')
-    # parser.add_option('--upload', '-u', dest='upload', help='Upload a file')
-    # parser.add_option('--wait', '-w', dest='wait', action='store_true',
-    #                   help='After submitting, monitor job status')
-    # parser.add_option('--wcs', dest='wcs',
-    #                   help='Download resulting wcs.fits file, saving to ' +
-    #                   'given filename; implies --wait if --urlupload or' +
-    #                   '--upload')
-    # parser.add_option('--kmz', dest='kmz',
-    #                   help='Download resulting kmz file, saving to given ' +
-    #                   'filename; implies --wait if --urlupload or --upload')
-    # parser.add_option('--urlupload', '-U', dest='upload_url',
-    #                   help='Upload a file at specified url')
-    # parser.add_option('--scale-units', dest='scale_units',
-    #                   choices=('arcsecperpix', 'arcminwidth', 'degwidth',
-    #                            'focalmm'),
-    #                   help='Units for scale estimate')
-    # parser.add_option('--scale-lower', dest='scale_lower', type=float,
-    #                   help='Scale lower-bound')
-    # parser.add_option('--scale-upper', dest='scale_upper', type=float,
-    #                   help='Scale upper-bound')
-    # parser.add_option('--scale-est', dest='scale_est', type=float,
-    #                   help='Scale estimate')
-    # parser.add_option('--scale-err', dest='scale_err', type=float,
-    #                   help='Scale estimate error (in PERCENT), eg "10" if' +
-    #                   'you estimate can be off by 10%')
-    # parser.add_option('--ra', dest='center_ra', type=float, help='RA center')
-    # parser.add_option('--dec', dest='center_dec', type=float,
-    #                   help='Dec center')
-    # parser.add_option('--radius', dest='radius', type=float,
-    #                   help='Search radius around RA,Dec center')
-    # parser.add_option('--downsample', dest='downsample_factor', type=int,
-    #                   help='Downsample image by this factor')
-    # parser.add_option('--parity', dest='parity', choices=('0', '1'),
-    #                   help='Parity (flip) of image')
-    # parser.add_option('--tweak-order', dest='tweak_order', type=int,
-    #                   help='SIP distortion order (default: 2)')
-    # parser.add_option('--crpix-center', dest='crpix_center',
-    #                   action='store_true', default=None,
-    #                   help='Set reference point to center of image?')
-    # parser.add_option('--sdss', dest='sdss_wcs', nargs=2,
-    #                   help='Plot SDSS image for the given WCS file; write ' +
-    #                   'plot to given PNG filename')
-    # parser.add_option('--galex', dest='galex_wcs', nargs=2,
-    #                   help='Plot GALEX image for the given WCS file; write' +
-    #                   'plot to given PNG filename')
-    # parser.add_option('--substatus', '-s', dest='sub_id',
-    #                   help='Get status of a submission')
-    # parser.add_option('--jobstatus', '-j', dest='job_id',
-    #                   help='Get status of a job')
-    # parser.add_option('--jobs', '-J', dest='myjobs', action='store_true',
-    #                   help='Get all my jobs')
-    # parser.add_option('--jobsbyexacttag', '-T', dest='jobs_by_exact_tag',
-    #                   help='Get a list of jobs associated with a given' +
-    #                   'tag--exact match')
-    # parser.add_option('--jobsbytag', '-t', dest='jobs_by_tag',
-    #                   help='Get a list of jobs associated with a given tag')
-    # parser.add_option('--private', '-p', dest='public', action='store_const',
-    #                   const='n', default='y',
-    #                   help='Hide this submission from other users')
-    # parser.add_option('--allow_mod_sa', '-m', dest='allow_mod',
-    #                   action='store_const', const='sa', default='d',
-    #                   help='Select license to allow derivative works of ' +
-    #                   'submission, but only if shared under same conditions ' +
-    #                   'of original license')
-    # parser.add_option('--no_mod', '-M', dest='allow_mod', action='store_const',
-    #                   const='n', default='d',
-    #                   help='Select license to disallow derivative works of ' +
-    #                   'submission')
-    # parser.add_option('--no_commercial', '-c', dest='allow_commercial',
-    #                   action='store_const', const='n', default='d',
-    #                   help='Select license to disallow commercial use of' +
-    #                   ' submission')
-
-    # TODO: Allow some way to use these options. Likely in the config
-    class options:
-        def __init__(self):
-            self.server = NovaClient.default_url
-            self.apikey = None
-            self.upload = None
-            self.wait = None
-            self.wcd = None
-            self.kmz = None
-            self.upload_url = None
-            self.scale_units = None
-            self.scale_lower = None
-            self.scale_upper = None
-            self.scale_est = None
-            self.scale_err = None
-            self.center_ra = None
-            self.center_dec = None
-            self.radius = None
-            self.downsample_factor = None
-            self.parity = None  # (1 or 2)
-            self.tweak_order = None  # Says default 2 but we don't set a default
-            self.crpix_center = None
-            self.sdss_wcs = None
-            self.galex_wcs = None
-            self.sub_id = None   # Do these really need to be options
-            self.job_id = None
-            self.myjobs = False
-            self.jobs_by_exact_tag = None
-            self.jobs_by_tag = None
-            self.public = 'n'  # y for yes, n for no
-            self.allow_mod = 'n'
-            self.allow_commercial = 'n'
-
-    opt = options()
-    # add given arguments
-    opt.wcs = wcsfn
-    opt.apikey = config.apikey
-    opt.upload = filename
-
-    if config.restrict_scale == 1 and scale is not None:  # and config.restrict_scale == 1:
-        opt.scale_units = 'arcsecperpix'
-        opt.scale_est = ('%.2f' % scale)
-        opt.scale_err = 5
-    # DEBUG print opt
-    print('with estimated scale', opt.scale_est)
-    client = NovaClient(apiurl=opt.server)
-    try:
-        client.login(opt.apikey)
-    except RequestError as e:
-        print("Couldn't log on to nova.astrometry.net - Check the API key")
-        raise e
-
-    if opt.upload or opt.upload_url:
-        if opt.wcs or opt.kmz:
-            opt.wait = True
-        kwargs = dict()
-        if opt.scale_lower and opt.scale_upper:
-            kwargs.update(scale_lower=opt.scale_lower,
-                          scale_upper=opt.scale_upper,
-                          scale_type='ul')
-        elif opt.scale_est and opt.scale_err:
-            kwargs.update(scale_est=opt.scale_est,
-                          scale_err=opt.scale_err,
-                          scale_type='ev')
-        elif opt.scale_lower or opt.scale_upper:
-            kwargs.update(scale_type='ul')
-            if opt.scale_lower:
-                kwargs.update(scale_lower=opt.scale_lower)
-            if opt.scale_upper:
-                kwargs.update(scale_upper=opt.scale_upper)
-
-        for key in ['scale_units', 'center_ra', 'center_dec', 'radius',
-                    'downsample_factor', 'tweak_order', 'crpix_center', ]:
-            if getattr(opt, key) is not None:
-                kwargs[key] = getattr(opt, key)
-        if opt.parity is not None:
-            kwargs.update(parity=int(opt.parity))
-        if opt.upload:
-            upres = client.upload(opt.upload, **kwargs)
-        stat = upres['status']
-        if stat != 'success':
-            print('Upload failed: status', stat)
-            print(upres)
-            sys.exit(-1)
-        opt.sub_id = upres['subid']
-    if opt.wait:
-        if opt.job_id is None:
-            if opt.sub_id is None:
-                print("Can't --wait without a submission id or job id!")
-                sys.exit(-1)
-            while True:
-                stat = client.sub_status(opt.sub_id, justdict=True)
-                # print 'Got status:', stat
-                jobs = stat.get('jobs', [])
-                if len(jobs):
-                    # Find the first elem in jobs that is not None  # TODO: Cleanup
-                    for j in jobs:
-                        if j is not None:
-                            break
-                    if j is not None:
-                        print('Selecting job id', j)
-                        opt.job_id = j
-                        break
-                time.sleep(5)
-        success = False
-        while True:
-            stat = client.job_status(opt.job_id, justdict=True)
-            # print 'Got job status:', stat
-            # TODO : stat may be None! should recover
-            if stat.get('status', '') in ['success']:
-                success = (stat['status'] == 'success')
-                break
-            time.sleep(5)
-        if success:
-            client.job_status(opt.job_id)
-            retrieveurls = []
-            if opt.wcs:
-                # We don't need the API for this, just construct URL
-                url = opt.server.replace('/api/', '/wcs_file/%i' % opt.job_id)
-                retrieveurls.append((url, opt.wcs))
-            for url, fne in retrieveurls:
-                print('Retrieving file from', url)
-                fle = urlopen(url)
-                txt = fle.read()
-                wfl = open(fne, 'wb')
-                wfl.write(txt)
-                wfl.close()
-                print('Wrote to', fne)
-                print('nova solve time ' + str(time.time() - t_start))
-                print('___________________________________________________________')
-        opt.job_id = None
-        opt.sub_id = None
-    if opt.sub_id:
-        print("Sub ID:")
-        print(client.sub_status(opt.sub_id))
-    if opt.job_id:
-        print("Job ID:")
-        print(client.job_status(opt.job_id))
-    if opt.jobs_by_tag:
-        tag = opt.jobs_by_tag
-        print("Jobs by Tag:")
-        print(client.jobs_by_tag(tag, None))
-    if opt.jobs_by_exact_tag:
-        tag = opt.jobs_by_exact_tag
-        print("Jobs by Exact Tag:")
-        print(client.jobs_by_tag(tag, 'yes'))
-    if opt.myjobs:
-        jobs = client.myjobs()
-        print("My Jobs:")
-        print(jobs)
+    for _, error in nova_img2wcs_many(config, [(filename, wcsfn, scale, near, progress)], cancel=cancel):
+        if error is not None:
+            raise error
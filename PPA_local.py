@@ -0,0 +1,259 @@
+'''
+Managed pool of local solve-field workers
+
+Each solve runs as a subprocess in its own session on a bounded thread pool,
+with its output captured, a wall-clock timeout and a way to cancel it. A
+runaway solve is killed together with everything it spawned.
+
+LocalEngine instead keeps one astrometry-engine process running, so that its
+index files are loaded once rather than by every solve-field run.
+'''
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+
+
+def kill_process_tree(proc):
+    '''
+    Kills a solver process started in its own session, and everything it spawned
+    '''
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class LocalSolveResult(object):
+    '''
+    The outcome of one solve-field run
+    '''
+
+    def __init__(self, filename, wcsfn, returncode, stdout, stderr, elapsed,
+                 timed_out=False, cancelled=False):
+        self.filename = filename
+        self.wcsfn = wcsfn
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    @property
+    def solved(self):
+        return self.returncode == 0 and os.path.exists(self.wcsfn)
+
+    def describe(self):
+        '''
+        a one line summary of why a solve failed
+        '''
+        if self.timed_out:
+            return 'timed out after %.0f s' % self.elapsed
+        if self.cancelled:
+            return 'cancelled'
+        if self.returncode != 0:
+            return 'exit status %s: %s' % (self.returncode, self.stderr.strip()[-500:])
+        return 'no solution found'
+
+
+class LocalSolverPool(object):
+    '''
+    Runs solve-field commands on a bounded pool of workers
+    workers: how many solves may run at once (default: one per CPU)
+    timeout: wall-clock seconds before a solve is killed (None for no limit)
+    '''
+
+    def __init__(self, workers=None, timeout=None):
+        import concurrent.futures
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                              thread_name_prefix='solve-field')
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def submit(self, cmd, filename, wcsfn, cancel=None):
+        '''
+        Queues a solve-field command; returns a Future of its LocalSolveResult
+        cancel: a threading.Event that kills the solve when set
+        '''
+        return self.executor.submit(self._run, cmd, filename, wcsfn, cancel)
+
+    def _run(self, cmd, filename, wcsfn, cancel):
+        t_start = time.time()
+        if cancel is not None and cancel.is_set():
+            return LocalSolveResult(filename, wcsfn, None, '', '', 0, cancelled=True)
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True, errors='replace',
+                                start_new_session=(os.name == 'posix'))
+        with self._lock:
+            self._running.add(proc)
+        timed_out = cancelled = False
+        try:
+            while True:
+                try:
+                    stdout, stderr = proc.communicate(timeout=0.25)
+                    break
+                except subprocess.TimeoutExpired:
+                    if cancel is not None and cancel.is_set():
+                        cancelled = True
+                    elif self.timeout and time.time() - t_start > self.timeout:
+                        timed_out = True
+                    else:
+                        continue
+                    kill_process_tree(proc)
+                    stdout, stderr = proc.communicate()
+                    break
+        finally:
+            with self._lock:
+                self._running.discard(proc)
+        return LocalSolveResult(filename, wcsfn, proc.returncode, stdout, stderr,
+                                time.time() - t_start, timed_out, cancelled)
+
+    def kill_all(self):
+        '''
+        Kills every running solve
+        '''
+        with self._lock:
+            running = list(self._running)
+        for proc in running:
+            kill_process_tree(proc)
+
+    def shutdown(self, kill=False):
+        if kill:
+            self.kill_all()
+        self.executor.shutdown(wait=not kill, cancel_futures=kill)
+
+
+class LocalEngine(object):
+    '''
+    A resident astrometry-engine (run with --files-on-stdin), fed augmented
+    xylists (.axy files) one path per line on its stdin and solving them one
+    at a time. It only ends when its stdin is closed, so its exit during a
+    solve is reported as a failure, with its output. With "inparallel"
+    set in its config file it loads its indexes once, when it starts.
+    cmd: the shell command starting the engine
+    timeout: wall-clock seconds before a solve is abandoned and the engine
+    restarted (None for no limit)
+    '''
+
+    def __init__(self, cmd, timeout=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.proc = None
+        self._lines = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        print('Starting', self.cmd)
+        self.proc = subprocess.Popen(self.cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, universal_newlines=True, errors='replace',
+                                     bufsize=1, start_new_session=(os.name == 'posix'))
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read, args=(self.proc, self._lines), daemon=True,
+                         name='astrometry-engine').start()
+
+    @staticmethod
+    def _read(proc, lines):
+        for line in proc.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    @staticmethod
+    def _rest(lines):
+        # what an engine that has ended still had to say
+        while True:
+            try:
+                line = lines.get(timeout=1)
+            except queue.Empty:
+                return
+            if line is None:
+                return
+            yield line
+
+    def _stop(self):
+        if self.proc is not None:
+            kill_process_tree(self.proc)
+            self.proc.wait()
+            self.proc = None
+
+    @staticmethod
+    def _written(wcsfn):
+        # the engine writes the .wcs header in one go, padded to whole FITS blocks
+        try:
+            size = os.path.getsize(wcsfn)
+        except OSError:
+            return False
+        return size > 0 and size % 2880 == 0
+
+    def solve(self, axy, filename, wcsfn, cancel=None):
+        '''
+        Solves an augmented xylist whose solution goes to wcsfn
+        Returns a LocalSolveResult; cancel is a threading.Event that abandons
+        the solve (restarting the engine) when set
+        '''
+        with self._lock:
+            starting = self.proc is None or self.proc.poll() is not None
+            if starting:
+                self._start()
+            while not self._lines.empty():
+                self._lines.get()
+            t_start = time.time()
+            log = []
+            returncode = 0
+            timed_out = cancelled = False
+            try:
+                self.proc.stdin.write(axy + '\n')
+                self.proc.stdin.flush()
+            except OSError:
+                status = self.proc.poll()
+                self._stop()
+                log.extend(self._rest(self._lines))
+                log.append('astrometry-engine %s (exit status %s)\n'
+                           % ('exited as it started' if starting else 'is gone', status))
+                print(log[-1], end='')
+                returncode = status or -1
+            while returncode == 0 and not self._written(wcsfn):
+                try:
+                    line = self._lines.get(timeout=0.1)
+                except queue.Empty:
+                    line = ''
+                if line is None:
+                    # the engine only ends when its stdin is closed: it failed
+                    status = self.proc.wait()
+                    self.proc = None
+                    log.append('astrometry-engine %s (exit status %s)\n'
+                               % ('exited as it started' if starting else 'ended while solving', status))
+                    print(log[-1], end='')
+                    returncode = status or -1
+                    break
+                log.append(line)
+                if 'did not solve' in line:  # with inparallel, logged once all indexes are tried
+                    break
+                if cancel is not None and cancel.is_set():
+                    cancelled = True
+                elif self.timeout and time.time() - t_start > self.timeout:
+                    timed_out = True
+                else:
+                    continue
+                # the engine can't be interrupted half way through a field
+                self._stop()
+                break
+        return LocalSolveResult(filename, wcsfn, returncode, ''.join(log), ''.join(log[-5:]),
+                                time.time() - t_start, timed_out, cancelled)
+
+    def close(self):
+        with self._lock:
+            if self.proc is not None:
+                try:
+                    self.proc.stdin.close()
+                    self.proc.wait(5)
+                    self.proc = None
+                except (OSError, subprocess.TimeoutExpired):
+                    self._stop()
@@ -0,0 +1,76 @@
+'''
+Client-side star extraction
+
+Turns an image into a short list of star positions (an "xylist"), so a solver
+can be sent a few kilobytes of table instead of the whole picture.
+'''
+
+
+def extract_sources(image_path, max_sources=300, nsigma=5.0, block=64):
+    '''
+    Find the stars in an image
+    Returns x, y (1-based pixel coordinates, brightest first), flux, width, height
+    '''
+    import numpy
+    import scipy.ndimage
+    from PIL import Image
+
+    data = numpy.asarray(Image.open(image_path).convert('L'), dtype=numpy.float32)
+    height, width = data.shape
+
+    # Background: median of each block x block cell, interpolated back to full size
+    ny, nx = max(1, height // block), max(1, width // block)
+    cells = data[:ny * block, :nx * block].reshape(ny, block, nx, block)
+    grid = numpy.median(cells.transpose(0, 2, 1, 3).reshape(ny, nx, -1), axis=2)
+    background = scipy.ndimage.zoom(grid, (height / ny, width / nx), order=1)[:height, :width]
+    resid = data - background
+
+    # Noise from the median absolute deviation, robust to the stars themselves
+    sample = resid[::4, ::4]
+    sigma = 1.4826 * numpy.median(numpy.abs(sample - numpy.median(sample)))
+    if sigma <= 0:
+        sigma = max(float(sample.std()), 1.0)
+
+    # Threshold a slightly smoothed image so single hot pixels don't count
+    smooth = scipy.ndimage.gaussian_filter(resid, 1.0)
+    labels, count = scipy.ndimage.label(smooth > nsigma * sigma)
+    if count == 0:
+        return numpy.zeros(0), numpy.zeros(0), numpy.zeros(0), width, height
+    index = numpy.arange(1, count + 1)
+    npix = scipy.ndimage.sum_labels(numpy.ones_like(resid), labels, index)
+    flux = scipy.ndimage.sum_labels(numpy.clip(resid, 0, None), labels, index)
+    centres = numpy.array(scipy.ndimage.center_of_mass(numpy.clip(resid, 0, None), labels, index))
+    keep = (npix >= 2) & (flux > 0)
+    centres, flux = centres[keep], flux[keep]
+
+    order = numpy.argsort(flux)[::-1][:max_sources]
+    ys = centres[order, 0] + 1
+    xs = centres[order, 1] + 1
+    return xs, ys, flux[order], width, height
+
+
+def write_xylist(path, xs, ys, flux, width, height):
+    '''
+    Write star positions as the FITS table astrometry.net solvers accept
+    '''
+    from astropy.io import fits
+    cols = fits.ColDefs([fits.Column(name='X', format='E', array=xs),
+                         fits.Column(name='Y', format='E', array=ys),
+                         fits.Column(name='FLUX', format='E', array=flux)])
+    table = fits.BinTableHDU.from_columns(cols)
+    table.header['IMAGEW'] = width
+    table.header['IMAGEH'] = height
+    table.writeto(path, overwrite=True)
+
+
+def image_to_xylist(image_path, xylist_path, min_sources=10):
+    '''
+    Extract the stars of an image into an xylist file
+    Returns (width, height), or None if too few stars were found to be worth it
+    '''
+    xs, ys, flux, width, height = extract_sources(image_path)
+    print('Found %d stars in %s' % (len(xs), image_path))
+    if len(xs) < min_sources:
+        return None
+    write_xylist(xylist_path, xs, ys, flux, width, height)
+    return width, height
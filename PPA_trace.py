@@ -0,0 +1,116 @@
+'''
+Timing spans, written as Trace Event Format JSON
+
+    with PPA_trace.span('upload', file=name):
+        ...
+
+Tracing is off unless the PPA_TRACE environment variable names a file ("-" for
+stderr), or enable() is called; while off, span() hands back one shared
+do-nothing object. While on, every finished span is written as one JSON line
+("complete" event, microsecond timestamps) after an opening "[", which is the
+form chrome://tracing, Perfetto and speedscope load directly. Spans of the same
+thread nest by time.
+'''
+import json
+import os
+import sys
+import threading
+import time
+
+_sink = None
+_lock = threading.Lock()
+_named_threads = set()
+
+
+def enable(path='-'):
+    '''
+    Starts writing spans to path ("-" for stderr)
+    '''
+    global _sink
+    with _lock:
+        _sink = sys.stderr if path in (None, '', '-') else open(path, 'w')
+        _sink.write('[\n')
+        _sink.flush()
+        _named_threads.clear()
+
+
+def enabled():
+    return _sink is not None
+
+
+def _emit(event):
+    tid = threading.get_ident()
+    event['pid'] = os.getpid()
+    event['tid'] = tid
+    with _lock:
+        if _sink is None:
+            return
+        if tid not in _named_threads:
+            _named_threads.add(tid)
+            _sink.write(json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': event['pid'], 'tid': tid,
+                                    'args': {'name': threading.current_thread().name}}) + ',\n')
+        _sink.write(json.dumps(event, default=str) + ',\n')
+        _sink.flush()
+
+
+def complete(name, start, end, **args):
+    '''
+    Records a span that has already happened, start and end being time.time() values
+    '''
+    if _sink is None:
+        return
+    _emit({'name': name, 'cat': 'ppa', 'ph': 'X', 'ts': int(start * 1e6),
+           'dur': int((end - start) * 1e6), 'args': args})
+
+
+class _Span(object):
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def set(self, **args):
+        '''
+        adds arguments to the span, e.g. what was found
+        '''
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        complete(self.name, self.start, time.time(), **self.args)
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **args):
+    '''
+    A context manager timing its block as a span called name
+    '''
+    if _sink is None:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+if os.environ.get('PPA_TRACE'):
+    enable(os.environ['PPA_TRACE'])
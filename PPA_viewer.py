@@ -0,0 +1,175 @@
+'''
+Tiled viewer for the annotated images
+
+    pyramid = PPA_viewer.Pyramid(image)         # on a worker thread
+    PPA_viewer.TiledViewer(win, pyramid, 800, 600).pack(fill='both', expand=1)
+
+The pyramid halves the image until it fits in a single tile. The viewer shows
+one level at a time, so zooming (mouse wheel, or + and -) goes by powers of
+two and never resamples. Dragging pans. Only the tiles in view get a Tk image,
+made when first needed and kept in an LRU cache.
+'''
+import collections
+from tkinter import Frame, Canvas, Scrollbar
+
+TILE = 256
+
+
+class Pyramid(object):
+    '''
+    An image and its successive halvings, down to a single tile
+    '''
+
+    def __init__(self, image):
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        self.levels = [image]
+        while max(image.size) > TILE:
+            image = image.reduce(2)
+            self.levels.append(image)
+
+    def size(self, level):
+        return self.levels[level].size
+
+    def fit(self, width, height):
+        '''
+        the most detailed level that fits in width x height
+        '''
+        for level, image in enumerate(self.levels):
+            if image.width <= width and image.height <= height:
+                return level
+        return len(self.levels) - 1
+
+    def tile(self, level, tx, ty):
+        '''
+        the PIL image of one tile
+        '''
+        image = self.levels[level]
+        return image.crop((tx * TILE, ty * TILE,
+                           min(image.width, (tx + 1) * TILE), min(image.height, (ty + 1) * TILE)))
+
+
+class TileCache(object):
+    '''
+    The Tk images of the most recently shown tiles, by (level, tx, ty)
+    '''
+
+    def __init__(self, pyramid, capacity=128):
+        self.pyramid = pyramid
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._tiles = collections.OrderedDict()
+
+    def get(self, key):
+        from PIL import ImageTk
+        photo = self._tiles.get(key)
+        if photo is not None:
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return photo
+        self.misses += 1
+        photo = ImageTk.PhotoImage(self.pyramid.tile(*key))
+        self._tiles[key] = photo
+        while len(self._tiles) > self.capacity:
+            self._tiles.popitem(last=False)
+        return photo
+
+
+class TiledViewer(Frame):
+    '''
+    A scrolling, zooming canvas showing a Pyramid
+    '''
+
+    def __init__(self, master, pyramid, width, height):
+        Frame.__init__(self, master, bd=0)
+        self.pyramid = pyramid
+        self.cache = TileCache(pyramid)
+        self.level = pyramid.fit(width, height)
+        self.items = {}  # (tx, ty) -> canvas item, for the tiles of this level on the canvas
+        self._redraw_pending = False
+        xscrollbar = Scrollbar(self, orient='horizontal')
+        xscrollbar.pack(side='bottom', fill='x')
+        yscrollbar = Scrollbar(self, orient='vertical')
+        yscrollbar.pack(side='right', fill='y')
+        canvas = Canvas(self, bd=0, width=width, height=height,
+                        xscrollcommand=lambda *args: self._scrolled(xscrollbar, *args),
+                        yscrollcommand=lambda *args: self._scrolled(yscrollbar, *args))
+        canvas.pack(side='top', fill='both', expand=1)
+        xscrollbar.config(command=canvas.xview)
+        yscrollbar.config(command=canvas.yview)
+        canvas.bind('<Configure>', lambda event: self.schedule_redraw())
+        canvas.bind('<ButtonPress-1>', lambda event: canvas.scan_mark(event.x, event.y))
+        canvas.bind('<B1-Motion>', lambda event: canvas.scan_dragto(event.x, event.y, gain=1))
+        canvas.bind('<MouseWheel>', self._wheel)  # Windows and macOS
+        canvas.bind('<Button-4>', self._wheel)  # X11
+        canvas.bind('<Button-5>', self._wheel)
+        for key, steps in (('<plus>', 1), ('<equal>', 1), ('<minus>', -1)):
+            canvas.bind(key, lambda event, steps=steps: self.zoom(steps))
+        canvas.bind('<Enter>', lambda event: canvas.focus_set())
+        self.canvas = canvas
+        self._set_level(self.level)
+
+    def _scrolled(self, scrollbar, *args):
+        scrollbar.set(*args)
+        self.schedule_redraw()
+
+    def _wheel(self, event):
+        self.zoom(1 if event.num == 4 or event.delta > 0 else -1, event.x, event.y)
+
+    def _set_level(self, level):
+        self.level = level
+        for item in self.items.values():
+            self.canvas.delete(item)
+        self.items.clear()
+        width, height = self.pyramid.size(level)
+        self.canvas.configure(scrollregion=(0, 0, width, height))
+
+    def zoom(self, steps, x=None, y=None):
+        '''
+        zooms in (steps > 0) or out by powers of two, keeping the image point
+        at window coordinates x, y (by default the middle) where it is
+        '''
+        level = min(max(self.level - steps, 0), len(self.pyramid.levels) - 1)
+        if level == self.level:
+            return
+        canvas = self.canvas
+        if x is None:
+            x, y = canvas.winfo_width() // 2, canvas.winfo_height() // 2
+        factor = 2.0 ** (self.level - level)
+        image_x = canvas.canvasx(x) * factor
+        image_y = canvas.canvasy(y) * factor
+        self._set_level(level)
+        width, height = self.pyramid.size(level)
+        canvas.xview_moveto((image_x - x) / width)
+        canvas.yview_moveto((image_y - y) / height)
+        self.schedule_redraw()
+
+    def schedule_redraw(self):
+        '''
+        redraws once the pending scroll and resize events are handled
+        '''
+        if not self._redraw_pending:
+            self._redraw_pending = True
+            self.after_idle(self.redraw)
+
+    def redraw(self):
+        '''
+        puts the tiles in view on the canvas, and takes the others off
+        '''
+        self._redraw_pending = False
+        canvas = self.canvas
+        width, height = self.pyramid.size(self.level)
+        left = max(0, int(canvas.canvasx(0)) // TILE)
+        top = max(0, int(canvas.canvasy(0)) // TILE)
+        right = min((width - 1) // TILE, int(canvas.canvasx(canvas.winfo_width())) // TILE)
+        bottom = min((height - 1) // TILE, int(canvas.canvasy(canvas.winfo_height())) // TILE)
+        wanted = [(tx, ty) for ty in range(top, bottom + 1) for tx in range(left, right + 1)]
+        # a shown tile must outlive its canvas item, so all in view have to fit
+        self.cache.capacity = max(self.cache.capacity, 2 * len(wanted))
+        for key in [key for key in self.items if key not in wanted]:
+            canvas.delete(self.items.pop(key))
+        for key in wanted:
+            photo = self.cache.get((self.level,) + key)
+            if key not in self.items:
+                self.items[key] = canvas.create_image(key[0] * TILE, key[1] * TILE, image=photo, anchor='nw')
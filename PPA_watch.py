@@ -0,0 +1,148 @@
+'''
+Watching a folder for new frames
+
+    watcher = PPA_watch.make_watcher(folder)
+    while True:
+        frames = watcher.wait()   # paths of the frames written since the last call
+
+On Linux the kernel's inotify tells us the moment a file has been written and
+closed, or moved into the folder. Elsewhere, or if inotify is unavailable, the
+folder is polled and a file counts as written once its size and modification
+time have stopped changing between two scans.
+'''
+import os
+import select
+import struct
+import sys
+import time
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.fit', '.fits')
+
+
+class PollingWatcher(object):
+    '''
+    Finds new frames by rescanning the folder every interval seconds
+    '''
+
+    def __init__(self, folder, extensions=IMAGE_EXTENSIONS, interval=0.5):
+        self.folder = folder
+        self.extensions = extensions
+        self.interval = interval
+        self._seen = set(self._scan())  # frames already there are not new
+        self._growing = {}
+
+    def _scan(self):
+        stamps = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(self.extensions):
+                    stat = entry.stat()
+                    stamps[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return stamps
+
+    def _poll(self):
+        stamps = self._scan()
+        ready = []
+        for path, stamp in stamps.items():
+            if path in self._seen:
+                continue
+            if self._growing.get(path) == stamp:
+                ready.append(path)
+                self._seen.add(path)
+                del self._growing[path]
+            else:
+                self._growing[path] = stamp
+        return sorted(ready, key=lambda path: stamps[path][1])
+
+    def wait(self, timeout=None):
+        '''
+        Returns the frames completed since the last call, oldest first,
+        waiting up to timeout seconds (None: until there is one)
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ready = self._poll()
+            if ready or (deadline is not None and time.monotonic() >= deadline):
+                return ready
+            pause = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            time.sleep(max(pause, 0))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    '''
+    Finds new frames with Linux inotify
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CLOEXEC = 0o2000000
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, folder, extensions=IMAGE_EXTENSIONS):
+        import ctypes
+        import ctypes.util
+        self.folder = folder
+        self.extensions = extensions
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed', folder)
+
+    def wait(self, timeout=None):
+        '''
+        Returns the frames completed since the last call, oldest first,
+        waiting up to timeout seconds (None: until there is one)
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ready = []
+        while not ready:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not select.select([self.fd], [], [], remaining)[0]:
+                break
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = self.event_header.unpack_from(data, offset)
+                offset += self.event_header.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                path = os.path.join(self.folder, name)
+                if name.lower().endswith(self.extensions):
+                    if path in ready:
+                        ready.remove(path)
+                    ready.append(path)
+        return ready
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(folder, extensions=IMAGE_EXTENSIONS):
+    '''
+    An InotifyWatcher where the platform has inotify, otherwise a PollingWatcher
+    '''
+    if not os.path.isdir(folder):
+        raise IOError("Folder '%s' not found." % folder)
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(folder, extensions)
+        except (OSError, AttributeError) as err:
+            print('inotify unavailable (%s), polling %s instead' % (err, folder))
+    return PollingWatcher(folder, extensions)
+
+
+def newest_frames(watcher):
+    '''
+    Yields the newest frame each time there are new frames, skipping any that
+    arrived while the previous one was being handled, as (frame, skipped)
+    '''
+    while True:
+        frames = watcher.wait()
+        frames += watcher.wait(0)
+        yield frames[-1], frames[:-1]
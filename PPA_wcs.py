@@ -0,0 +1,194 @@
+'''
+Light-weight reading of plate solutions
+
+Importing astropy takes about a second, while all PPA needs from a cached .wcs
+file is a handful of header cards and the core TAN projection. This module
+reads FITS headers and does that projection with plain Python and NumPy, and
+only falls back to astropy for solutions it does not understand.
+'''
+import math
+
+
+class Header(dict):
+    '''
+    The cards of a FITS header, with the COMMENT cards as a list: as much of
+    astropy's Header interface as PPA uses
+    '''
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path
+
+
+class HDU(object):
+    def __init__(self, header):
+        self.header = header
+
+
+def _parse_value(text):
+    text = text.strip()
+    if text.startswith("'"):
+        end = 1
+        while True:
+            end = text.find("'", end)
+            if end < 0 or text[end:end + 2] != "''":
+                break
+            end += 2
+        return text[1:end].replace("''", "'").rstrip()
+    text = text.split('/', 1)[0].strip()
+    if text == 'T':
+        return True
+    if text == 'F':
+        return False
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text.replace('D', 'E'))
+    except ValueError:
+        return text
+
+
+def read_header(path):
+    '''
+    Reads the primary header of a FITS file
+    '''
+    header = Header(path)
+    comments = []
+    with open(path, 'rb') as fle:
+        while True:
+            block = fle.read(2880)
+            if len(block) < 2880:
+                raise IOError("'%s' is not a FITS file" % path)
+            for i in range(0, 2880, 80):
+                card = block[i:i + 80].decode('ascii', 'replace')
+                key = card[:8].strip()
+                if key == 'END':
+                    if comments:
+                        header['COMMENT'] = comments
+                    return header
+                if key == 'COMMENT':
+                    comments.append(card[8:].strip())
+                elif card[8:10] == '= ':
+                    header[key] = _parse_value(card[10:])
+
+
+def open_wcs_file(path):
+    '''
+    Opens a .wcs file as a list holding one HDU, like fits.open does
+    '''
+    return [HDU(read_header(path))]
+
+
+class TanWCS(object):
+    '''
+    The core (non-distorted) gnomonic projection of a TAN or TAN-SIP
+    solution. Like astropy's wcs_pix2world/wcs_world2pix, SIP terms are ignored.
+    '''
+
+    @staticmethod
+    def supports(header):
+        try:
+            return (str(header['CTYPE1']).startswith('RA---TAN') and
+                    str(header['CTYPE2']).startswith('DEC--TAN') and
+                    'CD1_1' in header and header.get('LONPOLE', 180) == 180)
+        except KeyError:
+            return False
+
+    def __init__(self, header):
+        import numpy
+        self.crpix = numpy.array([header['CRPIX1'], header['CRPIX2']], numpy.float64)
+        self.crval = numpy.radians([header['CRVAL1'], header['CRVAL2']])
+        self.cd = numpy.radians(numpy.array([[header.get('CD1_1', 0.0), header.get('CD1_2', 0.0)],
+                                             [header.get('CD2_1', 0.0), header.get('CD2_2', 0.0)]]))
+        self.cd_inv = numpy.linalg.inv(self.cd)
+
+    def wcs_pix2world(self, pixcrd, origin):
+        import numpy
+        pix = numpy.asarray(pixcrd, numpy.float64) + (1 - origin)
+        xi, eta = ((pix - self.crpix) @ self.cd.T).T
+        ra0, dec0 = self.crval
+        denom = math.cos(dec0) - eta * math.sin(dec0)
+        ra = ra0 + numpy.arctan2(xi, denom)
+        dec = numpy.arctan2(math.sin(dec0) + eta * math.cos(dec0), numpy.hypot(xi, denom))
+        return numpy.column_stack([numpy.mod(numpy.degrees(ra), 360.0), numpy.degrees(dec)])
+
+    def wcs_world2pix(self, world, origin):
+        import numpy
+        ra, dec = numpy.radians(numpy.asarray(world, numpy.float64)).T
+        ra0, dec0 = self.crval
+        cos_dra = numpy.cos(ra - ra0)
+        cosc = math.sin(dec0) * numpy.sin(dec) + math.cos(dec0) * numpy.cos(dec) * cos_dra
+        xi = numpy.cos(dec) * numpy.sin(ra - ra0) / cosc
+        eta = (math.cos(dec0) * numpy.sin(dec) - math.sin(dec0) * numpy.cos(dec) * cos_dra) / cosc
+        return numpy.column_stack([xi, eta]) @ self.cd_inv.T + self.crpix - (1 - origin)
+
+
+def world2pix_many(wcses, world, origin):
+    '''
+    The pixel coordinates of the same sky points in several solutions, as an
+    array of shape (solutions, points, 2). When all are TanWCS this is a
+    single broadcast pass, however many solutions there are.
+    '''
+    import numpy
+    world = numpy.asarray(world, numpy.float64)
+    if not all(isinstance(wcs, TanWCS) for wcs in wcses):
+        return numpy.stack([wcs.wcs_world2pix(world, origin) for wcs in wcses])
+    ra0, dec0 = numpy.array([wcs.crval for wcs in wcses]).T[:, :, None]
+    crpix = numpy.array([wcs.crpix for wcs in wcses])
+    cd_inv = numpy.array([wcs.cd_inv for wcs in wcses])
+    ra, dec = numpy.radians(world).T
+    cos_dra = numpy.cos(ra - ra0)
+    cosc = numpy.sin(dec0) * numpy.sin(dec) + numpy.cos(dec0) * numpy.cos(dec) * cos_dra
+    xi = numpy.cos(dec) * numpy.sin(ra - ra0) / cosc
+    eta = (numpy.cos(dec0) * numpy.sin(dec) - numpy.sin(dec0) * numpy.cos(dec) * cos_dra) / cosc
+    return numpy.stack([xi, eta], axis=-1) @ cd_inv.transpose(0, 2, 1) + crpix[:, None, :] - (1 - origin)
+
+
+def make_wcs(header):
+    '''
+    A WCS object for a header: the light TanWCS when it can handle it,
+    otherwise astropy's
+    '''
+    if TanWCS.supports(header):
+        return TanWCS(header)
+    from astropy import wcs
+    if isinstance(header, Header):
+        from astropy.io import fits
+        header = fits.open(header.path)[0].header
+    return wcs.WCS(header)
+
+
+class WcsSummary(object):
+    '''
+    What PPA uses of a plate solution, from a SummaryIndex record:
+    scale (arcsec/pixel), parity, width, height, dec, and the WCS itself
+    '''
+
+    def __init__(self, path, record):
+        self.path = path
+        self.record = record
+        self.scale = record['scale']
+        self.parity = record['parity']
+        self.width = record['width']
+        self.height = record['height']
+        self.dec = record['crval2']
+
+    @property
+    def header(self):
+        '''
+        the WCS cards of the solution, enough for make_wcs
+        '''
+        header = Header(self.path)
+        for field in ('ctype1', 'ctype2', 'lonpole', 'crval1', 'crval2', 'crpix1', 'crpix2',
+                      'cd1_1', 'cd1_2', 'cd2_1', 'cd2_2'):
+            if self.record[field] is not None:
+                header[field.upper()] = self.record[field]
+        header.update(self.record['sip'] or {})
+        header['IMAGEW'] = self.width
+        header['IMAGEH'] = self.height
+        return header
+
+    def wcs(self):
+        return make_wcs(self.header)
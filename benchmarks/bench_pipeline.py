@@ -0,0 +1,291 @@
+'''
+End-to-end benchmark over the Testing image sets
+
+Replays each alignment session in Testing/ through plate_solve (nova, served
+by a local stand-in, so no network is needed), wcs_summary,
+find_ra_axis_pix_coords and find_error, and reports the latency and
+throughput of each phase:
+
+    python benchmarks/bench_pipeline.py                 # report
+    python benchmarks/bench_pipeline.py --save          # record a baseline
+    python benchmarks/bench_pipeline.py --check         # fail on regressions (--repeat 3 or more)
+
+The stand-in answers with the solution of each image kept in
+benchmarks/fixtures/<set>/<image>.wcs. The ones committed are generated in
+nova's form (TAN-SIP, nova's cards and comments), the vertical image turned in
+RA about a known axis, kept in <set>/axis.json and checked against. They are
+remade with --generate, or replaced by real solutions from nova (network and
+an API key needed, and the axis is then not checked) with:
+
+    python benchmarks/bench_pipeline.py --record --apikey <key>
+'''
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from nova_standin import NovaStandIn
+from wcs_fixtures import axis_error, nova_session_headers
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+TESTING = os.path.join(ROOT, 'Testing')
+FIXTURES = os.path.join(HERE, 'fixtures')
+BASELINE = os.path.join(HERE, 'pipeline_baseline.json')
+sys.path.insert(0, ROOT)
+
+# The alignment sessions: horizontal, vertical and improved images, and the
+# scale (arcsec/pixel) used for their synthetic solutions
+SETS = {
+    'N/20141206': {'north': True, 'scale': 4.21, 'h': 'horiz.JPG', 'v': 'vert.JPG',
+                   'i': ['IMG_%04d.JPG' % n for n in range(3, 14)]},
+    'N/Stelarrium': {'north': True, 'scale': 60.0, 'h': 'horizontal.png', 'v': 'vertical.png',
+                     'i': ['improved1.png', 'improved2.png', 'improved3.png']},
+    'S/20141202': {'north': False, 'scale': 10.3, 'h': 'h_108mm_MG_3677.JPG', 'v': 'v_108mm_MG_3676.JPG',
+                   'i': ['h2_108mm_MG_3678.JPG', 'h3_108mm_MG_3679.JPG', 'h4_108mm_MG_3680.JPG']},
+}
+
+PHASES = ('solve', 'cached', 'summary', 'axis', 'error')
+# the fewest timed replays --check takes a median of
+CHECK_REPEAT = 3
+
+
+def images_of(session):
+    '''
+    (role, image path) for each image of a session: h, v, i1, i2, ...
+    '''
+    spec = SETS[session]
+    folder = os.path.join(TESTING, session)
+    images = [('h', os.path.join(folder, spec['h'])), ('v', os.path.join(folder, spec['v']))]
+    images += [('i%d' % k, os.path.join(folder, name)) for k, name in enumerate(spec['i'], 1)]
+    return images
+
+
+def load_fixtures(session):
+    '''
+    The solution of every image of a session, by sha256 of the image file,
+    and the RA axis pixel to expect (None for recorded solutions)
+    '''
+    solutions = {}
+    for role, path in images_of(session):
+        fixture = os.path.join(FIXTURES, session, os.path.basename(path) + '.wcs')
+        if not os.path.exists(fixture):
+            raise SystemExit('No fixture %s: make them with --generate or --record' % fixture)
+        with open(fixture, 'rb') as fle:
+            wcs = fle.read()
+        with open(path, 'rb') as fle:
+            solutions[hashlib.sha256(fle.read()).hexdigest()] = wcs
+    try:
+        with open(os.path.join(FIXTURES, session, 'axis.json')) as fle:
+            axis = tuple(json.load(fle)['axis'])
+    except OSError:
+        axis = None
+    return solutions, axis
+
+
+def generate():
+    '''
+    Writes nova-style solutions of every image as fixtures, with the RA axis
+    they were made around
+    '''
+    from PIL import Image
+    for session, spec in SETS.items():
+        images = images_of(session)
+        width, height = Image.open(images[0][1]).size
+        headers, axis = nova_session_headers(width, height, spec['scale'], spec['north'], len(spec['i']))
+        folder = os.path.join(FIXTURES, session)
+        os.makedirs(folder, exist_ok=True)
+        for role, path in images:
+            with open(os.path.join(folder, os.path.basename(path) + '.wcs'), 'wb') as fle:
+                fle.write(headers[role])
+        with open(os.path.join(folder, 'axis.json'), 'w') as fle:
+            json.dump({'axis': list(axis)}, fle)
+            fle.write('\n')
+
+
+def make_config(workdir, server):
+    import PPA_lib
+    cfgfn = os.path.join(workdir, 'PPA.ini')
+    with open(cfgfn, 'w') as fle:
+        fle.write('[nova]\napikey = standin\nserver = %s\n[file]\ncachedir = %s\n'
+                  % (server, os.path.join(workdir, 'cache')))
+    return PPA_lib.PPAConfig(cfgfn)
+
+
+def timed(func, *args):
+    t_start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - t_start, result
+
+
+def replay(session, config, expected_axis):
+    '''
+    Runs one session through every phase
+    Returns ({phase: [seconds per operation]}, {phase: wall seconds}, failures)
+    '''
+    import PPA_lib
+    images = images_of(session)
+    latencies = {phase: [] for phase in PHASES}
+    walls = {}
+    failures = []
+
+    # every image submitted at once, as PPA-cli does
+    t_start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(images)) as executor:
+        futures = {role: executor.submit(timed, PPA_lib.plate_solve, config, path, 'nova')
+                   for role, path in images}
+        wcs_paths = {}
+        for role, future in futures.items():
+            seconds, wcs_paths[role] = future.result()
+            latencies['solve'].append(seconds)
+    walls['solve'] = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    for role, path in images:
+        seconds, wcs_path = timed(PPA_lib.plate_solve, config, path, 'nova')
+        latencies['cached'].append(seconds)
+        if wcs_path != wcs_paths[role]:
+            failures.append('%s: cached solve of %s gave another file' % (session, role))
+    walls['cached'] = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    summaries = {}
+    for role, _ in images:
+        seconds, summaries[role] = timed(PPA_lib.wcs_summary, config, wcs_paths[role])
+        latencies['summary'].append(seconds)
+    walls['summary'] = time.perf_counter() - t_start
+
+    seconds, axis = timed(PPA_lib.find_ra_axis_pix_coords, summaries['v'], summaries['h'])
+    latencies['axis'].append(seconds)
+    walls['axis'] = seconds
+    if expected_axis is not None and axis_error(axis, expected_axis) > 0.01:
+        failures.append('%s: RA axis at %s, expected %s' % (session, list(axis), list(expected_axis)))
+
+    t_start = time.perf_counter()
+    for role, _ in images[2:]:
+        seconds, _ = timed(PPA_lib.find_error, axis, summaries[role])
+        latencies['error'].append(seconds)
+    walls['error'] = time.perf_counter() - t_start
+    return latencies, walls, failures
+
+
+def record(apikey):
+    '''
+    Solves every image on nova.astrometry.net and keeps the solutions as fixtures
+    '''
+    import PPA_lib
+    workdir = tempfile.mkdtemp(prefix='ppa-record-')
+    try:
+        config = make_config(workdir, PPA_lib.NovaClient.default_url)
+        config.apikey = apikey
+        for session in SETS:
+            os.makedirs(os.path.join(FIXTURES, session), exist_ok=True)
+            for role, path in images_of(session):
+                wcs_path = PPA_lib.plate_solve(config, path, 'nova')
+                shutil.copy(wcs_path, os.path.join(FIXTURES, session, os.path.basename(path) + '.wcs'))
+            # the true axis of a recorded session is not known
+            try:
+                os.remove(os.path.join(FIXTURES, session, 'axis.json'))
+            except OSError:
+                pass
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark over the Testing image sets')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed replays per session, after a warm-up one (default 3)')
+    parser.add_argument('--solve-delay', type=float, default=0.0,
+                        help='seconds the stand-in takes to solve an image (default 0)')
+    parser.add_argument('--save', action='store_true', help='record the results as the baseline')
+    parser.add_argument('--check', action='store_true', help='fail if slower than the baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='allowed slowdown over the baseline (default 1.5x)')
+    parser.add_argument('--slack', type=float, default=5.0,
+                        help='milliseconds any phase may lose whatever its baseline, as '
+                             'millisecond phases are noisy (default 5)')
+    parser.add_argument('--verbose', action='store_true', help="show PPA's own output")
+    parser.add_argument('--record', action='store_true', help='record real solutions from nova as fixtures')
+    parser.add_argument('--apikey', help='nova API key, for --record')
+    parser.add_argument('--generate', action='store_true', help='make nova-style solutions as fixtures')
+    opts = parser.parse_args()
+    if opts.check and opts.repeat < CHECK_REPEAT:
+        parser.error('--check needs --repeat %d or more, for a steady median' % CHECK_REPEAT)
+
+    if opts.generate:
+        generate()
+        return 0
+
+    if opts.record:
+        if not opts.apikey:
+            parser.error('--record needs --apikey')
+        record(opts.apikey)
+        return 0
+
+    results = {}
+    failures = []
+    print('%-14s %-8s %10s %10s %12s' % ('session', 'phase', 'median ms', 'max ms', 'ops/s'))
+    for session in SETS:
+        solutions, expected_axis = load_fixtures(session)
+        server = NovaStandIn(solutions, opts.solve_delay).start()
+        latencies = {phase: [] for phase in PHASES}
+        walls = {phase: 0.0 for phase in PHASES}
+        try:
+            for run in range(opts.repeat + 1):
+                workdir = tempfile.mkdtemp(prefix='ppa-bench-')
+                try:
+                    output = sys.stdout if opts.verbose else io.StringIO()
+                    with contextlib.redirect_stdout(output):
+                        config = make_config(workdir, server.url)
+                        run_latencies, run_walls, run_failures = replay(session, config, expected_axis)
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+                failures += run_failures
+                if run == 0:
+                    continue  # warm-up: imports, first connections
+                for phase in PHASES:
+                    latencies[phase] += run_latencies[phase]
+                    walls[phase] += run_walls[phase]
+        finally:
+            server.stop()
+        results[session] = {}
+        for phase in PHASES:
+            median = statistics.median(latencies[phase])
+            results[session][phase] = median
+            print('%-14s %-8s %10.2f %10.2f %12.1f' % (session, phase, median * 1e3, max(latencies[phase]) * 1e3,
+                                                      len(latencies[phase]) / walls[phase]))
+        print('%-14s requests %s' % ('', ', '.join('%s %d' % item for item in server.counts.items())))
+
+    if opts.check:
+        try:
+            with open(BASELINE) as fle:
+                baseline = json.load(fle)
+        except OSError:
+            baseline = {}
+        for session, phases in results.items():
+            for phase, seconds in phases.items():
+                allowed = baseline.get(session, {}).get(phase)
+                if allowed is not None and seconds > allowed * opts.tolerance + opts.slack / 1e3:
+                    failures.append('%s %s: %.2f ms, baseline %.2f ms' % (session, phase, seconds * 1e3, allowed * 1e3))
+    if opts.save:
+        with open(BASELINE, 'w') as fle:
+            json.dump({session: {phase: round(seconds, 5) for phase, seconds in phases.items()}
+                       for session, phases in results.items()}, fle, indent=2)
+            fle.write('\n')
+
+    for failure in failures:
+        print('FAIL', failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
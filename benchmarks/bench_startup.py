@@ -0,0 +1,141 @@
+'''
+Cold-start benchmark for PPA-cli
+
+Times fresh interpreters running each CLI code path, and checks which heavy
+modules each one imports:
+
+    python benchmarks/bench_startup.py                 # report
+    python benchmarks/bench_startup.py --save          # record a baseline
+    python benchmarks/bench_startup.py --check         # fail on regressions
+
+The "cached" path runs against a throwaway cache holding hand-written .wcs
+files for the Testing images, so it never touches a solver or the network.
+'''
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from wcs_fixtures import fits_header, tan_cards
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+CLI = os.path.join(ROOT, 'PPA-cli.py')
+BASELINE = os.path.join(HERE, 'startup_baseline.json')
+
+# Modules a code path must not import, by path
+FORBIDDEN = {
+    'help': ('numpy', 'astropy', 'scipy', 'PPA_lib'),
+    'cached': ('astropy', 'scipy'),
+}
+
+
+def make_fixtures(workdir):
+    '''
+    Copies the Testing images into workdir and writes their solutions into a
+    cache there: v is h turned 90 degrees about a point near the pole, i is h
+    Returns the CLI arguments for a fully cached run
+    '''
+    sys.path.insert(0, ROOT)
+    import PPA_lib
+
+    cfgfn = os.path.join(workdir, 'PPA.ini')
+    cachedir = os.path.join(workdir, 'cache')
+    with open(cfgfn, 'w') as fle:
+        fle.write('[file]\ncachedir = %s\n' % cachedir)
+    config = PPA_lib.PPAConfig(cfgfn)
+
+    scale = 0.001  # degrees per pixel
+    crpix = (320.0, 240.0)
+    cds = {'h': ((-scale, 0.0), (0.0, scale)),
+           'v': ((0.0, -scale), (-scale, 0.0)),
+           'i': ((-scale, 0.0), (0.0, scale))}
+    args = ['--solver', 'nova', '--config', cfgfn, '--cache-dir', cachedir]
+    flags = {'h': '--horizontal', 'v': '--vertical', 'i': '--improved'}
+    for hint, cd in cds.items():
+        image = os.path.join(workdir, hint + '.jpg')
+        shutil.copy(os.path.join(ROOT, 'Testing', hint + '.jpg'), image)
+        wcsfn = PPA_lib.get_wcs_file_path(config, image)
+        os.makedirs(os.path.dirname(wcsfn), exist_ok=True)
+        with open(wcsfn, 'wb') as fle:
+            fle.write(fits_header(tan_cards((30.0, 89.2), crpix, cd)))
+        args += [flags[hint], image]
+    return args
+
+
+def run(args, env=None, importtime=False):
+    '''
+    Runs the CLI in a fresh interpreter; returns (seconds, stdout, stderr)
+    '''
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + [CLI] + args
+    t_start = time.perf_counter()
+    proc = subprocess.run(cmd, capture_output=True, text=True, cwd=ROOT, env=env)
+    return time.perf_counter() - t_start, proc.stdout, proc.stderr
+
+
+def imported(stderr):
+    '''
+    The top-level packages named in -X importtime output
+    '''
+    names = set()
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            names.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start benchmark for PPA-cli')
+    parser.add_argument('--repeat', type=int, default=7, help='runs per code path (default 7)')
+    parser.add_argument('--save', action='store_true', help='record the results as the baseline')
+    parser.add_argument('--check', action='store_true', help='fail if slower than the baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='allowed slowdown over the baseline (default 1.5x)')
+    opts = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ppa-bench-')
+    env = dict(os.environ, HOME=workdir, XDG_CONFIG_HOME=workdir, XDG_CACHE_HOME=workdir)
+    try:
+        paths = {'help': ['--help'], 'cached': make_fixtures(workdir)}
+        results = {}
+        failures = []
+        for name, args in paths.items():
+            run(args, env)  # warm the OS file cache and the .pyc files
+            times = [run(args, env)[0] for _ in range(opts.repeat)]
+            _, stdout, stderr = run(args, env, importtime=True)
+            if name == 'cached' and 'Right' not in stdout and 'Left' not in stdout:
+                failures.append('%s: no alignment error reported\n%s%s' % (name, stdout, stderr))
+            heavy = sorted(imported(stderr) & set(FORBIDDEN[name]))
+            if heavy:
+                failures.append('%s: imports %s' % (name, ', '.join(heavy)))
+            results[name] = statistics.median(times)
+            print('%-8s median %6.3f s  min %6.3f s  (%d runs)' % (name, results[name], min(times), opts.repeat))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if opts.check:
+        try:
+            with open(BASELINE) as fle:
+                baseline = json.load(fle)
+        except OSError:
+            baseline = {}
+        for name, seconds in results.items():
+            if name in baseline and seconds > baseline[name] * opts.tolerance:
+                failures.append('%s: %.3f s, baseline %.3f s' % (name, seconds, baseline[name]))
+    if opts.save:
+        with open(BASELINE, 'w') as fle:
+            json.dump({name: round(seconds, 3) for name, seconds in results.items()}, fle, indent=2)
+            fle.write('\n')
+
+    for failure in failures:
+        print('FAIL', failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
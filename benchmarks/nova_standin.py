@@ -0,0 +1,112 @@
+'''
+A local stand-in for the nova.astrometry.net API
+
+Serves the endpoints NovaClient uses (login, upload, submissions, jobs and
+wcs_file) from memory, answering each upload with the recorded solution of
+the uploaded file:
+
+    server = NovaStandIn({sha256 of image bytes: wcs bytes}, solve_delay=0.5)
+    server.start()
+    ... config.nova_server = server.url ...
+    server.stop()
+
+Uploads it has no solution for fail, like an unsolvable image would.
+'''
+import hashlib
+import http.server
+import json
+import threading
+import time
+from urllib.parse import parse_qs
+
+
+class NovaStandIn(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, solutions, solve_delay=0.0, port=0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.solutions = solutions
+        self.solve_delay = solve_delay
+        self.jobs = {}  # job id -> (time solved, wcs bytes or None)
+        self.counts = {'login': 0, 'upload': 0, 'submissions': 0, 'jobs': 0, 'wcs_file': 0}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/api/' % self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='nova-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, endpoint):
+        with self._lock:
+            self.counts[endpoint] += 1
+
+    def submit(self, data):
+        with self._lock:
+            job_id = len(self.jobs) + 1
+            self.jobs[job_id] = (time.time() + self.solve_delay,
+                                 self.solutions.get(hashlib.sha256(data).hexdigest()))
+        return job_id
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like nova
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body, content_type='application/json', status=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _uploaded_file(self, body):
+        # the part after the request-json one, up to the closing boundary
+        boundary = self.headers['Content-Type'].split('boundary=', 1)[1].strip('"').encode()
+        part = body.split(b'--' + boundary)[2]
+        return part.split(b'\r\n\r\n', 1)[1][:-1]
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = self.path.split('/api/', 1)[-1].strip('/')
+        server = self.server
+        if path == 'login':
+            server.count('login')
+            return self._reply({'status': 'success', 'message': 'authenticated user', 'session': 'standin'})
+        if path == 'upload':
+            server.count('upload')
+            job_id = server.submit(self._uploaded_file(body))
+            return self._reply({'status': 'success', 'subid': job_id, 'hash': '%040x' % job_id})
+        args = json.loads(parse_qs(body.decode()).get('request-json', ['{}'])[0])
+        if args.get('session') != 'standin':
+            return self._reply({'status': 'error', 'errormessage': 'no session with key'})
+        endpoint, _, ident = path.partition('/')
+        if endpoint == 'submissions':
+            # the job starts straight away, as the submission is looked at
+            server.count('submissions')
+            return self._reply({'processing_started': 'now', 'jobs': [int(ident)], 'job_calibrations': []})
+        if endpoint == 'jobs':
+            server.count('jobs')
+            ready, wcs = server.jobs[int(ident)]
+            status = 'solving' if time.time() < ready else ('success' if wcs is not None else 'failure')
+            return self._reply({'status': status})
+        self._reply({'status': 'error', 'errormessage': 'unknown service %s' % path}, status=404)
+
+    def do_GET(self):
+        if self.path.startswith('/wcs_file/'):
+            self.server.count('wcs_file')
+            _, wcs = self.server.jobs[int(self.path.rsplit('/', 1)[1])]
+            return self._reply(wcs, 'application/fits')
+        self._reply({'status': 'error'}, status=404)
@@ -0,0 +1,166 @@
+'''
+Plate-solution fixtures for the benchmarks
+
+Writes FITS headers by hand, so no astropy is needed. nova_session_headers
+makes the solutions of an alignment session in the form of nova's wcs_file
+answers (TAN-SIP with second-order distortion, nova's header cards and solver
+comments): a horizontal image, the vertical one taken after turning the mount
+90 degrees in RA (the whole sky turned about the sky point at a known RA axis
+pixel), and improved images closing in on the pole. benchmarks/fixtures holds
+these, made with bench_pipeline.py --generate, until real solutions are
+recorded with bench_pipeline.py --record.
+'''
+import math
+
+
+def fits_header(cards, comments=()):
+    '''
+    A primary FITS header (no data) from (key, value) pairs and COMMENT lines
+    '''
+    lines = ['%-8s= %20s' % ('SIMPLE', 'T'), '%-8s= %20d' % ('BITPIX', 8), '%-8s= %20d' % ('NAXIS', 0)]
+    for key, value in cards:
+        if isinstance(value, bool):
+            lines.append('%-8s= %20s' % (key, 'T' if value else 'F'))
+        elif isinstance(value, str):
+            lines.append('%-8s= %-20s' % (key, "'%-8s'" % value))
+        elif isinstance(value, float):
+            text = repr(value).upper()
+            if '.' not in text:
+                text = text.replace('E', '.0E')
+            lines.append('%-8s= %20s' % (key, text))
+        else:
+            lines.append('%-8s= %20r' % (key, value))
+    lines += ['COMMENT ' + comment for comment in comments]
+    lines.append('END')
+    text = ''.join(line.ljust(80) for line in lines)
+    return text.ljust((len(text) + 2879) // 2880 * 2880).encode('ascii')
+
+
+def tan_cards(crval, crpix, cd, width=None, height=None):
+    return [('CTYPE1', 'RA---TAN'), ('CTYPE2', 'DEC--TAN'), ('EQUINOX', 2000.0), ('LONPOLE', 180.0),
+            ('CRVAL1', crval[0]), ('CRVAL2', crval[1]), ('CRPIX1', crpix[0]), ('CRPIX2', crpix[1]),
+            ('CD1_1', cd[0][0]), ('CD1_2', cd[0][1]), ('CD2_1', cd[1][0]), ('CD2_2', cd[1][1]),
+            ('IMAGEW', width or 2 * crpix[0]), ('IMAGEH', height or 2 * crpix[1])]
+
+
+def axis_error(found, expected):
+    return math.hypot(found[0] - expected[0], found[1] - expected[1])
+
+
+# second-order distortion of a typical camera lens, shared by every frame of
+# a session (SIP's A, B and their inverses AP, BP)
+SIP = {'A': {(0, 2): 2.1e-07, (1, 1): -3.4e-07, (2, 0): 1.2e-07},
+       'B': {(0, 2): -1.6e-07, (1, 1): 2.7e-07, (2, 0): 3.0e-07}}
+
+
+def nova_header(crval, crpix, cd, width, height, scale, index=5203):
+    '''
+    A solution laid out like nova's wcs_file answer: TAN-SIP, nova's cards and
+    the solver comments (scale and parity among them)
+    '''
+    cards = [('EXTEND', True), ('WCSAXES', 2), ('CTYPE1', 'RA---TAN-SIP'), ('CTYPE2', 'DEC--TAN-SIP'),
+             ('EQUINOX', 2000.0), ('LONPOLE', 180.0), ('LATPOLE', 0.0),
+             ('CRVAL1', crval[0]), ('CRVAL2', crval[1]), ('CRPIX1', crpix[0]), ('CRPIX2', crpix[1]),
+             ('CUNIT1', 'deg'), ('CUNIT2', 'deg'),
+             ('CD1_1', cd[0][0]), ('CD1_2', cd[0][1]), ('CD2_1', cd[1][0]), ('CD2_2', cd[1][1]),
+             ('IMAGEW', width), ('IMAGEH', height)]
+    for name in ('A', 'B'):
+        cards.append(('%s_ORDER' % name, 2))
+        cards += [('%s_%d_%d' % (name, i, j), value) for (i, j), value in sorted(SIP[name].items())]
+    for name in ('A', 'B'):
+        cards.append(('%sP_ORDER' % name, 2))
+        cards += [('%sP_%d_%d' % (name, i, j), -value) for (i, j), value in sorted(SIP[name].items())]
+    parity = 1 if cd[0][0] * cd[1][1] - cd[0][1] * cd[1][0] < 0 else 0
+    comments = ['PPA benchmark fixture: generated in nova form, not recorded',
+                '-- onefield solver parameters: --',
+                'Index name: index-%d-03.fits' % index,
+                'Cxdx margin: 0', 'Field edge margin: 0', 'Quad size min: 0', 'Quad size max: 0',
+                'Tweak: yes', 'Tweak AB order: 2', 'Tweak ABP order: 2',
+                'Field width: %d pixels' % width, 'Field height: %d pixels' % height,
+                '-- properties of the matching quad: --',
+                'index id: %d' % index, 'index healpix: 23', 'index hpnside: 1',
+                'log odds: 131.8', 'odds: 1.7e+57', 'quadno: 58213',
+                'scale: %.6f arcsec/pix' % scale, 'parity: %d' % parity,
+                'field: %s' % ' '.join('%.1f' % v for v in (crpix[0], crpix[1], width, height))]
+    return fits_header(cards, comments)
+
+
+def _unit(ra, dec):
+    ra, dec = math.radians(ra), math.radians(dec)
+    return (math.cos(dec) * math.cos(ra), math.cos(dec) * math.sin(ra), math.sin(dec))
+
+
+def _radec(vec):
+    return (math.degrees(math.atan2(vec[1], vec[0])) % 360.0, math.degrees(math.asin(max(-1.0, min(1.0, vec[2])))))
+
+
+def _rotate(vec, axis, angle):
+    '''
+    vec turned by angle (radians) about the unit vector axis (Rodrigues)
+    '''
+    cos, sin = math.cos(angle), math.sin(angle)
+    cross = (axis[1] * vec[2] - axis[2] * vec[1], axis[2] * vec[0] - axis[0] * vec[2],
+             axis[0] * vec[1] - axis[1] * vec[0])
+    dot = sum(a * v for a, v in zip(axis, vec))
+    return tuple(v * cos + c * sin + a * dot * (1 - cos) for v, c, a in zip(vec, cross, axis))
+
+
+def _pix2world(crval, crpix, cd, pix):
+    xi, eta = (math.radians(sum(cd[i][k] * (pix[k] - crpix[k]) for k in range(2))) for i in range(2))
+    ra0, dec0 = math.radians(crval[0]), math.radians(crval[1])
+    denom = math.cos(dec0) - eta * math.sin(dec0)
+    return (math.degrees(ra0 + math.atan2(xi, denom)) % 360.0,
+            math.degrees(math.atan2(math.sin(dec0) + eta * math.cos(dec0), math.hypot(xi, denom))))
+
+
+def _world2plane(crval, world):
+    ra0, dec0 = math.radians(crval[0]), math.radians(crval[1])
+    ra, dec = math.radians(world[0]), math.radians(world[1])
+    cosc = math.sin(dec0) * math.sin(dec) + math.cos(dec0) * math.cos(dec) * math.cos(ra - ra0)
+    xi = math.cos(dec) * math.sin(ra - ra0) / cosc
+    eta = (math.cos(dec0) * math.sin(dec) - math.sin(dec0) * math.cos(dec) * math.cos(ra - ra0)) / cosc
+    return math.degrees(xi), math.degrees(eta)
+
+
+def turned_solution(crval, crpix, cd, width, height, axis, angle):
+    '''
+    The (crval, cd) of a frame taken after turning the mount by angle
+    (degrees) about the sky point seen at pixel axis: the same detector, so
+    the same crpix, and the whole sky turned about that point
+    '''
+    pole = _unit(*_pix2world(crval, crpix, cd, axis))
+    turn = lambda world: _radec(_rotate(_unit(*world), pole, math.radians(angle)))
+    crval_t = turn(crval)
+    # the CD matrix taking pixel offsets to the turned tangent plane: TAN is
+    # unchanged by rotations of the sky, so two pixel offsets fix it exactly
+    (du1, dv1), (du2, dv2) = (width / 2.0, 0.0), (0.0, height / 2.0)
+    planes = [_world2plane(crval_t, turn(_pix2world(crval, crpix, cd, (crpix[0] + du, crpix[1] + dv))))
+              for du, dv in ((du1, dv1), (du2, dv2))]
+    det = du1 * dv2 - du2 * dv1
+    cd_t = tuple(((planes[0][i] * dv2 - planes[1][i] * dv1) / det, (du1 * planes[1][i] - du2 * planes[0][i]) / det)
+                 for i in range(2))
+    return crval_t, cd_t
+
+
+def nova_session_headers(width, height, scale, north=True, improved=0):
+    '''
+    nova-style solutions for one alignment session, the vertical image being
+    the horizontal one turned 90 degrees in RA
+    scale: arcsec/pixel
+    Returns ({'h': header, 'v': header, 'i1': header, ...}, true RA axis pixel)
+    '''
+    deg = scale / 3600.0
+    sign = 1 if north else -1
+    crpix = (width / 2 + 0.5, height / 2 + 0.5)
+    axis = (crpix[0] + 0.1 * width, crpix[1] - 0.08 * height)
+    offset = 0.3 * min(width, height) * deg
+    crval = (30.0, sign * (90 - offset))
+    cd_h = ((-deg, 0.0), (0.0, deg))
+    crval_v, cd_v = turned_solution(crval, crpix, cd_h, width, height, axis, sign * 90.0)
+    headers = {'h': nova_header(crval, crpix, cd_h, width, height, scale),
+               'v': nova_header(crval_v, crpix, cd_v, width, height, scale)}
+    for k in range(1, improved + 1):
+        # each adjustment takes the centre a little closer to the pole
+        dec = sign * (90 - offset * (1 - k / (improved + 1.0)))
+        headers['i%d' % k] = nova_header((30.0 + 5 * k, dec), crpix, cd_h, width, height, scale)
+    return headers, axis